@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+cache.py: read-through cache for results of idempotent commands
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import sys
+import logging
+import collections
+
+
+ROOT_PATH = '.'
+
+
+def parent_path(path):
+    return os.path.dirname(path) or ROOT_PATH
+
+
+def estimate_size(value):
+    """
+    Return a rough estimate of the memory occupied by ``value`` and all the
+    objects it references.
+    """
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v)
+                                          for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + estimate_size(vars(value))
+    slots = slot_names(type(value))
+    if slots:
+        return sys.getsizeof(value) + sum(
+            estimate_size(getattr(value, name, None)) for name in slots)
+    return sys.getsizeof(value)
+
+
+def slot_names(cls):
+    """
+    Return names of the slots declared by ``cls`` and its base classes.
+    """
+    names = []
+    for klass in cls.__mro__:
+        slots = getattr(klass, '__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(slots)
+    return names
+
+
+class ResponseCache(object):
+    """
+    Memory bounded LRU cache of command results.
+
+    Every cached result depends on the subtree of a single index path. Changes
+    to the index are reported through :py:meth:`invalidate`, which bumps the
+    generation counters of the changed path and all of its ancestors. A cached
+    result is fresh as long as no change happened within its subtree, nor was
+    any of the ancestors of its path replaced as a whole, since the result was
+    computed.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get('cache.enabled', True)
+        self.max_size = int(config.get('cache.max_size', 4 * 1024 * 1024))
+        # results larger than this would evict most of the cache at once
+        self.max_entry_size = self.max_size // 4
+        self.max_generations = config.get('cache.max_generations', 65536)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # generation counters are stamps of a logical clock which is
+        # advanced on every invalidation
+        self.clock = 0
+        self.floor = 0
+        self.subtree_gens = dict()
+        self.path_gens = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.resets = 0
+
+    def fetch(self, handler, execute):
+        """
+        Return cached result of ``handler`` if it is still fresh, otherwise
+        invoke ``execute`` and cache its return value.
+        """
+        key = handler.cache_key() if self.enabled else None
+        if key is None:
+            return execute()
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            (stamp, path, size, result) = entry
+            if self.is_fresh(path, stamp):
+                self.hits += 1
+                self.entries[key] = entry
+                return result
+            self.size -= size
+            self.invalidations += 1
+        self.misses += 1
+        stamp = self.clock
+        result = execute()
+        self.store(key, stamp, handler.cache_path(), result)
+        return result
+
+    def store(self, key, stamp, path, result):
+        size = estimate_size(key) + estimate_size(result)
+        if size > self.max_entry_size:
+            return
+        self.entries[key] = (stamp, path, size, result)
+        self.size += size
+        while self.size > self.max_size:
+            (_, (_, _, old_size, _)) = self.entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def is_fresh(self, path, stamp):
+        if stamp < self.floor:
+            return False
+        if self.subtree_gens.get(path, 0) > stamp:
+            return False
+        while path != ROOT_PATH:
+            path = parent_path(path)
+            if self.path_gens.get(path, 0) > stamp:
+                return False
+        return True
+
+    def invalidate(self, path):
+        """
+        Mark the subtree of ``path`` as changed.
+        """
+        if not self.enabled:
+            return
+        self.clock += 1
+        path = os.path.normpath(path)
+        self.path_gens[path] = self.clock
+        self.subtree_gens[path] = self.clock
+        while path != ROOT_PATH:
+            path = parent_path(path)
+            self.subtree_gens[path] = self.clock
+        if len(self.subtree_gens) > self.max_generations:
+            self.reset()
+
+    def reset(self):
+        """
+        Drop all cached results and generation counters. Results which are
+        being computed at the moment are rejected by moving the floor of valid
+        stamps past them.
+        """
+        self.entries.clear()
+        self.size = 0
+        self.subtree_gens.clear()
+        self.path_gens.clear()
+        self.floor = self.clock
+        self.resets += 1
+        logging.debug('Response cache reset')
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {
+            'enabled': self.enabled,
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(hit_rate, 3),
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'resets': self.resets,
+        }
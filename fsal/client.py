@@ -7,11 +7,11 @@ import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element, SubElement, tostring
 
 from . import commandtypes
-from .fs import File, Directory
+from .fs import File, Directory, PathEntry, FIELDS_ALL
 from .events import event_from_xml
 from .utils import to_unicode
 from .serialize import str_to_bool, bool_to_str, singular_name
-from .exceptions import OpenError
+from .exceptions import FSALError, OpenError, CommandBusyError
 
 
 IN_ENCODING = 'utf-8'
@@ -20,7 +20,12 @@ OUT_ENCODING = 'utf-8'
 
 def build_request_xml(command, params):
     root = Element('request')
-    command_node = SubElement(root, 'command')
+    add_command_xml(root, command, params)
+    return root
+
+
+def add_command_xml(parent, command, params):
+    command_node = SubElement(parent, 'command')
     type_node = SubElement(command_node, 'type')
     type_node.text = command
     params_node = SubElement(command_node, 'params')
@@ -33,7 +38,7 @@ def build_request_xml(command, params):
             add_list_xml(list(value), param_node)
         else:
             param_node.text = to_unicode(value)
-    return root
+    return command_node
 
 
 def add_list_xml(items, parent):
@@ -61,16 +66,57 @@ def command(command_type, response_parser):
             request_xml = build_request_xml(command_type, params)
             response = self._send_request(tostring(request_xml))
             response_xml = ET.fromstring(response)
+            check_busy(response_xml)
             return response_parser(self, response_xml)
+        # expose the building blocks of the command so it can be batched
+        wrapper.command_type = command_type
+        wrapper.build_params = func
+        wrapper.response_parser = response_parser
         return wrapper
     return decorator
 
 
+def check_busy(response_xml):
+    """
+    Raise :py:class:`CommandBusyError` if the server rejected the command
+    because it is overloaded.
+    """
+    error_node = response_xml.find('./params/error')
+    if (error_node is not None and
+            error_node.text == CommandBusyError.error_code):
+        raise CommandBusyError('FSAL server is busy')
+
+
+def xml_to_dict(node):
+    """
+    Convert a tree of XML nodes into nested dicts with leaf text as values.
+    """
+    if len(node) == 0:
+        return node.text
+    return dict((child.tag, xml_to_dict(child)) for child in node)
+
+
 def iter_fsobjs(xml_node, constructor_func):
     for child in xml_node:
         yield constructor_func(child)
 
 
+def iter_listing(response_xml):
+    """
+    Return iterators of the listed directories and files, which are
+    :py:class:`PathEntry` objects if the listing asked for some fields only.
+    """
+    fields_node = response_xml.find('.//params/fields')
+    fields = FIELDS_ALL if fields_node is None else fields_node.text
+    dirs_node = response_xml.find('.//dirs')
+    files_node = response_xml.find('.//files')
+    if fields == FIELDS_ALL:
+        return (iter_fsobjs(dirs_node, Directory.from_xml),
+                iter_fsobjs(files_node, File.from_xml))
+    return (iter_fsobjs(dirs_node, PathEntry.from_xml),
+            iter_fsobjs(files_node, PathEntry.from_xml))
+
+
 def sort_listing(fso_list):
     """
     Sort list of FSObject in-place
@@ -78,6 +124,84 @@ def sort_listing(fso_list):
     fso_list.sort(key=lambda fso: fso.name)
 
 
+class BatchResult(object):
+    """
+    Placeholder for the return value of a batched command, which becomes
+    available once the batch it belongs to has been executed.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.error = None
+        self._value = None
+
+    def resolve(self, value=None, error=None):
+        self._value = value
+        self.error = error
+        self.done = True
+
+    @property
+    def value(self):
+        if not self.done:
+            raise RuntimeError('Batch has not been executed yet')
+        if self.error is not None:
+            raise FSALError(self.error)
+        return self._value
+
+
+class CommandBatch(object):
+    """
+    Collects invocations of :py:class:`FSAL` commands and sends all of them
+    to the server in a single request. Each invocation returns a
+    :py:class:`BatchResult` which is resolved by :py:meth:`execute`.
+    """
+
+    def __init__(self, fsal):
+        self._fsal = fsal
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._fsal, name)
+        command_type = getattr(method, 'command_type', None)
+        if command_type is None:
+            raise AttributeError("'{}' cannot be batched".format(name))
+
+        def collect(*args, **kwargs):
+            params = method.build_params(self._fsal, *args, **kwargs)
+            result = BatchResult()
+            self._calls.append((command_type, params, method.response_parser,
+                                result))
+            return result
+        return collect
+
+    @property
+    def results(self):
+        return [call[-1].value for call in self._calls]
+
+    def execute(self):
+        if not self._calls:
+            return
+        root = Element('request')
+        command_node = add_command_xml(root, commandtypes.COMMAND_TYPE_BATCH,
+                                       {})
+        commands_node = SubElement(command_node.find('params'), 'commands')
+        for command_type, params, _, _ in self._calls:
+            add_command_xml(commands_node, command_type, params)
+        response = self._fsal._send_request(tostring(root))
+        response_xml = ET.fromstring(response)
+        check_busy(response_xml)
+        responses_node = response_xml.find('.//responses')
+        for (command_type, _, parser, result), node in zip(self._calls,
+                                                          responses_node):
+            try:
+                result.resolve(value=parser(self._fsal, node))
+            except (AttributeError, TypeError, ValueError):
+                error_node = node.find('./params/error')
+                error = (error_node.text if error_node is not None
+                         else 'invalid_response')
+                result.resolve(error='{}: {}'.format(command_type, error))
+
+
 class FSAL(object):
 
     def __init__(self, socket_path):
@@ -103,12 +227,11 @@ class FSAL(object):
         dirs = []
         files = []
         if success:
-            dirs_node = response_xml.find('.//dirs')
-            files_node = response_xml.find('.//files')
-            dirs = list(iter_fsobjs(dirs_node, Directory.from_xml))
-            files = list(iter_fsobjs(files_node, File.from_xml))
-            sort_listing(dirs)
-            sort_listing(files)
+            (dirs, files) = map(list, iter_listing(response_xml))
+            # listings the server sorted are kept in its order
+            if response_xml.find('.//params/order') is None:
+                sort_listing(dirs)
+                sort_listing(files)
         return (success, dirs, files)
 
     def _parse_list_descendants_response(self, response_xml):
@@ -120,10 +243,11 @@ class FSAL(object):
         if success:
             count_node = response_xml.find('.//count')
             count = int(count_node.text) if count_node is not None else None
-            dirs_node = response_xml.find('.//dirs')
-            files_node = response_xml.find('.//files')
-            dirs = list(iter_fsobjs(dirs_node, Directory.from_xml))
-            files = list(iter_fsobjs(files_node, File.from_xml))
+            counts_node = response_xml.find('.//params/counts')
+            if counts_node is not None:
+                count = dict((node.tag, int(node.text))
+                             for node in counts_node)
+            (dirs, files) = map(list, iter_listing(response_xml))
         return (success, count, dirs, files)
 
     def _parse_exists_response(self, response_xml):
@@ -216,11 +340,86 @@ class FSAL(object):
         size = int(response_xml.find('.//size').text)
         return success, size
 
+    def _parse_stats_response(self, response_xml):
+        params_node = response_xml.find('.//params')
+        if params_node is None:
+            return {}
+        return xml_to_dict(params_node)
+
+    @command(commandtypes.COMMAND_TYPE_GET_STATS, _parse_stats_response)
+    def get_stats(self):
+        """ Returns server statistics as nested dicts of strings """
+        return {}
+
+    @command(commandtypes.COMMAND_TYPE_SET_PROFILING, _parse_stats_response)
+    def set_profiling(self, enabled=None, threshold=None,
+                      profile_requests=None, profile_indexing=None):
+        """
+        Toggle the slow command log, set its ``threshold`` in milliseconds,
+        or request profiles of the next ``profile_requests`` commands or of
+        the next indexing run. Returns the resulting profiler state.
+        """
+        params = {}
+        if enabled is not None:
+            params['enabled'] = bool_to_str(enabled)
+        if threshold is not None:
+            params['threshold'] = threshold
+        if profile_requests is not None:
+            params['profile_requests'] = profile_requests
+        if profile_indexing is not None:
+            params['profile_indexing'] = bool_to_str(profile_indexing)
+        return params
+
+    def _parse_aggregate_response(self, response_xml):
+        success_node = response_xml.find('.//success')
+        success = str_to_bool(success_node.text)
+        groups = []
+        if success:
+            for group_node in response_xml.find('.//groups'):
+                group = dict((node.tag, node.text) for node in group_node)
+                group['count'] = int(group['count'])
+                group['size'] = int(group['size'])
+                groups.append(group)
+        return (success, groups)
+
+    @command(commandtypes.COMMAND_TYPE_AGGREGATE, _parse_aggregate_response)
+    def aggregate(self, path, group_by, ignored_paths=None):
+        """
+        Return the number of entries under ``path`` and the total size of
+        files among them, grouped by a list of any of ``type``, ``extension``,
+        ``base_path`` and ``day``, ``week`` or ``month`` of modification.
+        Groups are dicts of ``count``, ``size`` and the grouped by values.
+        """
+        params = {'path': path, 'group_by': group_by}
+        if ignored_paths is not None:
+            params['ignored_paths'] = ignored_paths
+        return params
+
     @command(commandtypes.COMMAND_TYPE_GET_PATH_SIZE, _parse_get_path_size_response)
     def get_path_size(self, path):
         """ Moves content from a list of sources to a single destination """
         return {'path': path}
 
+    def _parse_storage_info_response(self, response_xml):
+        info = []
+        for node in response_xml.find('.//base_paths'):
+            entry = xml_to_dict(node)
+            for (key, value) in entry.items():
+                if key != 'path':
+                    entry[key] = int(value)
+            info.append(entry)
+        return info
+
+    @command(commandtypes.COMMAND_TYPE_STORAGE_INFO,
+             _parse_storage_info_response)
+    def storage_info(self):
+        """
+        Return a list of dicts of the number of indexed ``files`` and
+        ``dirs`` and their size in ``bytes`` for each base ``path``, with the
+        ``capacity`` and ``free`` bytes of its storage if it is accessible.
+        """
+        return {}
+
     def _parse_consolidate_response(self, response_xml):
         success_node = response_xml.find('.//success')
         success = str_to_bool(success_node.text)
@@ -241,12 +440,27 @@ class FSAL(object):
         return {}
 
     @command(commandtypes.COMMAND_TYPE_LIST_DIR, _parse_list_dir_response)
-    def list_dir(self, path):
-        return {'path': path}
+    def list_dir(self, path, order=None):
+        """
+        Return the directories and files within ``path``, sorted by name, or
+        by ``order`` on the server if specified: one of ``name``, ``natural``
+        (numbers within names sorted by value), ``size`` or ``mtime``, which
+        is prefixed with ``-`` for descending order.
+        """
+        params = {'path': path}
+        if order is not None:
+            params['order'] = order
+        return params
 
     @command(commandtypes.COMMAND_TYPE_LIST_DESCENDANTS, _parse_list_descendants_response)
     def list_descendants(self, path, count=False, offset=None, limit=None,
-                         order=None, span=None, entry_type=None, ignored_paths=None):
+                         order=None, span=None, entry_type=None, ignored_paths=None,
+                         fields=None):
+        """
+        With ``fields`` set to ``paths`` or ``sizes``, the listed entries are
+        :py:class:`PathEntry` objects, and with ``counts`` the returned count
+        is a dict of the number of ``dirs`` and ``files`` instead.
+        """
         params = {'path': path, 'count': bool_to_str(count)}
         if order is not None:
             params['order'] = order
@@ -260,6 +474,8 @@ class FSAL(object):
             params['entry_type'] = entry_type
         if ignored_paths is not None:
             params['ignored_paths'] = ignored_paths
+        if fields is not None:
+            params['fields'] = fields
         return params
 
     @command(commandtypes.COMMAND_TYPE_EXISTS, _parse_exists_response)
@@ -282,18 +498,24 @@ class FSAL(object):
         return {'path': path}
 
     @command(commandtypes.COMMAND_TYPE_SEARCH, _parse_search_response)
-    def search(self, query, whole_words=False, exclude=None):
-        return {'query': query,
-                'whole_words': bool_to_str(whole_words),
-                'excludes': exclude}
+    def search(self, query, whole_words=False, exclude=None, fields=None):
+        params = {'query': query,
+                  'whole_words': bool_to_str(whole_words),
+                  'excludes': exclude}
+        if fields is not None:
+            params['fields'] = fields
+        return params
 
     @command(commandtypes.COMMAND_TYPE_FILTER, _parse_list_dir_response)
-    def filter(self, paths):
+    def filter(self, paths, fields=None):
         """
         Return a subset of all file system objects from the database which
         paths can be found in the passed in list.
         """
-        return {'paths': paths}
+        params = {'paths': paths}
+        if fields is not None:
+            params['fields'] = fields
+        return params
 
     @command(commandtypes.COMMAND_TYPE_GET_FSO, _parse_get_fso_response)
     def get_fso(self, path):
@@ -317,6 +539,17 @@ class FSAL(object):
     def confirm_changes(self, limit):
         return {'limit': limit}
 
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect the commands invoked on the yielded :py:class:`CommandBatch`
+        and send them to the server in a single request when the block exits.
+        Read-only commands in a batch observe the same state of the index.
+        """
+        batch = CommandBatch(self)
+        yield batch
+        batch.execute()
+
     @contextlib.contextmanager
     def open(self, path, mode):
         (success, fso) = self.get_fso(path)
@@ -330,12 +563,20 @@ class FSAL(object):
             file_obj.close()
             raise
         finally:
-            self.refresh_path(fso.rel_path)
+            self.refresh_file(fso.rel_path)
 
     @command(commandtypes.COMMAND_TYPE_REFRESH_PATH, _parse_generic_response)
     def refresh_path(self, path):
         return {'path': path}
 
+    @command(commandtypes.COMMAND_TYPE_REFRESH_FILE, _parse_generic_response)
+    def refresh_file(self, path):
+        """
+        Update the index entry of the single file at ``path``, which is
+        done by the time this returns.
+        """
+        return {'path': path}
+
     @command(commandtypes.COMMAND_TYPE_REFRESH, _parse_empty_response)
     def refresh(self):
         return {}
@@ -11,21 +11,27 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 COMMAND_TYPE_COPY = 'copy'
+COMMAND_TYPE_BATCH = 'batch'
 COMMAND_TYPE_ISDIR = 'isdir'
 COMMAND_TYPE_EXISTS = 'exists'
 COMMAND_TYPE_ISFILE = 'isfile'
 COMMAND_TYPE_REMOVE = 'remove'
 COMMAND_TYPE_FILTER = 'filter'
 COMMAND_TYPE_SEARCH = 'search'
+COMMAND_TYPE_AGGREGATE = 'aggregate'
 COMMAND_TYPE_REFRESH = 'refresh'
 COMMAND_TYPE_GET_FSO = 'get_fso'
 COMMAND_TYPE_TRANSFER = 'transfer'
 COMMAND_TYPE_LIST_DIR = 'list_dir'
+COMMAND_TYPE_GET_STATS = 'get_stats'
 COMMAND_TYPE_CONSOLIDATE = 'consolidate'
 COMMAND_TYPE_GET_CHANGES = 'get_changes'
 COMMAND_TYPE_REFRESH_PATH = 'refresh_path'
+COMMAND_TYPE_REFRESH_FILE = 'refresh_file'
 COMMAND_TYPE_GET_PATH_SIZE = 'get_path_size'
+COMMAND_TYPE_STORAGE_INFO = 'storage_info'
 COMMAND_TYPE_SET_WHITELIST = 'set_whitelist'
+COMMAND_TYPE_SET_PROFILING = 'set_profiling'
 COMMAND_TYPE_CONFIRM_CHANGES = 'confirm_changes'
 COMMAND_TYPE_LIST_BASE_PATHS = 'list_base_paths'
 COMMAND_TYPE_LIST_DESCENDANTS = 'list_descendants'
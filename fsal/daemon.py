@@ -2,10 +2,120 @@
 
 import os
 import sys
+import time
+import signal
 import atexit
+import logging
 import argparse
 
+import gevent
+
 import fsal.server
+from fsal.db.databases import init_databases, close_databases
+from fsal.db.sqlite import MEMORY
+from fsal.workers import Channel
+
+
+#: Seconds to wait before restarting a process which exited unexpectedly
+RESTART_DELAY = 1
+
+
+class ProcessGroup(object):
+    """
+    Runs FSAL as a group of processes: an indexer process which indexes the
+    storage and extracts bundles, and query processes which serve commands
+    on a listening socket they share.
+
+    The processes communicate through the database and through pipes. Query
+    processes record the maintenance tasks they request in the task journal,
+    which the indexer polls. Every process passes its changes of the index
+    on to the query processes, each of which reads them from its own pipe and
+    applies them to its tree and response cache.
+
+    Processes which fail are restarted. On SIGINT and SIGTERM
+    the signal is passed on to all processes, and the group exits once all
+    of them did.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.query_workers = max(1, config.get('workers.query_workers', 1))
+        self.listener = None
+        self.inboxes = []
+        self.outboxes = []
+        # pid => (name, function running the process)
+        self.children = dict()
+        self.stopping = False
+        self.signals = []
+
+    def run(self):
+        if (self.config.get('database.backend') == 'sqlite' and
+                self.config.get('database.path') == MEMORY):
+            raise RuntimeError('Processes cannot share an in-memory database')
+        # migrations run once, before any of the processes connects
+        close_databases(init_databases(self.config))
+        self.listener = fsal.server.FSALServer.prepare_socket(
+            self.config['fsal.socket'])
+        for _ in range(self.query_workers):
+            (inbox, outbox) = os.pipe()
+            self.inboxes.append(inbox)
+            self.outboxes.append(outbox)
+        self.spawn('indexer', self.run_indexer)
+        for index in range(self.query_workers):
+            self.spawn('query-{}'.format(index), self.run_query_worker, index)
+        self.signals = [gevent.signal(signal.SIGINT, self.stop),
+                        gevent.signal(signal.SIGTERM, self.stop)]
+        logging.info('FSAL process group started.')
+        while self.children:
+            (pid, status) = os.waitpid(-1, 0)
+            if pid not in self.children:
+                continue
+            (name, target, args) = self.children.pop(pid)
+            if self.stopping or status == 0:
+                # stopped by a signal sent to the whole process group
+                continue
+            logging.error('FSAL process %s exited with status %d, restarting',
+                          name, status)
+            time.sleep(RESTART_DELAY)
+            self.spawn(name, target, *args)
+        self.listener.close()
+        logging.info('FSAL process group stopped.')
+
+    def spawn(self, name, target, *args):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (name, target, args)
+            return
+        for handler in self.signals:
+            # processes install signal handlers of their own
+            handler.cancel()
+        status = 0
+        try:
+            target(*args)
+        except Exception:
+            logging.exception('Unhandled exception in FSAL process %s', name)
+            status = 1
+        finally:
+            # skip the exit handlers of the parent, such as pid file removal
+            os._exit(status)
+
+    def stop(self, *args):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run_indexer(self):
+        fsal.server.run_indexer(self.config, Channel(self.outboxes))
+
+    def run_query_worker(self, index):
+        peers = [fd for (i, fd) in enumerate(self.outboxes) if i != index]
+        # only the first query process persists stats snapshots
+        fsal.server.run_query_worker(self.config, Channel(peers),
+                                     self.inboxes[index], self.listener,
+                                     snapshots=index == 0)
 
 
 def cleanup(pidfile):
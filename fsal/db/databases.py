@@ -8,32 +8,214 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import weakref
+import contextlib
+
+import gevent
+from psycopg2 import OperationalError
+from psycopg2.extras import DictCursor
 from squery_pg.migrations import migrate
+# importing the pool makes psycopg yield to the gevent hub while it waits
+from squery_pg.pool import PostgresConnectionPool
 from squery_pg.squery_pg import Database, DatabaseContainer
 
+from .sqlite import init_sqlite_databases
+
+
+#: Name of the database used by the indexer for its write batches
+INDEXER_SUFFIX = '_indexer'
+
+#: Smallest pool size supported. A pool of a single connection hands the same
+#: connection to all greenlets, so statements of other greenlets would run
+#: within, and commit, the transaction pinned to it.
+MIN_POOL_SIZE = 2
+
+
+class PreparedStatement(object):
+    """
+    Statement which is prepared once on each connection that executes it and
+    then reused, so Postgres parses and plans it only once per connection.
+
+    ``sql`` refers to the parameters as ``$1``, ``$2``, ... in the order they
+    are listed in ``params``. It is executed with a dict of parameter values.
+    """
+
+    def __init__(self, name, sql, params):
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.prepare_sql = 'PREPARE {} AS {};'.format(name, sql)
+        placeholders = ', '.join('%({})s'.format(p) for p in params)
+        self.execute_sql = 'EXECUTE {}({});'.format(name, placeholders)
+
+
+class GreenConnectionPool(PostgresConnectionPool):
+    """
+    Connection pool which pins a connection to the greenlet that opened a
+    transaction, so all statements the greenlet issues until the transaction
+    ends run on that connection, while other greenlets keep using the rest of
+    the pool. Pools must have at least :py:data:`MIN_POOL_SIZE` connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(GreenConnectionPool, self).__init__(*args, **kwargs)
+        self._pinned = weakref.WeakKeyDictionary()
+        # names of the statements prepared on each connection
+        self._prepared = weakref.WeakKeyDictionary()
+
+    @contextlib.contextmanager
+    def connection(self, isolation_level=None):
+        conn = self._pinned.get(gevent.getcurrent())
+        if conn is not None:
+            # committed or rolled back when the pinning transaction ends
+            yield conn
+            return
+        parent = super(GreenConnectionPool, self)
+        with parent.connection(isolation_level) as conn:
+            yield conn
+
+    @contextlib.contextmanager
+    def prepared(self, statement):
+        """
+        Yield a cursor of a connection on which ``statement`` is prepared.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            prepared = self._prepared.setdefault(conn, set())
+            if statement.name not in prepared:
+                # prepared statements outlive transactions, so one that was
+                # prepared within a transaction which got rolled back is
+                # still available afterwards
+                cursor.execute(statement.prepare_sql)
+                prepared.add(statement.name)
+            yield cursor
+
+    @contextlib.contextmanager
+    def transaction(self, *args, **kwargs):
+        current = gevent.getcurrent()
+        conn = self._pinned.get(current)
+        if conn is not None:
+            # nested transactions are merged into the outermost one
+            yield conn.cursor(*args, **kwargs)
+            return
+        isolation_level = kwargs.pop('isolation_level', None)
+        with self.connection(isolation_level) as conn:
+            self._pinned[current] = conn
+            try:
+                yield conn.cursor(*args, **kwargs)
+            finally:
+                del self._pinned[current]
 
-def get_databases(db_name, host, port, user, password, debug=False):
-    databases = { db_name: Database.connect(host,
-                                            port,
-                                            db_name,
-                                            user,
-                                            password,
-                                            debug=debug) }
+
+class GreenDatabase(Database):
+    """
+    Database whose transactions span all statements issued through it by the
+    greenlet that opened the transaction.
+    """
+
+    dialect = 'postgres'
+
+    def transaction(self, *args, **kwargs):
+        return self.pool.transaction(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        with self.transaction():
+            self.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+            yield
+
+    def execute_prepared(self, statement, params):
+        with self.pool.prepared(statement) as cursor:
+            cursor.execute(statement.execute_sql, params)
+            return cursor.rowcount
+
+    def executemany_prepared(self, statement, params):
+        with self.pool.prepared(statement) as cursor:
+            cursor.executemany(statement.execute_sql, params)
+            return cursor.rowcount
+
+    def fetchone_prepared(self, statement, params):
+        with self.pool.prepared(statement) as cursor:
+            cursor.execute(statement.execute_sql, params)
+            return cursor.fetchone()
+
+    def fetchiter_prepared(self, statement, params):
+        with self.pool.prepared(statement) as cursor:
+            cursor.execute(statement.execute_sql, params)
+            while True:
+                items = cursor.fetchmany()
+                if not items:
+                    break
+                for item in items:
+                    yield item
+
+    @classmethod
+    def connect(cls, host, port, database, user, password, maxsize,
+                debug=False):
+        if maxsize < MIN_POOL_SIZE:
+            raise ValueError('Database pools need at least {} connections, '
+                             'got {}'.format(MIN_POOL_SIZE, maxsize))
+        kwargs = dict(host=host,
+                      port=port,
+                      dbname=database,
+                      user=user,
+                      password=password,
+                      maxsize=maxsize,
+                      cursor_factory=DictCursor)
+        pool = GreenConnectionPool(**kwargs)
+        try:
+            conn = pool.create_connection()  # testing connection
+        except OperationalError as exc:
+            if 'does not exist' not in str(exc):
+                raise
+            cls.create(host, port, database, user, password, maxsize)
+        else:
+            conn.close()
+        return cls(pool, kwargs, debug=debug)
+
+
+def get_databases(db_name, host, port, user, password, pool_size=4,
+                  debug=False):
+    databases = { db_name: GreenDatabase.connect(host,
+                                                 port,
+                                                 db_name,
+                                                 user,
+                                                 password,
+                                                 pool_size,
+                                                 debug=debug) }
     return DatabaseContainer(databases)
 
 
 def init_databases(config):
-    databases = get_databases(config['database.name'],
+    if config.get('database.backend', 'postgres') == 'sqlite':
+        return init_sqlite_databases(config, INDEXER_SUFFIX)
+    return init_postgres_databases(config)
+
+
+def init_postgres_databases(config):
+    db_name = config['database.name']
+    indexer_pool_size = config.get('database.indexer_pool_size', 2)
+    databases = get_databases(db_name,
                               config['database.host'],
                               config['database.port'],
                               config['database.user'],
                               config['database.password'],
+                              pool_size=config.get('database.pool_size', 4),
                               debug=False)
     # Run migrations on all databases
     for name, db in databases.items():
         migration_pkg = 'fsal.migrations.{0}'.format(name)
         migrate(db, name, migration_pkg, config)
 
+    # The indexer gets a pool of its own, so its write batches never hold up
+    # queries issued by clients
+    databases[db_name + INDEXER_SUFFIX] = GreenDatabase.connect(
+        config['database.host'],
+        config['database.port'],
+        db_name,
+        config['database.user'],
+        config['database.password'],
+        indexer_pool_size)
     return databases
 
 
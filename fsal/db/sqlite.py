@@ -0,0 +1,318 @@
+"""
+sqlite.py: Embedded SQLite storage backend
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import re
+import json
+import logging
+import sqlite3
+import importlib
+import contextlib
+
+from gevent.lock import RLock
+from squery_pg.squery_pg import Database, DatabaseContainer
+from squery_pg.migrations import (get_mods, get_new, load_mod, pack_version,
+                                  unpack_version)
+
+
+#: Value of ``database.path`` which keeps the database in memory
+MEMORY = ':memory:'
+
+#: Seconds a writer waits for a lock held by another connection
+BUSY_TIMEOUT = 10
+
+#: Oldest SQLite library supported: 3.34 added the trigram tokenizer of the
+#: search index, and 3.35 the RETURNING clause used by the write paths
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+# files next to the database file which are kept by a WAL database
+WAL_SUFFIXES = ('-wal', '-shm')
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL;',
+    # in WAL mode this is safe against corruption, only the transactions
+    # committed right before a power loss may be rolled back
+    'PRAGMA synchronous = NORMAL;',
+    'PRAGMA temp_store = MEMORY;',
+    # negative values are in KiB
+    'PRAGMA cache_size = -8192;',
+    'PRAGMA mmap_size = 67108864;',
+    # LIKE is case sensitive in Postgres, and only then can it use indexes
+    'PRAGMA case_sensitive_like = ON;',
+)
+
+# %(name)s, %s and %% placeholders used with psycopg
+PLACEHOLDER_RE = re.compile(r'%\(([^)]+)\)s|%s|%%')
+# array parameters, bound as JSON arrays
+ANY_RE = re.compile(r'=\s*ANY\s*\(\s*%s\s*\)', re.I)
+ANY_SQL = 'IN (SELECT value FROM json_each(%s))'
+# $1, $2, ... parameters of prepared statements
+NUMBERED_RE = re.compile(r'\$(\d+)')
+
+
+def translate(sql):
+    """
+    Convert a query written for psycopg into one accepted by sqlite3. Return
+    the converted query and the names of the parameters in the order they
+    are referenced, or ``None`` if the parameters are positional.
+    """
+    names = []
+
+    def replace(match):
+        token = match.group(0)
+        if token == '%%':
+            return '%'
+        if token != '%s':
+            names.append(match.group(1))
+        return '?'
+
+    sql = PLACEHOLDER_RE.sub(replace, ANY_RE.sub(ANY_SQL, sql))
+    return sql, names or None
+
+
+def check_version():
+    """
+    Raise ``RuntimeError`` if the SQLite library is too old for the queries
+    used by the index.
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            'SQLite {} or newer is required, found {}'.format(
+                '.'.join(str(n) for n in MIN_SQLITE_VERSION),
+                sqlite3.sqlite_version))
+
+
+def bind_value(value):
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value)
+    return value
+
+
+def bind(names, params):
+    if params is None:
+        return ()
+    if names is None:
+        if isinstance(params, dict):
+            # psycopg ignores named parameters the query does not use
+            return ()
+        return tuple(bind_value(v) for v in params)
+    return tuple(bind_value(params[n]) for n in names)
+
+
+class SQLiteConnection(object):
+    """
+    Single SQLite connection which stands in for the connection pool used
+    with Postgres.
+
+    Queries run in the calling greenlet without yielding to the hub, so each
+    statement is atomic with respect to other greenlets. A transaction holds
+    the connection for the greenlet which opened it until it ends, while
+    statements issued by other greenlets wait. Results are fetched eagerly,
+    so the connection is never held by a partially consumed iterator.
+    """
+
+    def __init__(self, path):
+        check_version()
+        self.path = path
+        self.lock = RLock()
+        self._queries = dict()
+        self.open()
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path,
+                                    timeout=BUSY_TIMEOUT,
+                                    isolation_level=None,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False,
+                                    cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self._depth = 0
+
+    def _translate(self, sql):
+        try:
+            return self._queries[sql]
+        except KeyError:
+            self._queries[sql] = query = translate(sql)
+            return query
+
+    def _run(self, sql, params=None, many=False):
+        (query, names) = self._translate(sql)
+        cursor = self.conn.cursor()
+        if many:
+            cursor.executemany(query, (bind(names, p) for p in params))
+        elif params is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, bind(names, params))
+        return cursor
+
+    def execute(self, sql, params=None, **kwargs):
+        with self.lock:
+            return self._run(sql, params).rowcount
+
+    def executemany(self, sql, params, **kwargs):
+        with self.lock:
+            return self._run(sql, params, many=True).rowcount
+
+    def fetchone(self, sql, params=None, **kwargs):
+        with self.lock:
+            return self._run(sql, params).fetchone()
+
+    def fetchall(self, sql, params=None, **kwargs):
+        with self.lock:
+            return self._run(sql, params).fetchall()
+
+    def fetchiter(self, sql, params=None, **kwargs):
+        return iter(self.fetchall(sql, params))
+
+    def executescript(self, sql):
+        with self.lock:
+            self.conn.executescript('BEGIN;\n{}\nCOMMIT;'.format(sql))
+
+    def run_prepared(self, statement, params, many=False):
+        # sqlite3 keeps compiled statements in a per connection cache, so
+        # only the placeholders need converting
+        query = NUMBERED_RE.sub(r'?\1', statement.sql)
+        cursor = self.conn.cursor()
+        if many:
+            cursor.executemany(query, (tuple(p[n] for n in statement.params)
+                                       for p in params))
+        else:
+            cursor.execute(query, tuple(params[n] for n in statement.params))
+        return cursor
+
+    @contextlib.contextmanager
+    def transaction(self, mode='IMMEDIATE'):
+        with self.lock:
+            if self._depth:
+                # nested transactions are merged into the outermost one
+                self._depth += 1
+                try:
+                    yield self.conn.cursor()
+                finally:
+                    self._depth -= 1
+                return
+            self.conn.execute('BEGIN {};'.format(mode))
+            self._depth = 1
+            try:
+                yield self.conn.cursor()
+            except Exception:
+                self.conn.execute('ROLLBACK;')
+                raise
+            else:
+                self.conn.execute('COMMIT;')
+            finally:
+                self._depth = 0
+
+    def closeall(self):
+        self.conn.close()
+
+
+class SQLiteDatabase(Database):
+    """
+    Database stored in a single SQLite file, exposing the same interface as
+    the Postgres backed databases. ``migrations`` is the package of the
+    migrations which are run on the database when it is recreated.
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, path, migrations=None, debug=False):
+        super(SQLiteDatabase, self).__init__(SQLiteConnection(path),
+                                             dict(path=path), debug=debug)
+        self.migrations = migrations
+
+    @property
+    def name(self):
+        return self.connection_params['path']
+
+    def executescript(self, sql):
+        return self.pool.executescript(sql)
+
+    def transaction(self, *args, **kwargs):
+        return self.pool.transaction()
+
+    def snapshot(self):
+        # a read transaction observes a single snapshot of a WAL database
+        return self.pool.transaction(mode='DEFERRED')
+
+    def execute_prepared(self, statement, params):
+        with self.pool.lock:
+            return self.pool.run_prepared(statement, params).rowcount
+
+    def executemany_prepared(self, statement, params):
+        with self.pool.lock:
+            return self.pool.run_prepared(statement, params,
+                                          many=True).rowcount
+
+    def fetchone_prepared(self, statement, params):
+        with self.pool.lock:
+            return self.pool.run_prepared(statement, params).fetchone()
+
+    def fetchiter_prepared(self, statement, params):
+        with self.pool.lock:
+            return iter(self.pool.run_prepared(statement, params).fetchall())
+
+    def recreate(self):
+        """
+        Replace the database with an empty one, and run the migrations on
+        it. The connection is reopened in place, so references held to this
+        object remain valid.
+        """
+        with self.pool.lock:
+            self.pool.closeall()
+            if self.name != MEMORY:
+                for suffix in ('',) + WAL_SUFFIXES:
+                    try:
+                        os.remove(self.name + suffix)
+                    except OSError:
+                        # the WAL files are only kept while they are in use
+                        pass
+            self.pool.open()
+        if self.migrations:
+            migrate(self, self.migrations)
+
+
+def migrate(db, package):
+    """
+    Run all migrations from ``package`` which have not been run yet. The
+    version is kept in the ``user_version`` field of the database header.
+    """
+    version = db.fetchone('PRAGMA user_version;')[0]
+    (major_version, minor_version) = unpack_version(version)
+    package = importlib.import_module(package)
+    logging.debug('Migration version for %s is %s.%s', package.__name__,
+                  major_version, minor_version)
+    migrations = get_new(get_mods(package), major_version, minor_version + 1)
+    for (modname, major_version, minor_version) in migrations:
+        mod = load_mod(modname, package)
+        mod.up(db, {})
+        db.execute('PRAGMA user_version = {};'.format(
+            pack_version(major_version, minor_version)))
+        logging.debug('Finished migrating to %s', modname)
+
+
+def init_sqlite_databases(config, indexer_suffix):
+    db_name = config['database.name']
+    db_dir = config.get('database.path', MEMORY)
+    if db_dir == MEMORY:
+        path = MEMORY
+    else:
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        path = os.path.join(db_dir, '{}.sqlite'.format(db_name))
+    db = SQLiteDatabase(path, 'fsal.migrations.sqlite.{}'.format(db_name))
+    migrate(db, db.migrations)
+    # SQLite allows a single writer at a time and a second connection would
+    # wait for its lock without yielding to the hub, so the indexer shares
+    # the connection, whose lock greenlets wait for cooperatively
+    return DatabaseContainer({db_name: db, db_name + indexer_suffix: db})
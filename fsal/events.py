@@ -11,6 +11,7 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 import logging
 
 from .serialize import str_to_bool
+from .db.databases import PreparedStatement
 
 
 EVENT_CREATED = 'created'
@@ -115,20 +116,27 @@ class FileSystemEventQueue(object):
 
     EVENTS_TABLE = 'events'
 
+    INSERT_EVENT_STMT = PreparedStatement(
+        'insert_event',
+        'INSERT INTO {} (type, src, is_dir) VALUES ($1, $2, $3)'.format(
+            EVENTS_TABLE),
+        ['type', 'src', 'is_dir'])
+
     def __init__(self, config, context):
         self.db = context['databases'].fs
 
-    def add(self, event):
-        cols = ['type', 'src', 'is_dir']
+    def add(self, event, db=None):
+        """
+        Store ``event`` through ``db``, so it can be written in the same
+        transaction as the index change it reports. The database of client
+        commands is used by default.
+        """
         vals = get_event_dict(event)
-        q = self.db.Insert(self.EVENTS_TABLE, cols=cols)
-        self.db.execute(q, vals)
+        (db or self.db).execute_prepared(self.INSERT_EVENT_STMT, vals)
 
-    def additems(self, events):
-        cols = ['type', 'src', 'is_dir']
-        q = self.db.Insert(self.EVENTS_TABLE, cols=cols)
+    def additems(self, events, db=None):
         vals = (get_event_dict(e) for e in events)
-        self.db.executemany(q, vals)
+        (db or self.db).executemany_prepared(self.INSERT_EVENT_STMT, vals)
 
     def getitems(self, maxnum=100):
         items = []
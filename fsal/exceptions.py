@@ -8,3 +8,10 @@ class FSALError(Exception):
 class OpenError(FSALError):
     """Raised when a file cannot be opened."""
     pass
+
+
+class CommandBusyError(FSALError):
+    """Raised when a command is rejected because its pool is saturated."""
+
+    #: Error code sent to clients in place of the command result
+    error_code = 'busy'
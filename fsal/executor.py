@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+executor.py: bounded execution of command handlers
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import time
+import logging
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+from .metrics import Histogram
+from .hubmonitor import activity
+from .exceptions import CommandBusyError
+
+
+#: Quick lookups answered by a single indexed query
+CHEAP_READ = 'cheap'
+#: Reads which may scan large parts of the index or the file system
+HEAVY_READ = 'heavy'
+#: Quick changes of the state of the server, such as refreshes
+CONTROL = 'control'
+#: Commands which modify storage, and may run for a long time
+MUTATING = 'mutating'
+
+#: Default (concurrency, queue depth) of each command class
+POOL_DEFAULTS = {
+    CHEAP_READ: (16, 64),
+    HEAVY_READ: (2, 16),
+    CONTROL: (4, 32),
+    MUTATING: (1, 8),
+}
+
+
+class CommandPool(object):
+    """
+    Limits the number of concurrently executing commands of a single command
+    class. Commands over the ``concurrency`` limit wait for a free slot, and
+    once ``max_queue`` commands are already waiting, new ones are rejected
+    with :py:class:`CommandBusyError` instead of piling up.
+    """
+
+    def __init__(self, name, concurrency, max_queue, metrics):
+        self.name = name
+        self.metrics = metrics
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = BoundedSemaphore(concurrency)
+        self.waiting = 0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+
+    @property
+    def active(self):
+        return self.concurrency - self.semaphore.counter
+
+    def admit(self):
+        """
+        Queue a command for the next free slot, or raise
+        :py:class:`CommandBusyError` if the queue is full. Return the time
+        the command was queued at, which :py:meth:`execute` expects.
+        """
+        # admitted commands may not have taken their free slot yet
+        if self.waiting - self.semaphore.counter >= self.max_queue:
+            self.rejected += 1
+            raise CommandBusyError('{} pool is saturated'.format(self.name))
+        self.waiting += 1
+        return time.time()
+
+    def run(self, handler):
+        return self.execute(handler, self.admit())
+
+    def execute(self, handler, queued_at):
+        """
+        Wait for a free slot and run an admitted ``handler`` in it.
+        """
+        try:
+            self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.time()
+        self.wait_time.record(started - queued_at)
+        try:
+            with activity('command.' + handler.command_type):
+                return handler.do_command()
+        finally:
+            duration = time.time() - started
+            self.run_time.record(duration)
+            self.metrics.record('handlers.' + handler.command_type, duration)
+            self.semaphore.release()
+
+    def get_stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'wait_time': self.wait_time.to_dict(),
+            'run_time': self.run_time.to_dict(),
+        }
+
+
+class CommandExecutor(object):
+    """
+    Dispatches command handlers into separate pools based on their
+    ``command_class``, so cheap lookups are never stuck behind long running
+    scans or file operations.
+    """
+
+    def __init__(self, config, metrics):
+        self.pools = dict()
+        for name, (concurrency, max_queue) in POOL_DEFAULTS.items():
+            concurrency = config.get('executor.{}_concurrency'.format(name),
+                                     concurrency)
+            max_queue = config.get('executor.{}_queue'.format(name),
+                                   max_queue)
+            self.pools[name] = CommandPool(name, concurrency, max_queue,
+                                           metrics)
+            logging.debug('Command pool "%s": concurrency %d, queue %d',
+                          name, concurrency, max_queue)
+
+    def execute(self, handler):
+        return self.pools[handler.command_class].run(handler)
+
+    def submit(self, handler):
+        """
+        Admit a handler whose result nobody waits for, and run it in the
+        background. It is rejected right away if its pool is saturated, and
+        otherwise takes a slot of the pool like any other command.
+        """
+        pool = self.pools[handler.command_class]
+        queued_at = pool.admit()
+        return gevent.spawn(self._run_async, pool, handler, queued_at)
+
+    @staticmethod
+    def _run_async(pool, handler, queued_at):
+        try:
+            pool.execute(handler, queued_at)
+        except Exception:
+            logging.exception('Unexpected exception while handling "%s" '
+                              'command', handler.command_type)
+
+    def get_stats(self):
+        return dict((name, pool.get_stats())
+                    for name, pool in self.pools.items())
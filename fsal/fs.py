@@ -4,20 +4,50 @@ import logging
 from datetime import datetime
 
 
-class FSObject(object):
+EPOCH = datetime(1970, 1, 1)
+
+#: Fields of entries returned by listings. Entries of ``paths`` and ``sizes``
+#: listings are :py:class:`PathEntry` objects, while ``counts`` listings only
+#: return the number of directories and files.
+FIELDS_ALL = 'all'
+FIELDS_PATHS = 'paths'
+FIELDS_SIZES = 'sizes'
+FIELDS_COUNTS = 'counts'
+
+
+def to_timestamp(dt, epoch=EPOCH):
+    delta = dt - epoch
+    return delta.total_seconds()
 
-    def __init__(self, base_path, rel_path, create_date, modify_date, size):
+
+class FSObject(object):
+    """
+    File system entry. Instances are created in large numbers for listings,
+    so they have no ``__dict__``, and ``path`` and ``name`` are derived from
+    the relative path only when accessed.
+
+    Timestamps are kept in the form they were obtained in, which is a
+    ``datetime`` for entries read from the index or the file system, and a
+    float for entries parsed from a response, and converted to the other
+    form on access.
+    """
+
+    __slots__ = ('_rel_path', '_base_path', '_create', '_modify', '_size',
+                 'id')
+
+    def __init__(self, base_path, rel_path, create_date, modify_date, size,
+                 id=None):
         self._rel_path = rel_path
         self._base_path = base_path
-        self._path = os.path.join(base_path, rel_path)
-        self._name = os.path.split(rel_path)[1]
-        self._create_date = create_date
-        self._modify_date = modify_date
+        self._create = create_date
+        self._modify = modify_date
         self._size = size
+        # id of the index entry, known only to the server
+        self.id = id
 
     @property
     def path(self):
-        return self._path
+        return os.path.join(self._base_path, self._rel_path)
 
     @property
     def rel_path(self):
@@ -36,15 +66,35 @@ class FSObject(object):
 
     @property
     def name(self):
-        return self._name
+        return os.path.split(self._rel_path)[1]
 
     @property
     def create_date(self):
-        return self._create_date
+        return self._as_date(self._create)
 
     @property
     def modify_date(self):
-        return self._modify_date
+        return self._as_date(self._modify)
+
+    @property
+    def create_timestamp(self):
+        return self._as_timestamp(self._create)
+
+    @property
+    def modify_timestamp(self):
+        return self._as_timestamp(self._modify)
+
+    @staticmethod
+    def _as_date(value):
+        if isinstance(value, float):
+            return datetime.fromtimestamp(value)
+        return value
+
+    @staticmethod
+    def _as_timestamp(value):
+        if isinstance(value, float):
+            return value
+        return to_timestamp(value)
 
     @property
     def size(self):
@@ -88,12 +138,11 @@ class FSObject(object):
         base_path = file_xml.find('base-path').text
         rel_path = file_xml.find('rel-path').text
         size = file_xml.find('size').text
-        create_timestamp = file_xml.find('create-timestamp').text
-        create_date = datetime.fromtimestamp(float(create_timestamp))
-        modify_timestamp = file_xml.find('modify-timestamp').text
-        modify_date = datetime.fromtimestamp(float(modify_timestamp))
+        create_timestamp = float(file_xml.find('create-timestamp').text)
+        modify_timestamp = float(file_xml.find('modify-timestamp').text)
         return cls(base_path=base_path, rel_path=rel_path, size=size,
-                   create_date=create_date, modify_date=modify_date)
+                   create_date=create_timestamp,
+                   modify_date=modify_timestamp)
 
     @classmethod
     def from_path(cls, base_path, rel_path):
@@ -117,18 +166,52 @@ class FSObject(object):
     def from_db_row(cls, row):
         return cls(base_path=row['base_path'], rel_path=row['path'],
                    size=row['size'], create_date=row['create_time'],
-                   modify_date=row['modify_time'])
+                   modify_date=row['modify_time'], id=row['id'])
 
 
 class File(FSObject):
+    __slots__ = ()
+
     def is_file(self):
         return True
 
 
 class Directory(FSObject):
+    __slots__ = ()
+
     def is_dir(self):
         return True
 
     def other_path(self, path):
         path.lstrip(os.sep)
         return os.path.normpath(os.path.join(self.rel_path, path))
+
+
+class PathEntry(object):
+    """
+    Entry of listings which asked only for paths, or for paths and sizes, of
+    the listed entries. ``size`` is ``None`` in the former case.
+    """
+
+    __slots__ = ('rel_path', 'size', '_is_dir')
+
+    def __init__(self, rel_path, is_dir, size=None):
+        self.rel_path = rel_path
+        self.size = size
+        self._is_dir = is_dir
+
+    @property
+    def name(self):
+        return os.path.split(self.rel_path)[1]
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return not self._is_dir
+
+    @classmethod
+    def from_xml(cls, node):
+        size_node = node.find('size')
+        size = None if size_node is None else int(size_node.text)
+        return cls(node.find('rel-path').text, node.tag == 'dir', size)
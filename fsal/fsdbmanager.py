@@ -1,20 +1,36 @@
 import os
 import re
+import json
 import asyncfs
 import shutil
+import stat
 import logging
 import time
+import contextlib
 import collections
+import datetime
 import functools
-from itertools import chain, ifilter
+from itertools import chain, ifilter, islice
 
 import gevent.queue
 import scandir
 
-from .utils import to_unicode, to_bytes, common_ancestor
-from .fs import File, Directory
+from .utils import (to_unicode, to_bytes, common_ancestor, disk_space,
+                    natural_key)
+from .fs import (File, Directory, PathEntry, FIELDS_ALL, FIELDS_PATHS,
+                 FIELDS_SIZES, FIELDS_COUNTS)
 from .ondd import ONDDNotificationListener
 from .bundles import BundleExtracter, abs_bundle_path
+from .db.databases import PreparedStatement
+from .hubmonitor import activity
+from .metrics import Stopwatch
+from .planner import (RefreshPlanner, RemotePlanner, PlannedTask, REFRESH,
+                      PRUNE, UPDATE, EXTRACT)
+from .throttle import IndexThrottle
+from .usage import StorageUsage, empty_totals
+from .walker import ParallelWalker, WalkedEntry
+from .journal import TaskJournal
+from .workers import ROLE_SINGLE, ROLE_INDEXER, ROLE_QUERY, SharedTree
 from .asyncfs import copytree, rmtree, Error, _destinsrc
 from .events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, \
     DirCreatedEvent, DirModifiedEvent, DirDeletedEvent, FileSystemEventQueue
@@ -33,7 +49,26 @@ def sql_escape_path(path):
     return path
 
 
-def yielding_checked_fnwalk(path, fn, sleep_interval=0.01):
+def list_dir_statements(table, columns):
+    """
+    Return prepared statements of directory listings sorted by each of the
+    ``columns``, keyed by the column and whether the order is descending.
+    """
+    statements = dict()
+    for column in columns:
+        for descending in (False, True):
+            direction = ' DESC' if descending else ''
+            suffix = '_desc' if descending else ''
+            name = 'list_dir_{}{}'.format(column, suffix)
+            sql = ('SELECT * FROM {} WHERE parent_id = $1 '
+                   'ORDER BY type{d}, {c}{d}'.format(table, c=column,
+                                                     d=direction))
+            statements[(column, descending)] = PreparedStatement(
+                name, sql, ['parent_id'])
+    return statements
+
+
+def yielding_checked_fnwalk(path, fn, sleep_interval=0.01, pause=None):
     try:
         parent, name = os.path.split(path)
         entry = scandir.GenericDirEntry(parent, name)
@@ -54,7 +89,10 @@ def yielding_checked_fnwalk(path, fn, sleep_interval=0.01):
                         if entry.is_dir():
                             queue.put(entry.path)
                         yield entry
-                gevent.sleep(sleep_interval)
+                if pause is None:
+                    gevent.sleep(sleep_interval)
+                else:
+                    pause()
     except Exception as e:
         logging.exception(
             'Exception while directory walking: {}'.format(str(e)))
@@ -66,6 +104,77 @@ class FSDBManager(object):
 
     FS_TABLE = 'fsentries'
     STATS_TABLE = 'dbmgr_stats'
+    FINGERPRINTS_TABLE = 'fingerprints'
+
+    FSO_COLUMNS = ['parent_id', 'type', 'name', 'size', 'create_time',
+                   'modify_time', 'path', 'base_path']
+
+    # columns selected by listings for each of the projections
+    PROJECTIONS = {
+        FIELDS_PATHS: ['path', 'type'],
+        FIELDS_SIZES: ['path', 'type', 'size'],
+    }
+
+    # SQL expressions of the keys aggregations can be grouped by in each of
+    # the database dialects, where time buckets are dates of their first day
+    AGGREGATE_KEYS = {
+        'postgres': {
+            'type': 'type',
+            'base_path': 'base_path',
+            'extension': ("lower(NULLIF(substring(name from '\\.([^.]*)$'), "
+                          "''))"),
+            'day': "to_char(modify_time, 'YYYY-MM-DD')",
+            'week': "to_char(date_trunc('week', modify_time), 'YYYY-MM-DD')",
+            'month': ("to_char(date_trunc('month', modify_time), "
+                      "'YYYY-MM-DD')"),
+        },
+        'sqlite': {
+            'type': 'type',
+            'base_path': 'base_path',
+            # whatever follows the last dot, which rtrim() strips
+            'extension': ("CASE WHEN instr(name, '.') > 0 THEN "
+                          "lower(NULLIF(substr(name, length(rtrim("
+                          "name, replace(name, '.', ''))) + 1), '')) END"),
+            'day': 'date(modify_time)',
+            'week': "date(modify_time, 'weekday 0', '-6 days')",
+            'month': "date(modify_time, 'start of month')",
+        },
+    }
+
+    # statements executed for nearly every request and indexed entry
+    GET_FSO_STMT = PreparedStatement(
+        'get_fso', 'SELECT * FROM {} WHERE path = $1'.format(FS_TABLE),
+        ['path'])
+    LIST_DIR_STMT = PreparedStatement(
+        'list_dir', 'SELECT * FROM {} WHERE parent_id = $1'.format(FS_TABLE),
+        ['parent_id'])
+    # columns of sorted directory listings, each served by an index on
+    # (parent_id, type, column), for each of the orders of list_dir
+    LIST_DIR_ORDERS = {
+        'name': 'name',
+        'size': 'size',
+        'mtime': 'modify_time',
+    }
+    # order of names with numbers sorted by value, which no index serves
+    NATURAL_ORDER = 'natural'
+    LIST_DIR_SORTED_STMTS = list_dir_statements(FS_TABLE,
+                                                LIST_DIR_ORDERS.values())
+    INSERT_FSO_STMT = PreparedStatement(
+        'insert_fso',
+        'INSERT INTO {} ({}) VALUES ($1, $2, $3, $4, $5, $6, $7, $8) '
+        'RETURNING id'.format(FS_TABLE, ', '.join(FSO_COLUMNS)),
+        FSO_COLUMNS)
+    UPDATE_FSO_STMT = PreparedStatement(
+        'update_fso',
+        'UPDATE {} SET parent_id = $1, type = $2, name = $3, size = $4, '
+        'create_time = $5, modify_time = $6, path = $7, base_path = $8 '
+        'WHERE id = $9'.format(FS_TABLE),
+        FSO_COLUMNS + ['id'])
+    # removal of the entries at a list of paths, which returns what the
+    # usage totals, the tree and the events need to know about them
+    REMOVE_PATHS_SQL = ('DELETE FROM {} WHERE path = ANY(%s) '
+                        'RETURNING path, type, size, base_path;'.format(
+                            FS_TABLE))
 
     ROOT_DIR_PATH = '.'
 
@@ -73,6 +182,12 @@ class FSDBManager(object):
 
     SLEEP_INTERVAL = 0.500
 
+    # number of entries the indexer writes in a single transaction
+    INDEX_BATCH_SIZE = 200
+
+    # number of subtrees whose base path is updated by a single statement
+    PREFIX_BATCH_SIZE = 100
+
     def __init__(self, config, context):
         chroot = config.get('fsal.chroot') or ''
         if chroot:
@@ -86,6 +201,17 @@ class FSDBManager(object):
 
         logging.debug(u'Using basepaths: %s', ', '.join(self.base_paths))
         self.db = context['databases'].fs
+        # indexer writes go through a pool of their own, so they never hold
+        # up queries issued by clients
+        self.indexer_db = context['databases'].fs_indexer
+        self.cache = context.get('cache')
+        self.tree = context.get('tree')
+        self.metrics = context['metrics']
+        self.profiler = context['profiler']
+        self.throttle = context.get('throttle') or IndexThrottle(config)
+        self.usage = context.get('usage') or StorageUsage()
+        self.walker = ParallelWalker(config)
+        context['walker'] = self.walker
         self.bundles_dir = config['bundles.bundles_dir']
         self.bundle_ext = BundleExtracter(config)
 
@@ -101,6 +227,28 @@ class FSDBManager(object):
             config, self._handle_notifications)
         self.event_queue = FileSystemEventQueue(config, context)
         self.scheduler = TaskScheduler(0.2)
+        self.role = context.get('role', ROLE_SINGLE)
+        journal = TaskJournal(self.db)
+        if self.role == ROLE_QUERY:
+            # maintenance tasks are picked up from the journal by the indexer
+            # process
+            self.planner = RemotePlanner(journal)
+        else:
+            # overlapping maintenance tasks are merged before they are
+            # scheduled
+            self.planner = RefreshPlanner(self.scheduler, self._run_task,
+                                          on_idle=self._on_idle,
+                                          journal=journal)
+        self.poll_interval = config.get('workers.poll_interval', 1)
+        self._poller = None
+        self.fast_startup = config.get('fsal.fast_startup', True)
+        self.indexed = False
+        # whether the tree is to be loaded again once the index is idle
+        self._tree_reload = False
+        context['planner'] = self.planner
+        self._deferred_invalidations = dict()
+        # greenlets reading within a snapshot of the index
+        self._snapshots = set()
 
     @property
     def blacklist(self):
@@ -119,55 +267,215 @@ class FSDBManager(object):
         self.whitelist = [os.path.normpath(path) for path in paths]
 
     def start(self):
+        self._load_tree()
+        self._load_usage()
+        if self.role == ROLE_QUERY:
+            return
         self.notification_listener.start()
-        self._refresh_db_async()
+        # tasks which did not complete before the process stopped, whether it
+        # was shut down cleanly or not
+        self._replay_journal()
+        fingerprints = self._load_fingerprints()
+        if self.fast_startup and fingerprints:
+            self.metrics.gauge('startup.fast', True)
+            self._refresh_changed(fingerprints)
+        else:
+            logging.info('No fingerprints recorded, refreshing the index')
+            self.metrics.gauge('startup.fast', False)
+            self._refresh_db_async()
+        if self.planner.idle:
+            self._on_indexed()
+        if self.role == ROLE_INDEXER:
+            self._poller = gevent.spawn(self._poll_journal)
 
     def stop(self):
+        if self.role == ROLE_QUERY:
+            return
         self.notification_listener.stop()
+        if self._poller is not None:
+            self._poller.kill()
+            self._poller = None
+        # pending tasks remain in the journal
+        self._save_fingerprints()
+
+    @contextlib.contextmanager
+    def read_snapshot(self):
+        """
+        Execute the queries issued within the block in a single transaction,
+        so they all observe the same state of the index. The tree is not
+        bound to the transaction, so reads within the block bypass it.
+        """
+        current = gevent.getcurrent()
+        self._snapshots.add(current)
+        try:
+            with self.db.snapshot():
+                yield
+        finally:
+            self._snapshots.discard(current)
 
     def get_root_dir(self):
         try:
             # Root dir is a empty directory used only for maintaining the id 0
             d = Directory.from_path(self.base_paths[0], self.ROOT_DIR_PATH)
-            d.__id = 0
+            d.id = 0
             return d
         except OSError:
             return None
 
-    def list_dir(self, path):
+    def list_dir(self, path, order=None):
+        """
+        Return a tuple of (success, iterator) of the children of the
+        directory at ``path``. Children are sorted by type, and then by
+        ``order`` if specified, which is one of the keys of
+        :py:attr:`LIST_DIR_ORDERS` or :py:attr:`NATURAL_ORDER`, prefixed
+        with ``-`` for descending order.
+        """
+        if order is not None:
+            key = order.lstrip('-')
+            if key not in self.LIST_DIR_ORDERS and key != self.NATURAL_ORDER:
+                logging.error(u"Invalid listing order: '%s'", order)
+                return (False, [])
         d = self._get_dir(path)
         if d is None:
             return (False, [])
+        elif self._tree_ready:
+            row_iter = self.tree.list_dir(d.rel_path)
+            if order is not None:
+                row_iter = self._sort_rows(row_iter, order)
+            return (True, self._fso_row_iterator(row_iter))
+        elif order is None:
+            row_iter = self.db.fetchiter_prepared(self.LIST_DIR_STMT,
+                                                  {'parent_id': d.id})
+            return (True, self._fso_row_iterator(row_iter))
+        elif order.lstrip('-') == self.NATURAL_ORDER:
+            row_iter = self.db.fetchiter_prepared(self.LIST_DIR_STMT,
+                                                  {'parent_id': d.id})
+            row_iter = self._sort_rows(row_iter, order)
+            return (True, self._fso_row_iterator(row_iter))
         else:
-            q = self.db.Select('*', sets=self.FS_TABLE, where='parent_id = %s')
-            row_iter = self.db.fetchiter(q, (d.__id,))
+            # rows stream out of the index in the requested order
+            column = self.LIST_DIR_ORDERS[order.lstrip('-')]
+            stmt = self.LIST_DIR_SORTED_STMTS[(column, order.startswith('-'))]
+            row_iter = self.db.fetchiter_prepared(stmt, {'parent_id': d.id})
             return (True, self._fso_row_iterator(row_iter))
 
+    def _sort_rows(self, rows, order):
+        """
+        Sort ``rows`` of a directory listing the way the index would.
+        """
+        key = order.lstrip('-')
+        if key == self.NATURAL_ORDER:
+            def sort_key(row):
+                return (row['type'], natural_key(row['name']))
+        else:
+            column = self.LIST_DIR_ORDERS[key]
+
+            def sort_key(row):
+                return (row['type'], row[column])
+        return sorted(rows, key=sort_key, reverse=order.startswith('-'))
+
     def list_descendants(self, path, count=False, offset=None, limit=None,
-                         entry_type=None, span=None, order=None, ignored_paths=None):
+                         entry_type=None, span=None, order=None, ignored_paths=None,
+                         fields=FIELDS_ALL):
+        """
+        Return a tuple of (success, count, iterator). With ``fields`` set to
+        ``counts``, count is a dict of the number of ``dirs`` and ``files``
+        instead, and the iterator is empty.
+        """
         d = self._get_dir(path)
         if d is None:
             return (False, None, [])
 
-        filter_args = dict()
-        q = self.db.Select('COUNT(*) as count' if count else '*',
+        if fields == FIELDS_COUNTS:
+            q = self.db.Select(['type', 'COUNT(*) as count'],
+                               sets=self.FS_TABLE,
+                               group='type')
+        else:
+            q = self.db.Select('COUNT(*) as count' if count
+                               else self._projection(fields),
+                               sets=self.FS_TABLE,
+                               limit=limit,
+                               offset=offset,
+                               order=order)
+        filter_args = self._filter_descendants(q, path, ignored_paths)
+        if span:
+            q.where += 'modify_time > %(since)s'
+            since = datetime.datetime.now() - datetime.timedelta(
+                days=float(span))
+            filter_args.update(since=since)
+        if entry_type:
+            q.where += "type = %(entry_type)s"
+            filter_args.update(entry_type=entry_type)
+
+        if fields == FIELDS_COUNTS:
+            counts = dict(dirs=0, files=0)
+            for row in self.db.fetchall(q, filter_args):
+                key = 'dirs' if row['type'] == self.DIR_TYPE else 'files'
+                counts[key] = row['count']
+            return (True, counts, [])
+        if count:
+            count = self.db.fetchone(q, filter_args)['count']
+            return (True, count, [])
+        row_iter = self.db.fetchiter(q, filter_args)
+        return (True, None, self._row_iterator(row_iter, fields))
+
+    def aggregate(self, path, group_by, ignored_paths=None):
+        """
+        Return a tuple of (success, groups), where groups is a list of dicts
+        of the number of entries under ``path`` and the total size of files
+        among them, grouped by each of the ``group_by`` keys in
+        :py:attr:`AGGREGATE_KEYS`. Each dict also holds the value of every
+        key it is grouped by, and groups are ordered by size.
+        """
+        d = self._get_dir(path)
+        if d is None:
+            return (False, [])
+        exprs = self.AGGREGATE_KEYS[self.db.dialect]
+        unknown = [key for key in group_by if key not in exprs]
+        if unknown or not group_by:
+            logging.error(u"Invalid aggregation keys: '%s'",
+                          u', '.join(unknown or group_by))
+            return (False, [])
+
+        what = ['{} AS {}'.format(exprs[key], key) for key in group_by]
+        what.append('COUNT(*) AS count')
+        what.append('SUM(CASE WHEN type = {} THEN size ELSE 0 END) '
+                    'AS size'.format(self.FILE_TYPE))
+        positions = range(1, len(group_by) + 1)
+        q = self.db.Select(what,
                            sets=self.FS_TABLE,
-                           limit=limit,
-                           offset=offset,
-                           order=order)
+                           group=', '.join(str(p) for p in positions),
+                           order='-size')
+        filter_args = self._filter_descendants(q, path, ignored_paths)
+        groups = []
+        for row in self.db.fetchall(q, filter_args):
+            # keys may be unicode, which rows can not be indexed with
+            group = dict((key, row[i]) for (i, key) in enumerate(group_by))
+            if 'type' in group:
+                group['type'] = ('dir' if group['type'] == self.DIR_TYPE
+                                 else 'file')
+            group.update(count=row['count'], size=row['size'] or 0)
+            groups.append(group)
+        return (True, groups)
+
+    def _filter_descendants(self, q, path, ignored_paths=None):
+        """
+        Restrict query ``q`` to the whitelisted descendants of ``path``,
+        except those under ``ignored_paths``, and return the arguments of
+        the added conditions.
+        """
+        filter_args = dict()
         if self.whitelist:
             # generate unique keys for each whitelisted item
             keys = ['whitelist-{}'.format(i)
                     for i in range(len(self.whitelist))]
-            # prepare comma separated placeholders from ``keys``
-            in_array = ', '.join('%({})s'.format(k) for k in keys)
-            q.where += ('(path SIMILAR TO %(wl_patterns)s OR'
-                        ' path IN ({}))'.format(in_array))
-            # create like pattern for the similar to operator
-            wl_patterns = '({})%'.format('|'.join(base + '/'
-                                                  for base in self.whitelist))
-            filter_args.update(wl_patterns=wl_patterns,
-                               **dict(zip(keys, self.whitelist)))
+            # match the whitelisted paths and everything below them
+            q.where += '({})'.format(' OR '.join(
+                'path = %({0})s OR path LIKE %({0}-children)s'.format(k)
+                for k in keys))
+            for key, base in zip(keys, self.whitelist):
+                filter_args[key] = base
+                filter_args[key + '-children'] = base + '/%'
         if path != '.':
             q.where += 'path LIKE %(path)s'
             filter_args.update(path=os.path.join(path, '%'))
@@ -176,20 +484,9 @@ class FSDBManager(object):
                 key = 'ignore-{}'.format(i)
                 q.where += 'path NOT LIKE %({})s'.format(key)
                 filter_args[key] = ignored_path + '%'
-        if span:
-            q.where += "modify_time > NOW() - %(span)s * INTERVAL '1 days'"
-            filter_args.update(span=span)
-        if entry_type:
-            q.where += "type = %(entry_type)s"
-            filter_args.update(entry_type=entry_type)
+        return filter_args
 
-        if count:
-            count = self.db.fetchone(q, filter_args)['count']
-            return (True, count, [])
-        row_iter = self.db.fetchiter(q, filter_args)
-        return (True, None, self._fso_row_iterator(row_iter))
-
-    def filter(self, paths, batch_size=999):
+    def filter(self, paths, batch_size=999, fields=FIELDS_ALL):
         """
         Return a tuple of (success, iterator), where iterator yields rows
         which ``path`` is in the passed in ``paths`` list.
@@ -200,20 +497,24 @@ class FSDBManager(object):
                    for i in range(0, len(paths), batch_size))
         # collect iterators together instead of fetching the data right here
         for batch in batches:
-            q = self.db.Select(sets=self.FS_TABLE,
+            q = self.db.Select(self._projection(fields), sets=self.FS_TABLE,
                                where=self.db.sqlin('path', batch))
             iterators.append(self.db.fetchiter(q, batch))
-        return (True, self._fso_row_iterator(chain(*iterators)))
+        return (True, self._row_iterator(chain(*iterators), fields))
 
-    def search(self, query, whole_words=False, exclude=None):
+    def search(self, query, whole_words=False, exclude=None,
+               fields=FIELDS_ALL):
         is_match, files = self.list_dir(query)
         if is_match:
             result_gen = files
+        elif self.db.dialect == 'sqlite' and not whole_words:
+            row_iter = self._search_index(query.split(), fields)
+            result_gen = self._row_iterator(row_iter, fields)
         else:
             like_pattern = '%s' if whole_words else '%%%s%%'
             words = map(sql_escape_path, query.split())
             like_words = [(like_pattern % w) for w in words]
-            q = self.db.Select('*', sets=self.FS_TABLE)
+            q = self.db.Select(self._projection(fields), sets=self.FS_TABLE)
             for _ in like_words:
                 if whole_words:
                     where_clause = 'name LIKE %s'
@@ -222,7 +523,7 @@ class FSDBManager(object):
                 where_clause += ' ESCAPE \'{}\''.format(SQL_ESCAPE_CHAR)
                 q.where |= where_clause
             row_iter = self.db.fetchiter(q, like_words)
-            result_gen = self._fso_row_iterator(row_iter)
+            result_gen = self._row_iterator(row_iter, fields)
 
         if exclude and len(exclude) > 0:
             clean_exclude = [f.replace('.', '\.') for f in exclude]
@@ -232,6 +533,27 @@ class FSDBManager(object):
                                  result_gen)
         return (is_match, result_gen)
 
+    def _search_index(self, words, fields=FIELDS_ALL):
+        """
+        Match ``words`` anywhere within entry names using the full text index
+        of the SQLite backend. Its trigram tokenizer needs at least three
+        characters, so shorter words are matched with LIKE.
+        """
+        q = self.db.Select(self._projection(fields), sets=self.FS_TABLE)
+        params = []
+        terms = [w for w in words if len(w) >= 3]
+        if terms:
+            q.where |= ('id IN (SELECT rowid FROM fsentries_search '
+                        'WHERE fsentries_search MATCH %s)')
+            params.append(' OR '.join('"{}"'.format(w.replace('"', '""'))
+                                      for w in terms))
+        for word in words:
+            if len(word) < 3:
+                q.where |= 'lower(name) LIKE lower(%s) ESCAPE \'{}\''.format(
+                    SQL_ESCAPE_CHAR)
+                params.append('%{}%'.format(sql_escape_path(word)))
+        return self.db.fetchiter(q, params)
+
     def exists(self, path, unindexed=False):
         if unindexed:
             valid, path = self._validate_path(path)
@@ -256,15 +578,18 @@ class FSDBManager(object):
         fso = self._get_file(path)
         return (fso is not None)
 
-    def get_fso(self, path):
+    def get_fso(self, path, db=None):
         valid, path = self._validate_path(path)
         if not valid:
             return None
         if path == self.ROOT_DIR_PATH:
             return self.get_root_dir()
+        elif db is None and self._tree_ready:
+            result = self.tree.get(path)
+            return self._construct_fso(result) if result else None
         else:
-            q = self.db.Select('*', sets=self.FS_TABLE, where='path = %s')
-            result = self.db.fetchone(q, (path,))
+            db = db or self.db
+            result = db.fetchone_prepared(self.GET_FSO_STMT, {'path': path})
             return self._construct_fso(result) if result else None
 
     def remove(self, path):
@@ -294,10 +619,19 @@ class FSDBManager(object):
     def consolidate(self, sources, dest):
         errors = []
         copied = []
+        size = 0
         for src in sources:
-            valid, msg = self._validate_transfer(src, dest)
+            # base paths are checked against the index instead of a walk
+            indexed = os.path.abspath(src) in self.base_paths
+            valid, msg, src_size = self._validate_transfer(src, dest,
+                                                           indexed=indexed)
             if not valid:
-                return False, msg
+                return False, False, msg
+            size += src_size
+        fits, msg = self._check_space(dest, size)
+        if not fits:
+            return False, False, msg
+        for src in sources:
             try:
                 src, dest = map(os.path.abspath, (src, dest))
                 logging.info(
@@ -328,8 +662,14 @@ class FSDBManager(object):
                 if path not in relpath:
                     rel_copied.append(relpath)
         # Update base paths of the successfully consolidated content so
-        # that they are immediately accessible
-        self._update_base_paths(sources, dest, for_paths=rel_copied)
+        # that they are immediately accessible. If everything was copied, all
+        # entries of the sources moved, otherwise only the copied subtrees
+        if errors:
+            roots = self._subtree_roots(p for p in rel_copied
+                                        if p != self.ROOT_DIR_PATH)
+        else:
+            roots = None
+        moved = self._update_base_paths(sources, dest, roots=roots)
         if not errors:
             success = True
             msg = 'All files from ({}) copied to {} successfully'.format(
@@ -338,22 +678,36 @@ class FSDBManager(object):
             success = False
             msg = 'Errors: {}'.format('\n'.join(errors))
 
-        for path in rel_copied:
+        if errors:
+            # the sources may have lost content which was not copied, and
+            # the destination may hold partial copies
             for src in sources:
-                self._prune_db_async(base_path=src, src_path=path)
-            self._update_db_async(base_paths=(dest,), src_path=path)
+                self._prune_db_async(base_path=src)
+            self._update_db_async(base_paths=(dest,))
+        else:
+            # only content which was not indexed before the move needs to be
+            # indexed at its new location
+            unindexed = set(rel_copied) - moved
+            unindexed.discard(self.ROOT_DIR_PATH)
+            for path in self._subtree_roots(unindexed):
+                self._update_db_async(base_paths=(dest,), src_path=path)
         logging.info(msg)
         is_partial = len(errors) > 0 and len(copied) > 0
         return success, is_partial, msg
 
     def transfer(self, src, dest):
-        success, msg = self._validate_transfer(src, dest)
+        success, msg, size = self._validate_transfer(src, dest)
         if not success:
             return (success, msg)
 
         abs_src = os.path.abspath(src)
         # Assume that the last mentioned path is expected destination
         base_path = self.base_paths[-1]
+        # moves within a file system are renames, which take no extra space
+        if os.stat(abs_src).st_dev != os.stat(base_path).st_dev:
+            fits, msg = self._check_space(base_path, size)
+            if not fits:
+                return (False, msg)
         abs_dest = os.path.abspath(os.path.join(base_path, dest))
         logging.debug('Transferring content from "%s" to "%s"' % (abs_src,
                                                                   abs_dest))
@@ -374,6 +728,36 @@ class FSDBManager(object):
         self._update_db_async(path)
         return (success, msg)
 
+    def storage_info(self):
+        """
+        Return a list of dicts of the number of indexed ``files`` and
+        ``dirs`` and the total size of the files in ``bytes`` under each base
+        path, along with its ``path``, and the ``capacity`` and ``free``
+        bytes of its file system if it is accessible.
+        """
+        info = []
+        for base_path in self.base_paths:
+            entry = self.usage.get(base_path)
+            entry['path'] = base_path
+            space = disk_space(base_path)
+            if space is not None:
+                (entry['capacity'], entry['free']) = space
+            info.append(entry)
+        return info
+
+    def save_stats(self, stats, keep=None):
+        """
+        Persist a serialized snapshot of statistics, retaining only the
+        ``keep`` most recent snapshots if specified.
+        """
+        q = self.db.Insert(self.STATS_TABLE, cols=['stats'])
+        self.db.execute(q, {'stats': stats})
+        if keep:
+            q = self.db.Delete(self.STATS_TABLE)
+            q.where = ('id NOT IN (SELECT id FROM {} ORDER BY id DESC '
+                       'LIMIT %s)'.format(self.STATS_TABLE))
+            self.db.execute(q, (keep,))
+
     def get_changes(self, limit=100):
         return self.event_queue.getitems(limit)
 
@@ -398,6 +782,74 @@ class FSDBManager(object):
         self._update_db_async(src_path, base_paths)
         return (True, None)
 
+    def refresh_file(self, path):
+        """
+        Update the index entry of the single file at ``path`` from the
+        storage, adding it if it is new and removing it if it is gone, so at
+        most one event is emitted and nothing is walked or scanned. Paths
+        which turn out to be directories, or whose parent directory is not
+        indexed, are refreshed with :py:meth:`refresh_path` instead.
+
+        The lookup, the write and the event are a single transaction on the
+        connections used for client commands, so the write never runs within
+        a write batch of the indexer, and is either applied with its event
+        or not at all.
+        """
+        valid, path = self._validate_path(path)
+        if not valid or path == self.ROOT_DIR_PATH:
+            return (False, ('No such file "%s"' % path))
+        try:
+            with self._index_batch(self.db):
+                refreshed = self._refresh_file(path)
+        except Exception:
+            # e.g. the indexer added the entry in the meantime, while the
+            # rolled back transaction left nothing behind
+            logging.exception('Error while refreshing file "%s"', path)
+            refreshed = False
+        if refreshed:
+            return (True, None)
+        return self.refresh_path(self._deepest_indexed_parent(path))
+
+    def _refresh_file(self, path):
+        """
+        Update the index entry of the file at ``path``, and return whether
+        it could be done without refreshing a whole subtree.
+        """
+        old_fso = self.get_fso(path, db=self.db)
+        if old_fso is not None and old_fso.is_dir():
+            return False
+        if old_fso is not None:
+            base_paths = [old_fso.base_path]
+        else:
+            base_paths = self.base_paths
+        st = None
+        for base_path in base_paths:
+            try:
+                st = os.lstat(os.path.join(base_path, path))
+            except OSError:
+                continue
+            break
+        if (st is None or stat.S_ISLNK(st.st_mode) or
+                self._is_blacklisted(path)):
+            # the file is gone, or is not supposed to be indexed
+            if old_fso is not None:
+                self._remove_paths([(old_fso.base_path, path)], db=self.db)
+            return True
+        if stat.S_ISDIR(st.st_mode):
+            return False
+        parent = os.path.dirname(path) or self.ROOT_DIR_PATH
+        parent_dir = self._get_dir(parent, db=self.db)
+        if parent_dir is None:
+            return False
+        fso = File.from_stat(base_path, path, st)
+        if not old_fso:
+            self.event_queue.add(FileCreatedEvent(path), db=self.db)
+        elif old_fso.changed(fso):
+            self.event_queue.add(FileModifiedEvent(path), db=self.db)
+        if not old_fso or old_fso != fso:
+            self._update_fso_entry(fso, parent_dir.id, old_fso, db=self.db)
+        return True
+
     def _handle_notifications(self, notifications):
         for notification in notifications:
             try:
@@ -491,45 +943,165 @@ class FSDBManager(object):
                 any(path.startswith(base + '/') or path == base
                     for base in self.whitelist))
 
+    def _invalidate(self, path):
+        """
+        Notify the response cache that the index changed within ``path``.
+        """
+        deferred = self._deferred_invalidations.get(gevent.getcurrent())
+        if deferred is not None:
+            deferred.append(path)
+        elif self.cache is not None:
+            self.cache.invalidate(path)
+
+    @contextlib.contextmanager
+    def _index_batch(self, db=None):
+        """
+        Write the entries indexed within the block in a single transaction of
+        ``db``, the indexer database by default, and notify the response
+        cache about them once it is committed.
+        """
+        db = db or self.indexer_db
+        current = gevent.getcurrent()
+        self._deferred_invalidations[current] = paths = []
+        try:
+            with db.transaction():
+                yield
+        except Exception:
+            if self.tree is not None:
+                # the tree already mirrors the writes which were rolled back
+                self.tree.disable()
+                self._reload_tree_when_idle()
+            raise
+        finally:
+            del self._deferred_invalidations[current]
+            for path in paths:
+                self._invalidate(path)
+
+    @property
+    def _tree_ready(self):
+        return (self.tree is not None and self.tree.ready and
+                gevent.getcurrent() not in self._snapshots)
+
+    def _load_tree(self):
+        if self.tree is None or not self.tree.enabled:
+            return
+        q = self.db.Select('*', sets=self.FS_TABLE)
+        self.tree.load(self.db.fetchiter(q))
+
+    def reload_tree(self, peers=False):
+        """
+        Load the tree from the index again after it got out of sync with it,
+        and have peer processes do the same if ``peers`` is set.
+        """
+        self._tree_reload = False
+        logging.info('Reloading the index tree')
+        self._load_tree()
+        if peers and isinstance(self.tree, SharedTree):
+            self.tree.reload()
+
+    def _reload_tree_when_idle(self):
+        """
+        Reload the tree once no index writes are pending, as they would have
+        to be applied to the reloaded tree as well.
+        """
+        self._tree_reload = True
+        if self.planner.idle:
+            self.scheduler.schedule(self._reload_pending_tree)
+
+    def _reload_pending_tree(self):
+        # otherwise the planner reloads it once it becomes idle
+        if self._tree_reload and self.planner.idle:
+            self.reload_tree(peers=True)
+
+    def _load_usage(self, base_paths=None):
+        """
+        Compute storage usage totals of ``base_paths``, or of all base paths
+        if not specified, from the index.
+        """
+        q = self.db.Select(['base_path', 'type', 'COUNT(*) AS count',
+                            'SUM(size) AS size'],
+                           sets=self.FS_TABLE,
+                           group='base_path, type')
+        if base_paths is not None:
+            q.where = self.db.sqlin('base_path', base_paths)
+        totals = dict()
+        for row in self.db.fetchall(q, base_paths):
+            values = totals.setdefault(row['base_path'], empty_totals())
+            if row['type'] == self.DIR_TYPE:
+                values['dirs'] = row['count']
+            else:
+                values['files'] = row['count']
+                values['bytes'] = row['size'] or 0
+        self.usage.replace(totals, base_paths)
+
+    def _account_updated(self, fso, old_fso=None):
+        """
+        Update storage usage totals after ``old_fso`` was replaced by
+        ``fso`` in the index, or ``fso`` was added to it.
+        """
+        is_dir = fso.is_dir()
+        if (old_fso and old_fso.base_path == fso.base_path and
+                old_fso.is_dir() == is_dir):
+            if not is_dir and old_fso.size != fso.size:
+                self.usage.add(fso.base_path, is_dir,
+                               fso.size - old_fso.size, 0)
+            return
+        if old_fso:
+            self.usage.add(old_fso.base_path, old_fso.is_dir(),
+                           -old_fso.size, -1)
+        self.usage.add(fso.base_path, is_dir, fso.size)
+
+    def _account_removed(self, rows):
+        """
+        Update storage usage totals after the entries of ``rows`` were
+        removed from the index.
+        """
+        removed = dict()
+        for row in rows:
+            key = (row['base_path'], row['type'] == self.DIR_TYPE)
+            (count, size) = removed.get(key, (0, 0))
+            removed[key] = (count + 1, size + row['size'])
+        for ((base_path, is_dir), (count, size)) in removed.items():
+            self.usage.add(base_path, is_dir, -size, -count)
+
     def _construct_fso(self, row):
         type = row['type']
         cls = Directory if type == self.DIR_TYPE else File
-        fso = cls.from_db_row(row)
-        fso.__id = row['id']
-        return fso
+        return cls.from_db_row(row)
 
     def _remove_from_fs(self, fso):
-        events = []
-        if os.path.isdir(fso.path):
-            checker = functools.partial(self._fnwalk_checker, fso.base_path)
-            for entry in yielding_checked_fnwalk(fso.path, checker):
-                path = entry.path
-                rel_path = os.path.relpath(path, fso.base_path)
-                if entry.is_dir():
-                    event = DirDeletedEvent(rel_path)
-                else:
-                    event = FileDeletedEvent(rel_path)
-                events.append(event)
-        else:
-            events.append(FileDeletedEvent(os.path.relpath(fso.path,
-                                                           fso.base_path)))
         remover = shutil.rmtree if fso.is_dir() else os.remove
         remover(fso.path)
+
+    def _deleted_events(self, rows):
+        events = []
+        for row in rows:
+            if row['type'] == self.DIR_TYPE:
+                events.append(DirDeletedEvent(row['path']))
+            else:
+                events.append(FileDeletedEvent(row['path']))
         return events
 
     def _remove_fso(self, fso):
         try:
-            events = self._remove_from_fs(fso)
-            path = sql_escape_path(fso.rel_path)
-            q = self.db.Delete(self.FS_TABLE)
-            q.where = 'path LIKE %s ESCAPE \'{}\''.format(SQL_ESCAPE_CHAR)
+            self._remove_from_fs(fso)
+            q = self.db.Delete(self.FS_TABLE, where='path = %s')
+            params = [fso.rel_path]
             if fso.is_dir():
-                pattern = '%s' + os.sep + '%%'
-                count = self.db.executemany(q, (((pattern % path),), (path,)))
-            else:
-                count = self.db.execute(q, (path,))
-            self.event_queue.additems(events)
-            logging.debug('Removing %d files/dirs' % (count))
+                q.where |= 'path LIKE %s ESCAPE \'{}\''.format(
+                    SQL_ESCAPE_CHAR)
+                params.append(sql_escape_path(fso.rel_path) + os.sep + '%')
+            sql = '{} RETURNING path, type, size, base_path;'.format(
+                q.serialize()[:-1])
+            with self.db.transaction():
+                rows = self.db.fetchall(sql, params)
+                self.event_queue.additems(self._deleted_events(rows),
+                                          db=self.db)
+            self._account_removed(rows)
+            if self.tree is not None:
+                self.tree.remove(fso.rel_path)
+            self._invalidate(fso.rel_path)
+            logging.debug('Removing %d files/dirs' % len(rows))
         except Exception as e:
             msg = 'Exception while removing "%s": %s' % (fso.rel_path, str(e))
             logging.error(msg)
@@ -539,21 +1111,30 @@ class FSDBManager(object):
         else:
             return (True, None)
 
-    def _get_dir(self, path):
-        fso = self.get_fso(path)
+    def _get_dir(self, path, db=None):
+        fso = self.get_fso(path, db=db)
         return fso if fso and fso.is_dir() else None
 
     def _get_file(self, path):
         fso = self.get_fso(path)
         return fso if fso and fso.is_file() else None
 
-    def _validate_transfer(self, src, dest):
+    def _validate_transfer(self, src, dest, indexed=False):
+        """
+        Return a tuple of (valid, message, size) telling whether ``src`` can
+        be moved to ``dest``, and the total size of the files in it. Unless
+        ``src`` is an ``indexed`` base path, it is walked to find paths
+        which would exceed the length limit at the destination. Otherwise
+        the indexed paths are checked, and the size is taken from the usage
+        totals.
+        """
         src_valid, abs_src = self._validate_external_path(src)
         dest_valid, dest = self._validate_path(dest)
         if not src_valid or not os.path.exists(abs_src) or self.exists(src):
-            return (False, u'Invalid transfer source directory %s' % src)
+            return (False, u'Invalid transfer source directory %s' % src, 0)
         if not dest_valid:
-            return (False, u'Invalid transfer destination directory %s' % dest)
+            return (False,
+                    u'Invalid transfer destination directory %s' % dest, 0)
 
         base_path = self.base_paths[-1]
         abs_dest = os.path.abspath(os.path.join(base_path, dest))
@@ -562,20 +1143,76 @@ class FSDBManager(object):
             real_dst = os.path.join(abs_dest, asyncfs.basename(abs_src))
             if os.path.exists(real_dst):
                 return (False,
-                        'Destination path "%s" already exists' % real_dst)
+                        'Destination path "%s" already exists' % real_dst, 0)
+
+        if indexed:
+            dest_path = self._indexed_path_too_long(abs_src, real_dst)
+            if dest_path is not None:
+                msg = '%s exceeds path length limit' % dest_path
+                return (False, msg, 0)
+            return (True, None, self.usage.get(abs_src)['bytes'])
 
+        size = 0
         for entry in yielding_checked_fnwalk(abs_src, lambda p: True):
             path = entry.path
             path = os.path.relpath(path, abs_src)
             dest_path = os.path.abspath(os.path.join(real_dst, path))
             if len(to_bytes(dest_path)) > self.PATH_LEN_LIMIT:
                 msg = '%s exceeds path length limit' % dest_path
-                return (False, msg)
+                return (False, msg, 0)
+            if not entry.is_dir():
+                size += entry.stat().st_size
 
-        return (True, None)
+        return (True, None, size)
+
+    def _indexed_path_too_long(self, base_path, dest):
+        """
+        Return the first path which an entry indexed in ``base_path`` would
+        have under ``dest`` and which exceeds the path length limit, or
+        ``None``. The database measures lengths in characters, so only paths
+        which may exceed the limit once encoded are checked exactly.
+        """
+        dest = to_bytes(os.path.abspath(dest))
+        # an encoded character takes up to 4 bytes
+        min_length = (self.PATH_LEN_LIMIT - len(dest) - 1) // 4
+        q = self.db.Select('path', sets=self.FS_TABLE,
+                           where='base_path = %s AND length(path) > %s')
+        for row in self.db.fetchiter(q, (base_path, min_length)):
+            dest_path = os.path.join(dest, to_bytes(row['path']))
+            if len(dest_path) > self.PATH_LEN_LIMIT:
+                return dest_path
+        return None
+
+    def _check_space(self, path, size):
+        """
+        Return a tuple of (fits, message) telling whether ``size`` bytes fit
+        on the file system of ``path``. Space is assumed to suffice if it
+        cannot be determined.
+        """
+        space = disk_space(path)
+        if space is None or size <= space[1]:
+            return (True, None)
+        return (False, u'Not enough free space in {}: {} bytes needed, {} '
+                       u'bytes available'.format(path, size, space[1]))
+
+    def _run_task(self, task, args):
+        """
+        Execute a scheduled ``task``, recording its duration and reporting it
+        to the profiler.
+        """
+        name = task.__name__
+        started = time.time()
+        try:
+            with activity('task.' + name), self.throttle.task():
+                with self.profiler.profile('task', name):
+                    return task(*args)
+        finally:
+            duration = time.time() - started
+            self.metrics.record('tasks.' + name, duration)
+            self.profiler.report('task', name, duration, params=args)
 
     def _refresh_db_async(self):
-        self.scheduler.schedule(self._refresh_db)
+        self.planner.add(self._make_task(REFRESH))
 
     def _refresh_db(self):
         start = time.time()
@@ -585,11 +1222,145 @@ class FSDBManager(object):
         end = time.time()
         logging.debug('DB refreshed in %0.3f ms' % ((end - start) * 1000))
 
+    def _fingerprint(self, base_path):
+        """
+        Return a fingerprint of ``base_path`` which changes when a different
+        file system is mounted on it, or when any of its immediate children
+        is added, removed or modified. Return ``None`` if it does not exist.
+
+        The mount time is not exposed by the kernel, so the device and inode
+        of the root directory stand in for it.
+        """
+        base_path = to_unicode(base_path)
+        try:
+            st = os.stat(base_path)
+            entries = dict((entry.name,
+                            entry.stat(follow_symlinks=False).st_mtime)
+                           for entry in scandir.scandir(base_path))
+        except OSError:
+            return None
+        return {'device': st.st_dev, 'inode': st.st_ino, 'entries': entries}
+
+    def _save_fingerprints(self):
+        rows = []
+        for base_path in self.base_paths:
+            fingerprint = self._fingerprint(base_path)
+            if fingerprint is not None:
+                rows.append({'base_path': base_path,
+                             'fingerprint': json.dumps(fingerprint)})
+        with self.db.transaction():
+            self.db.execute(self.db.Delete(self.FINGERPRINTS_TABLE))
+            q = self.db.Insert(self.FINGERPRINTS_TABLE,
+                               cols=['base_path', 'fingerprint'])
+            self.db.executemany(q, rows)
+        logging.debug('Saved fingerprints of %d base paths', len(rows))
+
+    def _load_fingerprints(self):
+        q = self.db.Select('base_path, fingerprint',
+                           sets=self.FINGERPRINTS_TABLE)
+        return dict((row['base_path'], json.loads(row['fingerprint']))
+                    for row in self.db.fetchall(q))
+
+    def _make_task(self, kind, *args):
+        """
+        Return the maintenance task of ``kind`` called with ``args``.
+        """
+        if kind == REFRESH:
+            return PlannedTask(REFRESH, self._refresh_db)
+        if kind == EXTRACT:
+            return PlannedTask(EXTRACT, self._extract_bundles)
+        if kind == PRUNE:
+            (src_path, base_path) = args
+            if src_path == self.ROOT_DIR_PATH:
+                # paths are matched by prefix, and none starts with the root
+                src_path = None
+            base_paths = None if base_path is None else (base_path,)
+            return PlannedTask(PRUNE, self._prune_db,
+                               args=(src_path, base_path),
+                               path=src_path,
+                               base_paths=base_paths)
+        if kind == UPDATE:
+            (src_path, base_paths) = args
+            return PlannedTask(UPDATE, self._update_db,
+                               args=(src_path, base_paths),
+                               path=src_path,
+                               base_paths=base_paths)
+        raise ValueError('Unknown task kind "{}"'.format(kind))
+
+    def _replay_journal(self):
+        """
+        Accept the tasks recorded in the journal again.
+        """
+        with self.db.transaction():
+            tasks = self.planner.journal.pop()
+            for (kind, args) in tasks:
+                self.planner.add(self._make_task(kind, *args))
+        if tasks:
+            logging.info('Replaying %d unfinished tasks', len(tasks))
+        self.metrics.gauge('startup.replayed_tasks', len(tasks))
+
+    def _poll_journal(self):
+        """
+        Accept tasks which query processes recorded in the journal.
+        """
+        while True:
+            gevent.sleep(self.poll_interval)
+            try:
+                self.planner.adopt(self._make_task)
+            except Exception:
+                logging.exception('Exception while polling the task journal')
+
+    def _refresh_changed(self, fingerprints):
+        """
+        Refresh only the base paths whose fingerprints changed since the last
+        clean shutdown, and within them only the changed immediate children.
+        """
+        self._extract_bundles_async()
+        for base_path in self.base_paths:
+            saved = fingerprints.get(base_path)
+            current = self._fingerprint(base_path)
+            if (saved is None or current is None or
+                    saved['device'] != current['device'] or
+                    saved['inode'] != current['inode']):
+                logging.info('Refreshing changed base path %s', base_path)
+                self.metrics.incr('startup.refreshed_base_paths')
+                self._prune_db_async(base_path=base_path)
+                self._update_db_async(base_paths=(base_path,))
+                continue
+            (old, new) = (saved['entries'], current['entries'])
+            changed = [name for name in set(old) | set(new)
+                       if old.get(name) != new.get(name)]
+            logging.info('%d entries changed in %s', len(changed), base_path)
+            self.metrics.incr('startup.changed_entries', len(changed))
+            for name in changed:
+                if name in old:
+                    self._prune_db_async(src_path=name, base_path=base_path)
+                if name in new:
+                    self._update_db_async(src_path=name,
+                                          base_paths=(base_path,))
+
+    def _on_idle(self):
+        self._reload_pending_tree()
+        self._on_indexed()
+
+    def _on_indexed(self):
+        if self.indexed:
+            return
+        self.indexed = True
+        # totals loaded on start may have missed changes of peer processes
+        self._load_usage()
+        elapsed = time.time() - self.metrics.started
+        self.metrics.gauge('startup.time_to_indexed', round(elapsed, 3))
+        logging.info('Index is up to date %0.3f s after start', elapsed)
+        # later starts only need to look for changes made since now
+        self._save_fingerprints()
+
     def _prune_db_async(self, src_path=None, base_path=None):
-        self.scheduler.schedule(self._prune_db,
-                                args=(src_path, base_path,))
+        self.planner.add(self._make_task(PRUNE, src_path, base_path))
 
     def _prune_db(self, src_path=None, base_path=None, batch_size=1000):
+        # the scan keeps a read connection for its whole duration, while the
+        # removals are written through the indexer connection
         q = self.db.Select('base_path, path', sets=self.FS_TABLE)
         if src_path:
             q.where &= 'path LIKE %(path)s'
@@ -599,7 +1370,10 @@ class FSDBManager(object):
         removed_paths = []
         path = u'{}%'.format(src_path) if src_path else None
         q_params = dict(base_path=base_path, path=path)
-        for result in self.db.fetchiter(q, q_params):
+        for (scanned, result) in enumerate(self.db.fetchiter(q, q_params), 1):
+            if scanned % batch_size == 0:
+                # every entry is checked on the file system
+                self.throttle.pause()
             path = result['path']
             base_path = result['base_path'] or ''
             full_path = os.path.join(base_path, path)
@@ -612,49 +1386,75 @@ class FSDBManager(object):
         if len(removed_paths) >= 0:
             self._remove_paths(removed_paths)
 
-    def _update_base_paths(self, srcs, base_path, for_paths=None):
-        if for_paths:
-            sql = '''
-            BEGIN;
-            CREATE TEMPORARY TABLE moved_files (
-                path VARCHAR
-            ) ON COMMIT DROP;
-            INSERT INTO moved_files (path) VALUES {};
-            UPDATE fsentries SET base_path=%s
-                WHERE base_path IN {} AND
-                      path IN (SELECT path FROM moved_files);
-            COMMIT;
-            '''.format(','.join(['(%s)'] * len(for_paths)),
-                       self.db.sqlarray(srcs))
-            params = list(for_paths)
-            params.append(base_path)
-            params.extend(srcs)
-            self.db.execute(sql, params)
-            return
-        # simple update over the whole table
-        q = self.db.Update(self.FS_TABLE,
-                           where=self.db.sqlin('base_path', srcs),
-                           base_path='%s')
-        params = []
-        params.append(base_path)
+    def _subtree_roots(self, paths):
+        """
+        Return the smallest list of paths among ``paths`` whose subtrees
+        contain all of them.
+        """
+        roots = []
+        # sorting by components puts each path right after its ancestors
+        for path in sorted(paths, key=lambda p: p.split(os.sep)):
+            if roots and (path == roots[-1] or
+                          path.startswith(roots[-1] + os.sep)):
+                continue
+            roots.append(path)
+        return roots
+
+    def _update_base_paths(self, srcs, base_path, roots=None):
+        """
+        Move entries stored in one of the ``srcs`` base paths to
+        ``base_path``. If ``roots`` is specified, only entries within their
+        subtrees are moved. Return the set of paths of the moved entries.
+        """
+        if roots is not None and not roots:
+            return set()
+        params = [base_path]
         params.extend(srcs)
-        self.db.execute(q, params)
-
-    def _remove_paths(self, paths):
-        q = self.db.Delete(self.FS_TABLE, where='path = %s')
-        self.db.executemany(q, ((p,) for _, p in paths))
-        events = []
-        for b, p in paths:
-            abs_p = os.path.abspath(os.path.join(b, p))
-            if os.path.isdir(abs_p):
-                event = DirDeletedEvent(p)
-            else:
-                event = FileDeletedEvent(p)
-            events.append(event)
-        self.event_queue.additems(events)
+        # simple update over the whole table, or one per batch of subtrees
+        batches = [[]] if roots is None else [
+            roots[i:i + self.PREFIX_BATCH_SIZE]
+            for i in range(0, len(roots), self.PREFIX_BATCH_SIZE)]
+        moved = set()
+        with self.db.transaction():
+            for batch in batches:
+                q = self.db.Update(self.FS_TABLE,
+                                   where=self.db.sqlin('base_path', srcs),
+                                   base_path='%s')
+                prefixes = []
+                if batch:
+                    cond = 'path = %s OR path LIKE %s ESCAPE \'{}\''.format(
+                        SQL_ESCAPE_CHAR)
+                    q.where &= '({})'.format(' OR '.join([cond] * len(batch)))
+                    for root in batch:
+                        prefixes.append(root)
+                        prefixes.append(sql_escape_path(root) + os.sep + '%')
+                sql = '{} RETURNING path;'.format(q.serialize()[:-1])
+                rows = self.db.fetchall(sql, params + prefixes)
+                moved.update(row['path'] for row in rows)
+        if self.tree is not None:
+            self.tree.set_base_path(base_path, srcs, roots=roots)
+        self._load_usage(list(srcs) + [base_path])
+        for path in (roots or [self.ROOT_DIR_PATH]):
+            self._invalidate(path)
+        return moved
+
+    def _remove_paths(self, paths, db=None):
+        if not paths:
+            return
+        db = db or self.indexer_db
+        # the events are committed together with the removal, or not at all
+        with db.transaction():
+            rows = db.fetchall(self.REMOVE_PATHS_SQL,
+                               ([p for _, p in paths],))
+            self.event_queue.additems(self._deleted_events(rows), db=db)
+        self._account_removed(rows)
+        for row in rows:
+            if self.tree is not None:
+                self.tree.remove(row['path'])
+            self._invalidate(row['path'])
 
     def _update_db_async(self, src_path=ROOT_DIR_PATH, base_paths=None):
-        self.scheduler.schedule(self._update_db, args=(src_path, base_paths))
+        self.planner.add(self._make_task(UPDATE, src_path, base_paths))
 
     def _fnwalk_checker(self, base_path, entry):
         path = entry.path
@@ -677,34 +1477,87 @@ class FSDBManager(object):
             logging.error('Cannot index "%s". Path does not exist' % src_path)
             return
         id_cache = FIFOCache(1024)
+        started = time.time()
+        # the walker pauses for the throttle while it is being iterated, and
+        # that time is not spent walking
+        walking = Stopwatch()
+        pausing = Stopwatch()
+        pause = pausing.timed(self.throttle.pause)
+        entries = 0
+        round_trips = 0
         try:
             checker = functools.partial(self._fnwalk_checker, base_path)
-            for entry in yielding_checked_fnwalk(src_path, checker):
-                path = entry.path
-                rel_path = os.path.relpath(path, base_path)
-                parent_path = os.path.dirname(rel_path)
-                parent_id = id_cache[parent_path] if parent_path in id_cache else None
-                if entry.is_dir():
-                    fso = Directory.from_stat(
-                        base_path, rel_path, entry.stat())
-                else:
-                    fso = File.from_stat(base_path, rel_path, entry.stat())
-                old_fso = self.get_fso(rel_path)
-                if not old_fso:
-                    event_cls = DirCreatedEvent if fso.is_dir() else FileCreatedEvent
-                elif old_fso.changed(fso):
-                    event_cls = DirModifiedEvent if fso.is_dir() else FileModifiedEvent
-                else:
-                    event_cls = None
-                if event_cls:
-                    self.event_queue.add(event_cls(rel_path))
-                if not old_fso or old_fso != fso:
-                    fso_id = self._update_fso_entry(fso, parent_id, old_fso)
-                    logging.debug('Updating db entry for "%s"' % rel_path)
-                    if fso.is_dir():
-                        id_cache[fso.rel_path] = fso_id
+            if self.walker.enabled:
+                walker = self.walker.walk(src_path, base_path, checker,
+                                          pause=pause)
+            else:
+                walker = yielding_checked_fnwalk(src_path, checker,
+                                                 pause=pause)
+            while True:
+                batch_size = self.throttle.batch_size(self.INDEX_BATCH_SIZE)
+                with walking:
+                    batch = list(islice(walker, batch_size))
+                if not batch:
+                    break
+                entries += len(batch)
+                with self._index_batch():
+                    for entry in batch:
+                        round_trips += self._index_entry(base_path, entry,
+                                                         id_cache)
         except Exception:
             logging.exception('Exception while indexing "%s"' % src_path)
+        finally:
+            duration = time.time() - started
+            self.metrics.incr('indexer.runs')
+            self.metrics.incr('indexer.entries', entries)
+            self.metrics.incr('indexer.db_round_trips', round_trips)
+            self.metrics.record('indexer.run', duration)
+            self.metrics.record('indexer.walk',
+                                walking.elapsed - pausing.elapsed)
+            self.metrics.record('indexer.paused', pausing.elapsed)
+            if duration > 0:
+                self.metrics.gauge('indexer.entries_per_sec',
+                                   round(entries / duration, 1))
+
+    def _index_entry(self, base_path, entry, id_cache):
+        """
+        Update the index entry of a single walked ``entry`` and return the
+        number of database round trips it took.
+        """
+        round_trips = 0
+        if isinstance(entry, WalkedEntry):
+            # computed by the walker process
+            rel_path = entry.rel_path
+        else:
+            rel_path = os.path.relpath(entry.path, base_path)
+        parent_path = os.path.dirname(rel_path)
+        parent_id = id_cache[parent_path] if parent_path in id_cache else None
+        if entry.is_dir():
+            fso = Directory.from_stat(base_path, rel_path, entry.stat())
+        else:
+            fso = File.from_stat(base_path, rel_path, entry.stat())
+        old_fso = self.get_fso(rel_path, db=self.indexer_db)
+        round_trips += 1
+        if not old_fso:
+            event_cls = DirCreatedEvent if fso.is_dir() else FileCreatedEvent
+        elif old_fso.changed(fso):
+            event_cls = DirModifiedEvent if fso.is_dir() else FileModifiedEvent
+        else:
+            event_cls = None
+        if event_cls:
+            # written within the batch of the entry
+            self.event_queue.add(event_cls(rel_path), db=self.indexer_db)
+            round_trips += 1
+        if not old_fso or old_fso != fso:
+            fso_id = self._update_fso_entry(fso, parent_id, old_fso)
+            round_trips += 1
+            logging.debug('Updating db entry for "%s"' % rel_path)
+            if fso.is_dir():
+                id_cache[fso.rel_path] = fso_id
+        return round_trips
+
+    def _extract_bundles_async(self):
+        self.planner.add(self._make_task(EXTRACT))
 
     def _extract_bundles(self):
         def bundle_checker(base_path, entry):
@@ -729,11 +1582,13 @@ class FSDBManager(object):
                 logging.exception(
                     'Unexpected exception while extracing bundles in {}: {}'.format(base_path, str(e)))
 
-    def _update_fso_entry(self, fso, parent_id=None, old_entry=None):
+    def _update_fso_entry(self, fso, parent_id=None, old_entry=None,
+                          db=None):
+        db = db or self.indexer_db
         if not parent_id:
             parent, name = os.path.split(fso.rel_path)
-            parent_dir = self._get_dir(parent)
-            parent_id = parent_dir.__id if parent_dir else 0
+            parent_dir = self._get_dir(parent, db=db)
+            parent_id = parent_dir.id if parent_dir else 0
 
         vals = {
             'parent_id': parent_id,
@@ -747,30 +1602,49 @@ class FSDBManager(object):
         }
 
         if old_entry:
-            sql_params = {k: '%({})s'.format(k) for k, v in vals.items()}
-            q = self.db.Update(
-                self.FS_TABLE, where='id = %(id)s', **sql_params)
-            vals['id'] = old_entry.__id
-            self.db.execute(q, vals)
-            return old_entry.__id
+            vals['id'] = old_entry.id
+            db.execute_prepared(self.UPDATE_FSO_STMT, vals)
         else:
-            cols = ['parent_id', 'type', 'name', 'size', 'create_time',
-                    'modify_time', 'path', 'base_path']
-            q = self.db.Insert(self.FS_TABLE, cols=cols)
-            raw_query = '{} RETURNING id;'.format(q.serialize()[:-1])
-            result = self.db.fetchone(raw_query, vals)
-            return result['id']
+            result = db.fetchone_prepared(self.INSERT_FSO_STMT, vals)
+            vals['id'] = result['id']
+        self._account_updated(fso, old_entry)
+        if self.tree is not None:
+            self.tree.put(vals)
+        self._invalidate(fso.rel_path)
+        return vals['id']
 
     def _clear_db(self):
         with self.db.transaction():
             q = self.db.Delete(self.FS_TABLE)
             self.db.execute(q)
+        if self.tree is not None:
+            self.tree.clear()
+        self.usage.clear()
+        self._invalidate(self.ROOT_DIR_PATH)
 
     def _fso_row_iterator(self, cursor):
         for result in cursor:
             if self._is_whitelisted(result['path']):
                 yield self._construct_fso(result)
 
+    def _projection(self, fields):
+        return self.PROJECTIONS.get(fields, '*')
+
+    def _row_iterator(self, cursor, fields):
+        """
+        Return an iterator of the listed entries of a listing of ``fields``.
+        """
+        if fields not in self.PROJECTIONS:
+            return self._fso_row_iterator(cursor)
+        return self._entry_row_iterator(cursor, fields == FIELDS_SIZES)
+
+    def _entry_row_iterator(self, cursor, sized):
+        dir_type = self.DIR_TYPE
+        for result in cursor:
+            if self._is_whitelisted(result['path']):
+                yield PathEntry(result['path'], result['type'] == dir_type,
+                                result['size'] if sized else None)
+
 
 class FIFOCache(object):
 
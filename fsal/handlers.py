@@ -14,9 +14,13 @@ from __future__ import absolute_import
 
 import os
 import shutil
+import logging
 
 from .import commandtypes
+from .fs import FIELDS_ALL, FIELDS_COUNTS
 from .serialize import str_to_bool
+from .metrics import collect_stats
+from .executor import CHEAP_READ, HEAVY_READ, CONTROL, MUTATING
 
 
 def validate_path(base_path, path):
@@ -25,30 +29,92 @@ def validate_path(base_path, path):
     return full_path.startswith(base_path), full_path
 
 
+def node_key(node):
+    """
+    Return a hashable representation of a parsed XML node.
+    """
+    return (node.tag, node.data.strip(),
+            tuple(node_key(child) for child in node.children))
+
+
 class CommandHandler(object):
     command_type = None
 
+    command_class = CHEAP_READ
+
     is_synchronous = True
 
     def __init__(self, context, command_data):
+        self.context = context
         self.command_data = command_data
         self.fs_mgr = context['fs_manager']
 
     def do_command(self):
         raise NotImplementedError()
 
+    def cache_key(self):
+        """
+        Return the key under which the result of the command is cached, or
+        ``None`` if the result must not be cached.
+        """
+        return None
+
+    def cache_path(self):
+        """
+        Return the index path whose subtree the cached result depends on.
+        """
+        return self.fs_mgr.ROOT_DIR_PATH
+
     def send_result(self, **kwargs):
         result = dict(type=self.command_type)
         result.update(kwargs)
         return result
 
 
-class DirectoryListingCommandHandler(CommandHandler):
+class CachedCommandMixin(object):
+    """
+    Caches results of commands which are pure reads of the index under the
+    command type, the command parameters and the active whitelist.
+    """
+
+    def cache_key(self):
+        return (self.command_type, self.cache_params(),
+                tuple(self.fs_mgr.whitelist))
+
+    def cache_params(self):
+        return node_key(self.command_data.params)
+
+
+class CachedPathCommandMixin(CachedCommandMixin):
+    """
+    Caches results of commands operating on a single indexed ``path`` under
+    the normalized path, and invalidates them when its subtree changes.
+    """
+
+    def normalized_path(self):
+        (valid, path) = self.fs_mgr._validate_path(
+            self.command_data.params.path.data)
+        return path if valid else None
+
+    def cache_params(self):
+        return self.normalized_path()
+
+    def cache_path(self):
+        return self.normalized_path() or self.fs_mgr.ROOT_DIR_PATH
+
+
+class DirectoryListingCommandHandler(CachedPathCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_LIST_DIR
+    command_class = CHEAP_READ
+
+    def cache_params(self):
+        order = self.command_data.params.get_data('order', None)
+        return (self.normalized_path(), order)
 
     def do_command(self):
         path = self.command_data.params.path.data
-        success, fs_objs = self.fs_mgr.list_dir(path)
+        order = self.command_data.params.get_data('order', None)
+        success, fs_objs = self.fs_mgr.list_dir(path, order=order)
         dirs = []
         files = []
         for fso in fs_objs:
@@ -57,12 +123,16 @@ class DirectoryListingCommandHandler(CommandHandler):
             else:
                 files.append(fso)
         params = {'dirs': dirs, 'files': files}
+        if order is not None:
+            # tells the client the listing is already sorted
+            params['order'] = order
 
         return self.send_result(success=success, params=params)
 
 
 class ListDescendantsCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_LIST_DESCENDANTS
+    command_class = HEAVY_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -72,6 +142,7 @@ class ListDescendantsCommandHandler(CommandHandler):
         order = self.command_data.params.get_data('order', None)
         span = self.command_data.params.get_data('span', None)
         entry_type = self.command_data.params.get_data('entry_type', None)
+        fields = self.command_data.params.get_data('fields', FIELDS_ALL)
         if 'ignored_paths' in self.command_data.params:
             ignored_paths = [i.data for i in self.command_data.params.ignored_paths.children if i.data]
         else:
@@ -85,7 +156,8 @@ class ListDescendantsCommandHandler(CommandHandler):
                                                  order=order,
                                                  span=span,
                                                  entry_type=entry_type,
-                                                 ignored_paths=ignored_paths)
+                                                 ignored_paths=ignored_paths,
+                                                 fields=fields)
         dirs = []
         files = []
         for fso in fs_objs:
@@ -93,16 +165,22 @@ class ListDescendantsCommandHandler(CommandHandler):
                 dirs.append(fso)
             else:
                 files.append(fso)
-        params = {'dirs': dirs, 'files': files, 'count': count}
+        params = {'dirs': dirs, 'files': files, 'fields': fields}
+        if fields == FIELDS_COUNTS:
+            params['counts'] = count
+        else:
+            params['count'] = count
         return self.send_result(success=success, params=params)
 
 
 class FilterCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_FILTER
+    command_class = HEAVY_READ
 
     def do_command(self):
         paths = [i.data for i in self.command_data.params.paths.children]
-        success, fs_objs = self.fs_mgr.filter(paths)
+        fields = self.command_data.params.get_data('fields', FIELDS_ALL)
+        success, fs_objs = self.fs_mgr.filter(paths, fields=fields)
         dirs = []
         files = []
         for fso in fs_objs:
@@ -110,12 +188,13 @@ class FilterCommandHandler(CommandHandler):
                 dirs.append(fso)
             else:
                 files.append(fso)
-        params = {'dirs': dirs, 'files': files}
+        params = {'dirs': dirs, 'files': files, 'fields': fields}
         return self.send_result(success=success, params=params)
 
 
-class SearchCommandHandler(CommandHandler):
+class SearchCommandHandler(CachedCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_SEARCH
+    command_class = HEAVY_READ
 
     def do_command(self):
         params = self.command_data.params
@@ -127,8 +206,9 @@ class SearchCommandHandler(CommandHandler):
                 exclude.append(c.data)
         else:
             exclude = None
+        fields = params.get_data('fields', FIELDS_ALL)
         is_match, fs_objs = self.fs_mgr.search(query, whole_words=whole_words,
-                                               exclude=exclude)
+                                               exclude=exclude, fields=fields)
         dirs = []
         files = []
         for fso in fs_objs:
@@ -136,13 +216,38 @@ class SearchCommandHandler(CommandHandler):
                 dirs.append(fso)
             else:
                 files.append(fso)
-        params = {'dirs': dirs, 'files': files, 'is_match': is_match}
+        params = {'dirs': dirs, 'files': files, 'is_match': is_match,
+                  'fields': fields}
 
         return self.send_result(success=True, params=params)
 
 
-class ListBasePathsCommandHandler(CommandHandler):
+class AggregateCommandHandler(CachedPathCommandMixin, CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_AGGREGATE
+    command_class = HEAVY_READ
+
+    def cache_params(self):
+        return node_key(self.command_data.params)
+
+    def do_command(self):
+        params = self.command_data.params
+        path = params.path.data
+        group_by = [i.data for i in params.group_by.children if i.data]
+        if 'ignored_paths' in params:
+            ignored_paths = [i.data for i in params.ignored_paths.children
+                             if i.data]
+        else:
+            ignored_paths = None
+        success, groups = self.fs_mgr.aggregate(path, group_by,
+                                                ignored_paths=ignored_paths)
+        return self.send_result(success=success,
+                                params={'group_by': group_by,
+                                        'groups': groups})
+
+
+class ListBasePathsCommandHandler(CachedCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_LIST_BASE_PATHS
+    command_class = CHEAP_READ
 
     def do_command(self):
         return self.send_result(success=True,
@@ -151,6 +256,7 @@ class ListBasePathsCommandHandler(CommandHandler):
 
 class GetPathSizeCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_GET_PATH_SIZE
+    command_class = HEAVY_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -158,8 +264,19 @@ class GetPathSizeCommandHandler(CommandHandler):
         return self.send_result(success=success, size=size)
 
 
+class StorageInfoCommandHandler(CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_STORAGE_INFO
+    command_class = CHEAP_READ
+
+    def do_command(self):
+        return self.send_result(success=True,
+                                params={'base_paths':
+                                        self.fs_mgr.storage_info()})
+
+
 class ConsolidateCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_CONSOLIDATE
+    command_class = MUTATING
 
     def do_command(self):
         source_paths = [s.data for s in self.command_data.params.sources.children]
@@ -173,27 +290,37 @@ class ConsolidateCommandHandler(CommandHandler):
 
 class CopyCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_COPY
+    command_class = MUTATING
 
     is_synchronous = False
 
     def do_command(self):
-        source_path = self.command_data.params.source.data
-        dest_path = self.command_data.params.dest.data
-        source_valid, source_path = validate_path(self.base_path, source_path)
-        dest_valid, dest_path = validate_path(self.base_path, dest_path)
-        if not (source_valid and dest_valid):
+        source = self.command_data.params.source.data
+        dest = self.command_data.params.dest.data
+        # the copy is made within the base path the source is found in
+        for base_path in self.fs_mgr.base_paths:
+            source_valid, source_path = validate_path(base_path, source)
+            dest_valid, dest_path = validate_path(base_path, dest)
+            if source_valid and dest_valid and os.path.exists(source_path):
+                break
+        else:
+            logging.error(u'Invalid copy from "%s" to "%s"', source, dest)
             return
         try:
             if os.path.isdir(source_path):
                 shutil.copytree(source_path, dest_path)
             else:
                 shutil.copy2(source_path, dest_path)
-        except:
-            pass
+        except (shutil.Error, IOError, OSError):
+            logging.exception(u'Error while copying "%s" to "%s"', source,
+                              dest)
+            return
+        self.fs_mgr.refresh_path(os.path.relpath(dest_path, base_path))
 
 
-class ExistsCommandHandler(CommandHandler):
+class ExistsCommandHandler(CachedPathCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_EXISTS
+    command_class = CHEAP_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -206,9 +333,16 @@ class ExistsCommandHandler(CommandHandler):
         params = {'exists': exists}
         return self.send_result(success=True, params=params)
 
+    def cache_key(self):
+        # unindexed lookups check the file system directly
+        if str_to_bool(self.command_data.params.unindexed.data):
+            return None
+        return super(ExistsCommandHandler, self).cache_key()
+
 
-class IsDirCommandHandler(CommandHandler):
+class IsDirCommandHandler(CachedPathCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_ISDIR
+    command_class = CHEAP_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -220,8 +354,9 @@ class IsDirCommandHandler(CommandHandler):
         return self.send_result(success=True, params=params)
 
 
-class IsFileCommandHandler(CommandHandler):
+class IsFileCommandHandler(CachedPathCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_ISFILE
+    command_class = CHEAP_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -235,6 +370,7 @@ class IsFileCommandHandler(CommandHandler):
 
 class RemoveCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_REMOVE
+    command_class = MUTATING
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -243,8 +379,9 @@ class RemoveCommandHandler(CommandHandler):
         return self.send_result(success=success, params=params)
 
 
-class GetFSOCommandHandler(CommandHandler):
+class GetFSOCommandHandler(CachedPathCommandMixin, CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_GET_FSO
+    command_class = CHEAP_READ
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -262,6 +399,7 @@ class GetFSOCommandHandler(CommandHandler):
 
 class TransferCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_TRANSFER
+    command_class = MUTATING
 
     def do_command(self):
         src = self.command_data.params.src.data
@@ -273,6 +411,7 @@ class TransferCommandHandler(CommandHandler):
 
 class GetChangesCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_GET_CHANGES
+    command_class = CHEAP_READ
 
     def do_command(self):
         limit = int(self.command_data.params.limit.data)
@@ -283,6 +422,7 @@ class GetChangesCommandHandler(CommandHandler):
 
 class ConfirmChangesCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_CONFIRM_CHANGES
+    command_class = CHEAP_READ
 
     def do_command(self):
         limit = int(self.command_data.params.limit.data)
@@ -292,6 +432,7 @@ class ConfirmChangesCommandHandler(CommandHandler):
 
 class RefreshPathCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_REFRESH_PATH
+    command_class = CONTROL
 
     def do_command(self):
         path = self.command_data.params.path.data
@@ -300,8 +441,20 @@ class RefreshPathCommandHandler(CommandHandler):
         return self.send_result(success=success, params=params)
 
 
+class RefreshFileCommandHandler(CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_REFRESH_FILE
+    command_class = CONTROL
+
+    def do_command(self):
+        path = self.command_data.params.path.data
+        success, msg = self.fs_mgr.refresh_file(path)
+        params = {'error': msg}
+        return self.send_result(success=success, params=params)
+
+
 class RefreshCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_REFRESH
+    command_class = CONTROL
 
     def do_command(self):
         self.fs_mgr.refresh()
@@ -310,6 +463,7 @@ class RefreshCommandHandler(CommandHandler):
 
 class SetWhitelistCommandHandler(CommandHandler):
     command_type = commandtypes.COMMAND_TYPE_SET_WHITELIST
+    command_class = CONTROL
 
     def do_command(self):
         paths = [i.data for i in self.command_data.params.paths.children]
@@ -317,6 +471,87 @@ class SetWhitelistCommandHandler(CommandHandler):
         return self.send_result(success=True, params={})
 
 
+class GetStatsCommandHandler(CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_GET_STATS
+    command_class = CHEAP_READ
+
+    def do_command(self):
+        return self.send_result(success=True,
+                                params=collect_stats(self.context))
+
+
+class SetProfilingCommandHandler(CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_SET_PROFILING
+    command_class = CONTROL
+
+    def do_command(self):
+        params = self.command_data.params
+        enabled = params.get_data('enabled', None)
+        threshold = params.get_data('threshold', None)
+        profile_requests = params.get_data('profile_requests', None)
+        profile_indexing = params.get_data('profile_indexing', None)
+        profiler = self.context['profiler']
+        profiler.configure(
+            enabled=None if enabled is None else str_to_bool(enabled),
+            threshold=None if threshold is None else float(threshold),
+            profile_requests=(None if profile_requests is None
+                              else int(profile_requests)),
+            profile_indexing=(None if profile_indexing is None
+                              else str_to_bool(profile_indexing)))
+        return self.send_result(success=True, params=profiler.get_stats())
+
+
+class BatchCommandHandler(CommandHandler):
+    command_type = commandtypes.COMMAND_TYPE_BATCH
+
+    #: Command classes ordered from the cheapest to the most expensive one
+    class_order = (CHEAP_READ, CONTROL, HEAVY_READ, MUTATING)
+
+    def __init__(self, context, command_data):
+        super(BatchCommandHandler, self).__init__(context, command_data)
+        factory = CommandHandlerFactory(context)
+        self.handlers = []
+        for sub_command in command_data.params.commands.children:
+            handler = factory.create_handler(sub_command)
+            self.handlers.append((sub_command.type.data, handler))
+        classes = [h.command_class for _, h in self.handlers if h]
+        # the whole batch occupies a slot in the pool of its most expensive
+        # sub-command
+        self.command_class = max(classes or [CHEAP_READ],
+                                 key=self.class_order.index)
+        self.read_only = not (set(classes) & set([CONTROL, MUTATING]))
+
+    def run_handler(self, command_type, handler):
+        if handler is None or isinstance(handler, BatchCommandHandler):
+            error = 'unsupported_command'
+        elif not handler.is_synchronous:
+            error = 'unsupported_command'
+        else:
+            try:
+                cache = self.context.get('cache')
+                # results read within a snapshot may predate invalidations
+                # which the cache already saw, so they are neither served
+                # from nor stored in it
+                if cache is not None and not self.read_only:
+                    return cache.fetch(handler, handler.do_command)
+                return handler.do_command()
+            except Exception:
+                logging.exception('Unexpected exception while handling '
+                                  'batched "%s" command', command_type)
+                error = 'internal_error'
+        return dict(type=command_type, success=False,
+                    params={'error': error})
+
+    def do_command(self):
+        if self.read_only:
+            # read-only batches observe a single snapshot of the index
+            with self.fs_mgr.read_snapshot():
+                results = [self.run_handler(*h) for h in self.handlers]
+        else:
+            results = [self.run_handler(*h) for h in self.handlers]
+        return self.send_result(success=True, params={'results': results})
+
+
 class CommandHandlerFactory(object):
 
     def __init__(self, context):
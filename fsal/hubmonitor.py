@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+hubmonitor.py: detection of code blocking the gevent hub
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import sys
+import time
+import weakref
+import logging
+import threading
+import traceback
+import contextlib
+import collections
+
+import gevent
+import greenlet
+from gevent import monkey
+
+
+# the monitoring thread must not yield to the hub it is monitoring
+real_sleep = monkey.get_original('time', 'sleep')
+
+#: Labels of the work greenlets are currently doing, used for attribution
+_activities = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def activity(label):
+    """
+    Label the work done by the current greenlet within the block, so blocking
+    of the hub can be attributed to it. Labels are dotted names such as
+    ``command.list_dir``.
+    """
+    current = gevent.getcurrent()
+    previous = _activities.get(current)
+    _activities[current] = label
+    try:
+        yield
+    finally:
+        if previous is None:
+            _activities.pop(current, None)
+        else:
+            _activities[current] = previous
+
+
+class HubMonitor(object):
+    """
+    Detects when the gevent hub did not get to run for longer than
+    ``threshold`` milliseconds.
+
+    A greenlet updates a heartbeat every half of the threshold, while a native
+    thread checks that the heartbeat keeps advancing. When it does not, the
+    stack of the main thread, which is the stack of the greenlet hogging the
+    hub, is logged together with the label of the activity it belongs to. The
+    currently running greenlet is tracked using ``greenlet.settrace``, so the
+    cost in normal operation is one dict assignment per greenlet switch.
+
+    The native thread does not touch the metrics, which are not thread safe.
+    It queues the activities it found blocking, and the heartbeat greenlet
+    counts them on its next beat.
+    """
+
+    def __init__(self, config, metrics):
+        self.enabled = config.get('hub_monitor.enabled', True)
+        self.threshold = config.get('hub_monitor.threshold', 200) / 1000.0
+        self.interval = self.threshold / 2
+        self.metrics = metrics
+        self.last_tick = time.time()
+        self.running = None
+        self.events = 0
+        self.max_blocked = 0.0
+        self.last_event = None
+        # activities reported by the native thread, counted by the heartbeat
+        self._blocked = collections.deque()
+        self._heartbeat = None
+        self._thread = None
+        self._hub = None
+        self._stopped = False
+        self._main_thread_id = None
+
+    def start(self):
+        if not self.enabled or self._heartbeat is not None:
+            return
+        self._main_thread_id = threading.current_thread().ident
+        self._hub = gevent.get_hub()
+        settrace = getattr(greenlet, 'settrace', None)
+        if settrace is not None:
+            settrace(self._trace)
+        self._stopped = False
+        self._heartbeat = gevent.spawn(self._beat)
+        self._thread = threading.Thread(target=self._watch,
+                                        name='hub-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.debug('Hub monitor started with %d ms threshold',
+                      self.threshold * 1000)
+
+    def stop(self):
+        self._stopped = True
+        if self._heartbeat is not None:
+            self._heartbeat.kill()
+            self._heartbeat = None
+        settrace = getattr(greenlet, 'settrace', None)
+        if settrace is not None:
+            settrace(None)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self.running = args[1]
+
+    def _beat(self):
+        while True:
+            self.last_tick = time.time()
+            self._count_blocked()
+            gevent.sleep(self.interval)
+
+    def _count_blocked(self):
+        while self._blocked:
+            label = self._blocked.popleft()
+            self.metrics.incr('hub.blocked.' + label)
+
+    def _watch(self):
+        reported_tick = None
+        while not self._stopped:
+            real_sleep(self.interval)
+            last_tick = self.last_tick
+            blocked = time.time() - last_tick
+            if blocked < self.threshold or last_tick == reported_tick:
+                continue
+            reported_tick = last_tick
+            try:
+                self._report(blocked)
+            except Exception:
+                logging.exception('Error while reporting blocked hub')
+
+    def _report(self, blocked):
+        running = self.running
+        label = _activities.get(running) if running is not None else None
+        if label is None:
+            label = 'hub' if running is self._hub else 'unknown'
+        frame = sys._current_frames().get(self._main_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        self.events += 1
+        self.max_blocked = max(self.max_blocked, blocked)
+        self.last_event = {'activity': label,
+                           'blocked': round(blocked * 1000, 3)}
+        self._blocked.append(label)
+        logging.warning('Hub blocked for at least %d ms by %s:\n%s',
+                        blocked * 1000, label, stack)
+
+    def get_stats(self):
+        return {
+            'enabled': self.enabled,
+            'threshold': self.threshold * 1000,
+            'events': self.events,
+            'max_blocked': round(self.max_blocked * 1000, 3),
+            'last_event': self.last_event or {},
+        }
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+journal.py: persistent journal of pending index maintenance tasks
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import json
+
+
+class TaskJournal(object):
+    """
+    Table of maintenance tasks which were accepted by the planner and have not
+    completed yet. Tasks are recorded as their kind and JSON encoded arguments
+    when they are accepted, and removed once they complete or are replaced by
+    a task covering them, so the tasks which were pending or running when the
+    process died can be replayed on the next start.
+    """
+
+    TABLE = 'tasks'
+
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, task):
+        """
+        Record ``task`` and return the id of its record.
+        """
+        q = self.db.Insert(self.TABLE, cols=['kind', 'args'])
+        sql = '{} RETURNING id;'.format(q.serialize()[:-1])
+        row = self.db.fetchone(sql, {'kind': task.kind,
+                                     'args': json.dumps(task.args)})
+        return row['id']
+
+    def remove(self, ids):
+        if not ids:
+            return
+        q = self.db.Delete(self.TABLE, where='id = ANY(%s)')
+        self.db.execute(q, (list(ids),))
+
+    def records(self):
+        """
+        Return (id, kind, args) of all recorded tasks in the order they were
+        accepted.
+        """
+        q = self.db.Select('id, kind, args', sets=self.TABLE, order='id')
+        return [(row['id'], row['kind'], json.loads(row['args']))
+                for row in self.db.fetchall(q)]
+
+    def pop(self):
+        """
+        Remove the records and return (kind, args) pairs of the recorded
+        tasks in the order they were accepted. Call within a transaction, in
+        which the tasks are accepted again.
+        """
+        records = self.records()
+        # records added by other processes in the meantime are kept
+        self.remove([journal_id for (journal_id, _, _) in records])
+        return [(kind, args) for (_, kind, args) in records]
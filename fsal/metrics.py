@@ -0,0 +1,258 @@
+"""
+metrics.py: lightweight counters and latency histograms
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import json
+import time
+import bisect
+import logging
+import collections
+
+import gevent
+
+
+#: Context entries which report their statistics
+STATS_SOURCES = ('executor', 'cache', 'tree', 'planner', 'throttle',
+                 'walker', 'metrics', 'profiler', 'hub_monitor')
+
+
+def collect_stats(context):
+    """
+    Gather statistics of all components present in ``context``.
+    """
+    stats = dict()
+    for name in STATS_SOURCES:
+        source = context.get(name)
+        if source is not None:
+            stats[name] = source.get_stats()
+    return stats
+
+
+def nest(flat):
+    """
+    Convert a dict with dotted keys into nested dicts.
+    """
+    nested = dict()
+    for key, value in flat.items():
+        node = nested
+        parts = key.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return nested
+
+
+class Histogram(object):
+    """
+    Fixed-bucket latency histogram. Samples are recorded in seconds and
+    reported in milliseconds. Percentiles are approximated by the upper bound
+    of the bucket they fall into, which is precise enough to spot outliers
+    while keeping recording O(log n) and memory constant.
+    """
+    #: Upper bounds of the buckets in milliseconds
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for bound, hits in zip(self.BOUNDS, self.buckets):
+            seen += hits
+            if seen >= threshold:
+                return float(min(bound, self.max))
+        return self.max
+
+    def to_dict(self):
+        avg = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'avg': round(avg, 3),
+            'max': round(self.max, 3),
+            'p50': round(self.percentile(50), 3),
+            'p95': round(self.percentile(95), 3),
+            'p99': round(self.percentile(99), 3),
+        }
+
+
+class Timer(object):
+    """
+    Context manager recording the duration of the enclosed block.
+    """
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, time.time() - self.start)
+
+
+class NullTimer(object):
+    """
+    Stand-in for :py:class:`Timer` which does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Stopwatch(object):
+    """
+    Accumulates the time spent within its blocks, and within the calls of
+    functions wrapped with :py:meth:`timed`.
+    """
+    __slots__ = ('elapsed', 'start')
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed += time.time() - self.start
+
+    def timed(self, func):
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class PhaseTimer(object):
+    """
+    Measures consecutive phases of a single unit of work. Each call to
+    :py:meth:`mark` ends the current phase and records its duration under
+    ``prefix`` followed by the phase name.
+    """
+
+    def __init__(self, metrics, prefix):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.timings = collections.OrderedDict()
+        self.started = self.last = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        duration = now - self.last
+        self.last = now
+        self.timings[phase] = duration
+        self.metrics.record(self.prefix + phase, duration)
+
+    @property
+    def total(self):
+        return self.last - self.started
+
+
+class Metrics(object):
+    """
+    Registry of named counters, gauges and latency histograms. Names are
+    dotted paths, e.g. ``requests.parse``, and are reported as nested dicts.
+    When disabled, recording is reduced to a single attribute check.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get('stats.enabled', True)
+        self.started = time.time()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def incr(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def timer(self, name):
+        if self.enabled:
+            return Timer(self, name)
+        return NULL_TIMER
+
+    def get_stats(self):
+        latency = dict((name, histogram.to_dict())
+                       for name, histogram in self.histograms.items())
+        return {
+            'enabled': self.enabled,
+            'uptime': round(time.time() - self.started, 3),
+            'counters': nest(self.counters),
+            'gauges': nest(self.gauges),
+            'latency': nest(latency),
+        }
+
+
+class StatsSnapshotter(object):
+    """
+    Periodically persists a snapshot of the collected statistics.
+    """
+
+    def __init__(self, config, context):
+        self.interval = config.get('stats.snapshot_interval', 0)
+        self.keep = config.get('stats.snapshot_keep', 1440)
+        self.context = context
+        self._background = None
+
+    def start(self):
+        if self._background is not None or not self.interval:
+            return
+        self._background = gevent.spawn(self._snapshot_loop)
+
+    def stop(self):
+        if self._background:
+            self._background.kill()
+            self._background = None
+
+    def _snapshot_loop(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                stats = json.dumps(collect_stats(self.context))
+                self.context['fs_manager'].save_stats(stats, keep=self.keep)
+            except Exception as e:
+                logging.exception(
+                    'Exception while saving stats snapshot: {}'.format(str(e)))
@@ -0,0 +1,12 @@
+SQL = """
+create table dbmgr_stats
+(
+    id serial primary key not null,                 -- id of the snapshot
+    time timestamp not null default now(),          -- time of the snapshot
+    stats varchar not null                          -- JSON encoded statistics
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,13 @@
+SQL = """
+-- directory listings, already sorted by type and name
+create index parent_index on fsentries(parent_id, type, name);
+-- prefix matches (path LIKE 'dir/%') regardless of the database collation
+create index path_prefix_index on fsentries(path varchar_pattern_ops);
+create index base_path_index on fsentries(base_path);
+create index modify_time_index on fsentries(modify_time);
+create index type_modify_time_index on fsentries(type, modify_time);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
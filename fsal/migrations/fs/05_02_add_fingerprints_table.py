@@ -0,0 +1,12 @@
+SQL = """
+create table fingerprints
+(
+    base_path varchar primary key not null,         -- base path
+    fingerprint varchar not null,                   -- JSON encoded fingerprint
+    time timestamp not null default now()           -- time of the fingerprint
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,13 @@
+SQL = """
+create table tasks
+(
+    id serial primary key not null,                 -- order of acceptance
+    kind varchar not null,                          -- kind of the task
+    args varchar not null,                          -- JSON encoded arguments
+    time timestamp not null default now()           -- time of acceptance
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,10 @@
+SQL = """
+-- directory listings sorted by size or modification time, the way
+-- parent_index serves those sorted by name
+create index parent_size_index on fsentries(parent_id, type, size);
+create index parent_modify_time_index on fsentries(parent_id, type, modify_time);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,39 @@
+# Schema of the Postgres migrations up to 05_01, squashed into one migration
+SQL = """
+create table fsentries
+(
+    id integer primary key autoincrement,         -- id for the file
+    parent_id integer not null default 0,         -- id of the parent
+    type integer not null,                        -- determines the type of the entry (0 => file, 1 => directory)
+    name varchar not null,                        -- filename
+    size integer not null default 0,              -- size in bytes
+    create_time timestamp not null,               -- UNIX timestamp of created time
+    modify_time timestamp not null,               -- UNIX timestamp of modified time
+    path varchar unique not null,                 -- path relative to base path
+    base_path varchar                             -- base path the entry is stored in
+);
+
+create index parent_index on fsentries(parent_id, type, name);
+create index base_path_index on fsentries(base_path);
+create index modify_time_index on fsentries(modify_time);
+create index type_modify_time_index on fsentries(type, modify_time);
+
+create table events
+(
+    id integer primary key autoincrement,    -- id for event
+    type varchar not null,                  -- whether it's a create, modify or delete event
+    src varchar not null,                   -- path of the source of event
+    is_dir bool not null                    -- whether the source is a directory
+);
+
+create table dbmgr_stats
+(
+    id integer primary key autoincrement,           -- id of the snapshot
+    time timestamp not null default current_timestamp, -- time of the snapshot
+    stats varchar not null                          -- JSON encoded statistics
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
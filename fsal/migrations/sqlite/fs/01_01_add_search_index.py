@@ -0,0 +1,29 @@
+# Full text index of entry names used by search. The trigram tokenizer allows
+# case insensitive substring matches, like ILIKE '%word%' does in Postgres.
+SQL = """
+create virtual table fsentries_search using fts5(
+    name,
+    content='fsentries',
+    content_rowid='id',
+    tokenize='trigram'
+);
+
+create trigger fsentries_search_insert after insert on fsentries begin
+    insert into fsentries_search(rowid, name) values (new.id, new.name);
+end;
+
+create trigger fsentries_search_delete after delete on fsentries begin
+    insert into fsentries_search(fsentries_search, rowid, name)
+        values ('delete', old.id, old.name);
+end;
+
+create trigger fsentries_search_update after update of name on fsentries begin
+    insert into fsentries_search(fsentries_search, rowid, name)
+        values ('delete', old.id, old.name);
+    insert into fsentries_search(rowid, name) values (new.id, new.name);
+end;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,13 @@
+SQL = """
+create table tasks
+(
+    id integer primary key autoincrement,           -- order of acceptance
+    kind varchar not null,                          -- kind of the task
+    args varchar not null,                          -- JSON encoded arguments
+    time timestamp not null default current_timestamp -- time of acceptance
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
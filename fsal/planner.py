@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+planner.py: merging of pending index maintenance tasks
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import logging
+
+from gevent.lock import RLock
+
+
+ROOT_PATH = '.'
+
+REFRESH = 'refresh'
+PRUNE = 'prune'
+UPDATE = 'update'
+EXTRACT = 'extract'
+
+
+def within(path, root):
+    """
+    Return whether ``path`` lies in the subtree of ``root``, where ``None``
+    stands for the whole tree.
+    """
+    if root is None:
+        return True
+    if path is None:
+        return False
+    return path == root or path.startswith(root + os.sep)
+
+
+class PlannedTask(object):
+    """
+    Index maintenance task of a given ``kind``, which covers the subtree of
+    ``path`` within ``base_paths``. ``None`` stands for the whole tree and for
+    all base paths respectively.
+    """
+
+    def __init__(self, kind, fn, args=(), path=None, base_paths=None):
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        if path is not None:
+            path = os.path.normpath(path)
+        self.path = None if path == ROOT_PATH else path
+        self.base_paths = None if base_paths is None else set(base_paths)
+        # id of the record in the task journal
+        self.journal_id = None
+
+    def covers(self, other):
+        """
+        Return whether running this task makes running ``other`` redundant.
+        """
+        if self.kind == REFRESH:
+            # a refresh prunes and updates the whole index
+            return True
+        if self.kind != other.kind:
+            return False
+        if self.base_paths is not None and (
+                other.base_paths is None or
+                not other.base_paths <= self.base_paths):
+            return False
+        return within(other.path, self.path)
+
+    def __repr__(self):
+        return '<PlannedTask {} {} in {}>'.format(
+            self.kind, self.path or ROOT_PATH,
+            'all' if self.base_paths is None else sorted(self.base_paths))
+
+
+class RefreshPlanner(object):
+    """
+    Queue of pending index maintenance tasks in front of the task scheduler.
+
+    A task covered by one which is still pending is dropped, and a task which
+    covers pending ones takes the place of the first of them. Tasks that are
+    already running never cover new ones, as they may have passed the changed
+    paths already. Every accepted task takes a slot in the scheduler queue,
+    and each slot runs the task at the head of the pending ones when it comes
+    up, so slots of replaced tasks are left empty.
+
+    If a ``journal`` is given, accepted tasks are recorded in it until they
+    complete or get replaced.
+    """
+
+    def __init__(self, scheduler, run, on_idle=None, journal=None):
+        self.scheduler = scheduler
+        self.run = run
+        self.on_idle = on_idle
+        self.journal = journal
+        self.lock = RLock()
+        self.pending = []
+        self.running = 0
+        # journal ids of the running tasks
+        self._running_ids = set()
+        self.planned = 0
+        self.merged = 0
+        self.replaced = 0
+        self.executed = 0
+        self.max_pending = 0
+
+    @property
+    def idle(self):
+        """
+        Whether no task is pending or running.
+        """
+        return not self.pending and not self.running
+
+    def add(self, task):
+        """
+        Queue ``task`` unless a pending task covers it. Return whether it was
+        queued.
+        """
+        with self.lock:
+            return self._accept(task)
+
+    def adopt(self, make_task):
+        """
+        Accept the tasks recorded in the journal by other processes, which
+        are created by calling ``make_task`` with their kind and arguments.
+        """
+        with self.lock:
+            known = set(t.journal_id for t in self.pending)
+            known.update(self._running_ids)
+            for (journal_id, kind, args) in self.journal.records():
+                if journal_id not in known:
+                    self._accept(make_task(kind, *args), journal_id)
+
+    def _accept(self, task, journal_id=None):
+        for pending in self.pending:
+            if pending.covers(task):
+                self.merged += 1
+                logging.debug('%r merged into %r', task, pending)
+                if journal_id is not None:
+                    self.journal.remove([journal_id])
+                return False
+        if journal_id is not None:
+            task.journal_id = journal_id
+        elif self.journal is not None:
+            task.journal_id = self.journal.add(task)
+        covered = [i for (i, p) in enumerate(self.pending) if task.covers(p)]
+        if covered:
+            self.replaced += len(covered)
+            logging.debug('%r replaces %d pending tasks', task, len(covered))
+            if self.journal is not None:
+                self.journal.remove([self.pending[i].journal_id
+                                     for i in covered])
+            self.pending[covered[0]] = task
+            for i in reversed(covered[1:]):
+                del self.pending[i]
+        else:
+            self.pending.append(task)
+        self.planned += 1
+        self.max_pending = max(self.max_pending, len(self.pending))
+        self.scheduler.schedule(self._run_next)
+        return True
+
+    def _run_next(self):
+        if not self.pending:
+            return
+        task = self.pending.pop(0)
+        self.executed += 1
+        self.running += 1
+        self._running_ids.add(task.journal_id)
+        try:
+            return self.run(task.fn, task.args)
+        finally:
+            self.running -= 1
+            self._running_ids.discard(task.journal_id)
+            if self.journal is not None:
+                self.journal.remove([task.journal_id])
+            if self.idle and self.on_idle is not None:
+                self.on_idle()
+
+    def get_stats(self):
+        kinds = dict.fromkeys((REFRESH, PRUNE, UPDATE, EXTRACT), 0)
+        for task in self.pending:
+            kinds[task.kind] += 1
+        return {
+            'pending': len(self.pending),
+            'pending_by_kind': kinds,
+            'running': self.running,
+            'max_pending': self.max_pending,
+            'planned': self.planned,
+            'merged': self.merged,
+            'replaced': self.replaced,
+            'executed': self.executed,
+        }
+
+
+class RemotePlanner(object):
+    """
+    Planner of processes which leave maintenance tasks to the indexer
+    process. Tasks are only recorded in the journal, from which the indexer
+    process adopts them.
+    """
+
+    idle = True
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.forwarded = 0
+
+    def add(self, task):
+        self.journal.add(task)
+        self.forwarded += 1
+        return True
+
+    def get_stats(self):
+        return {
+            'forwarded': self.forwarded,
+        }
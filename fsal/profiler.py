@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+profiler.py: slow command log and on-demand profiling
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import time
+import cProfile
+import logging
+import contextlib
+import collections
+import logging.handlers
+
+from .utils import to_unicode
+
+
+SLOW_LOG_SIZE = 1024 * 1024
+SLOW_LOG_BACKUPS = 2
+#: Number of most recently written profiles reported in the stats
+PROFILE_HISTORY = 20
+#: Scheduled tasks which walk the storage to index it, the ``REFRESH`` and
+#: ``UPDATE`` tasks of the planner
+INDEXING_TASKS = ('_refresh_db', '_update_db')
+
+
+def node_to_dict(node):
+    """
+    Convert parsed XML command parameters into a JSON serializable dict.
+    """
+    params = dict()
+    for child in node.children:
+        if child.children:
+            params[child.tag] = [c.data for c in child.children]
+        else:
+            params[child.tag] = child.data
+    return params
+
+
+class Profiler(object):
+    """
+    Records commands and scheduled tasks exceeding the ``threshold`` (in
+    milliseconds) to the slow log, and captures ``cProfile`` profiles of the
+    next requested number of commands or of the next indexing task. Other
+    scheduled tasks are not profiled, and leave the request for the indexing
+    task pending.
+
+    Only one profile can be captured at a time. Since all greenlets share the
+    main thread, a profile also contains the work of greenlets which were
+    switched to while the profiled command or task was running.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get('profiling.enabled', False)
+        self.threshold = config.get('profiling.slow_threshold', 500)
+        self.profile_dir = config.get('profiling.profile_dir', '/tmp')
+        self.slow_log = self._get_slow_logger(
+            config.get('profiling.slow_log', '/tmp/fsal-slow.log'))
+        self.profile_requests = 0
+        self.profile_indexing = False
+        self.slow_count = 0
+        self.profiles = collections.deque(maxlen=PROFILE_HISTORY)
+        self._active = None
+
+    @staticmethod
+    def _get_slow_logger(path):
+        logger = logging.getLogger('fsal.slow')
+        logger.propagate = False
+        if path and not logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=SLOW_LOG_SIZE, backupCount=SLOW_LOG_BACKUPS)
+            formatter = logging.Formatter('[%(asctime)s] %(message)s')
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+        return logger
+
+    def configure(self, enabled=None, threshold=None, profile_requests=None,
+                  profile_indexing=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if threshold is not None:
+            self.threshold = threshold
+        if profile_requests is not None:
+            self.profile_requests = profile_requests
+        if profile_indexing is not None:
+            self.profile_indexing = profile_indexing
+        logging.info('Profiling %s, slow threshold %s ms, profiling next %d '
+                     'requests%s', 'enabled' if self.enabled else 'disabled',
+                     self.threshold, self.profile_requests,
+                     ' and indexing run' if self.profile_indexing else '')
+
+    def report(self, kind, name, duration, params=None, timings=None):
+        """
+        Write an entry into the slow log if ``duration`` (in seconds) exceeds
+        the threshold. ``params`` may be parsed XML command parameters.
+        """
+        if not self.enabled or duration * 1000 < self.threshold:
+            return
+        self.slow_count += 1
+        if hasattr(params, 'children'):
+            params = node_to_dict(params)
+        entry = {
+            'kind': kind,
+            'name': name,
+            'duration': round(duration * 1000, 3),
+            'params': params,
+        }
+        if timings:
+            entry['timings'] = dict((phase, round(t * 1000, 3))
+                                    for phase, t in timings.items())
+        self.slow_log.warning(json.dumps(entry, default=to_unicode))
+
+    def _should_profile(self, kind, name):
+        if self._active is not None:
+            return False
+        if kind == 'command' and self.profile_requests > 0:
+            self.profile_requests -= 1
+            return True
+        if (kind == 'task' and self.profile_indexing and
+                name in INDEXING_TASKS):
+            self.profile_indexing = False
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def profile(self, kind, name):
+        """
+        Capture a profile of the enclosed block if one was requested for the
+        given ``kind`` of work (``command`` or ``task``).
+        """
+        if not self._should_profile(kind, name):
+            yield
+            return
+        self._active = profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active = None
+            self._dump(profile, kind, name)
+
+    def _dump(self, profile, kind, name):
+        filename = 'fsal-{}-{}-{}.prof'.format(kind, name,
+                                               int(time.time() * 1000))
+        path = os.path.join(self.profile_dir, filename)
+        try:
+            profile.dump_stats(path)
+        except (IOError, OSError) as e:
+            logging.error('Could not write profile to %s: %s', path, str(e))
+        else:
+            logging.info('Profile of %s "%s" written to %s', kind, name, path)
+            self.profiles.append(path)
+
+    def get_stats(self):
+        return {
+            'enabled': self.enabled,
+            'slow_threshold': self.threshold,
+            'slow_count': self.slow_count,
+            'profile_requests': self.profile_requests,
+            'profile_indexing': self.profile_indexing,
+            'profiles': list(self.profiles),
+        }
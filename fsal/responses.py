@@ -10,24 +10,19 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
-from datetime import datetime
-
 from xml.etree.ElementTree import Element, SubElement, tostring
 
 from . import commandtypes
+from .fs import FIELDS_ALL, FIELDS_SIZES
 from .utils import to_unicode
-from .serialize import singular_name
+from .serialize import singular_name, bool_to_str
+from .exceptions import CommandBusyError
 
 
 def create_response_xml_root():
     return Element(u'response')
 
 
-def to_timestamp(dt, epoch=datetime(1970, 1, 1)):
-    delta = dt - epoch
-    return delta.total_seconds()
-
-
 def dict_to_xml(data, root=None):
     root = Element(u'response') if root is None else root
     for key, value in data.items():
@@ -62,13 +57,58 @@ def add_fso_node(parent_node, fso):
     rel_path_node = SubElement(fso_node, u'rel-path')
     rel_path_node.text = to_unicode(fso.rel_path)
     create_timestamp_node = SubElement(fso_node, u'create-timestamp')
-    create_timestamp_node.text = to_unicode(to_timestamp(fso.create_date))
+    create_timestamp_node.text = to_unicode(fso.create_timestamp)
     modify_timestamp_node = SubElement(fso_node, u'modify-timestamp')
-    modify_timestamp_node.text = to_unicode(to_timestamp(fso.modify_date))
+    modify_timestamp_node.text = to_unicode(fso.modify_timestamp)
     size_node = SubElement(fso_node, u'size')
     size_node.text = str(fso.size)
 
 
+def add_entry_node(parent_node, entry, fields=FIELDS_ALL):
+    """
+    Add a node of the listed ``entry`` with only the requested ``fields``.
+    """
+    if fields == FIELDS_ALL:
+        add_fso_node(parent_node, entry)
+        return
+    node_name = u'dir' if entry.is_dir() else u'file'
+    entry_node = SubElement(parent_node, node_name)
+    rel_path_node = SubElement(entry_node, u'rel-path')
+    rel_path_node.text = to_unicode(entry.rel_path)
+    if fields == FIELDS_SIZES:
+        size_node = SubElement(entry_node, u'size')
+        size_node.text = str(entry.size)
+
+
+def add_listing_nodes(params_node, params):
+    """
+    Add nodes of the listed directories and files, and of their counts if
+    only those were requested.
+    """
+    fields = params.get('fields', FIELDS_ALL)
+    if fields != FIELDS_ALL:
+        fields_node = SubElement(params_node, u'fields')
+        fields_node.text = to_unicode(fields)
+    order = params.get('order')
+    if order is not None:
+        order_node = SubElement(params_node, u'order')
+        order_node.text = to_unicode(order)
+    counts = params.get('counts')
+    if counts is not None:
+        counts_node = SubElement(params_node, u'counts')
+        for key in ('dirs', 'files'):
+            count_node = SubElement(counts_node, key)
+            count_node.text = to_unicode(counts[key])
+
+    dirs_node = SubElement(params_node, u'dirs')
+    for d in params.get('dirs', []):
+        add_entry_node(dirs_node, d, fields)
+
+    files_node = SubElement(params_node, u'files')
+    for f in params.get('files', []):
+        add_entry_node(files_node, f, fields)
+
+
 def add_event_node(parent_node, event):
     event_node = SubElement(parent_node, u'event')
     type_node = SubElement(event_node, u'type')
@@ -123,13 +163,7 @@ class DirectoryListingResponse(GenericResponse):
                 count_node = SubElement(result_node, u'count')
                 count_node.text = to_unicode(count)
 
-            dirs_node = SubElement(params_node, u'dirs')
-            for d in self.response_data['params'].get('dirs', []):
-                add_fso_node(dirs_node, d)
-
-            files_node = SubElement(params_node, u'files')
-            for f in self.response_data['params'].get('files', []):
-                add_fso_node(files_node, f)
+            add_listing_nodes(params_node, self.response_data['params'])
 
         return root
 
@@ -149,14 +183,30 @@ class SearchResponse(GenericResponse):
             is_match_node = SubElement(params_node, u'is-match')
             is_match_node.text = is_match.lower()
 
-            dirs_node = SubElement(params_node, u'dirs')
-            for d in self.response_data['params']['dirs']:
-                add_fso_node(dirs_node, d)
+            add_listing_nodes(params_node, self.response_data['params'])
+
+        return root
 
-            files_node = SubElement(params_node, u'files')
-            for f in self.response_data['params']['files']:
-                add_fso_node(files_node, f)
 
+class AggregateResponse(GenericResponse):
+
+    def get_xml(self):
+        root = create_response_xml_root()
+        result_node = SubElement(root, u'result')
+        success_node = SubElement(result_node, u'success')
+        success = self.response_data['success']
+        success_node.text = to_unicode(success).lower()
+        if success:
+            params = self.response_data['params']
+            params_node = SubElement(result_node, u'params')
+            groups_node = SubElement(params_node, u'groups')
+            for group in params['groups']:
+                group_node = SubElement(groups_node, u'group')
+                for key in params['group_by'] + ['count', 'size']:
+                    key_node = SubElement(group_node, key)
+                    # entries without an extension are grouped under none
+                    if group[key] is not None:
+                        key_node.text = to_unicode(group[key])
         return root
 
 
@@ -191,6 +241,22 @@ class GetChangesResponse(GenericResponse):
         return root
 
 
+class BatchResponse(GenericResponse):
+
+    def get_xml(self):
+        root = create_response_xml_root()
+        result_node = SubElement(root, u'result')
+        success_node = SubElement(result_node, u'success')
+        success = self.response_data['success']
+        success_node.text = to_unicode(success).lower()
+        responses_node = SubElement(result_node, u'responses')
+        factory = CommandResponseFactory()
+        for result in self.response_data['params']['results']:
+            response = factory.create_response(result)
+            responses_node.append(response.get_xml())
+        return root
+
+
 class CommandResponseFactory:
     default_response_generator = GenericResponse
     response_map = {
@@ -199,8 +265,10 @@ class CommandResponseFactory:
         commandtypes.COMMAND_TYPE_LIST_DESCENDANTS: DirectoryListingResponse,
         commandtypes.COMMAND_TYPE_FILTER: DirectoryListingResponse,
         commandtypes.COMMAND_TYPE_SEARCH: SearchResponse,
+        commandtypes.COMMAND_TYPE_AGGREGATE: AggregateResponse,
         commandtypes.COMMAND_TYPE_GET_FSO: GetFSOResponse,
         commandtypes.COMMAND_TYPE_GET_CHANGES: GetChangesResponse,
+        commandtypes.COMMAND_TYPE_BATCH: BatchResponse,
     }
 
     def create_response(self, response_data):
@@ -211,3 +279,10 @@ class CommandResponseFactory:
             response_generator = self.default_response_generator
 
         return response_generator(response_data)
+
+    def create_busy_response(self, command_type):
+        return GenericResponse({
+            'type': command_type,
+            'success': bool_to_str(False),
+            'params': {'error': CommandBusyError.error_code},
+        })
@@ -18,6 +18,7 @@ monkey.patch_all(thread=False, aggressive=True)
 import os
 import sys
 import stat
+import time
 import socket
 import signal
 import logging
@@ -26,6 +27,7 @@ from contextlib import contextmanager
 from os.path import join, dirname, abspath, normpath
 
 import gevent
+import gevent.event
 
 import xml.etree.ElementTree as ET
 from gevent.server import StreamServer
@@ -33,8 +35,19 @@ from gevent.server import StreamServer
 from .xmlparser import parsestring
 from confloader import ConfDict
 from .handlers import CommandHandlerFactory
+from .cache import ResponseCache
+from .tree import IndexTree
+from .usage import StorageUsage
+from .throttle import IndexThrottle
+from .metrics import Metrics, PhaseTimer, StatsSnapshotter
+from .profiler import Profiler
+from .hubmonitor import HubMonitor
+from .executor import CommandExecutor
 from .responses import CommandResponseFactory
+from .exceptions import CommandBusyError
 from .fsdbmanager import FSDBManager
+from .workers import (ROLE_SINGLE, ROLE_INDEXER, ROLE_QUERY, Receiver,
+                      SharedCache, SharedTree, SharedUsage)
 from .db.databases import init_databases, close_databases
 
 
@@ -50,13 +63,6 @@ def in_pkg(*paths):
     return normpath(join(MODDIR, *paths))
 
 
-def consume_command_queue(command_queue):
-    while True:
-        command_handler = command_queue.get(block=True)
-        command_handler.do_command()
-        command_queue.task_done()
-
-
 class FSALServer(object):
     IN_ENCODING = 'ascii'
     OUT_ENCODING = 'utf-8'
@@ -64,10 +70,21 @@ class FSALServer(object):
     def __init__(self, config, context):
         self.socket_path = config['fsal.socket']
         self.server = None
+        self.cache = context['cache']
+        self.metrics = context['metrics']
+        self.profiler = context['profiler']
+        self.throttle = context['throttle']
         self.handler_factory = CommandHandlerFactory(context)
         self.response_factory = CommandResponseFactory()
+        self.executor = CommandExecutor(config, self.metrics)
+        context['executor'] = self.executor
 
-    def run(self):
+    def run(self, listener=None):
+        if listener is not None:
+            # listening socket shared with other query processes
+            self.server = StreamServer(listener, self.request_handler)
+            self.server.serve_forever()
+            return
         with self.open_socket() as sock:
             self.server = StreamServer(sock, self.request_handler)
             self.server.serve_forever()
@@ -77,26 +94,76 @@ class FSALServer(object):
             self.server.stop()
 
     def request_handler(self, sock, address):
+        metrics = self.metrics
+        phases = PhaseTimer(metrics, 'requests.')
+        handler = None
         try:
-            request_data = parsestring(self.read_request(sock)).request
+            request_str = self.read_request(sock)
+            phases.mark('receive')
+            request_data = parsestring(request_str).request
             command_data = request_data.command
             handler = self.handler_factory.create_handler(command_data)
+            phases.mark('parse')
             if handler.is_synchronous:
-                self.send_response(sock, handler.do_command())
+                metrics.incr('commands.' + handler.command_type)
+                try:
+                    with self.throttle.command(), self.profiler.profile(
+                            'command', handler.command_type):
+                        response_data = self.cache.fetch(
+                            handler, lambda: self.executor.execute(handler))
+                except CommandBusyError as e:
+                    self.reject(sock, handler, e)
+                else:
+                    phases.mark('execute')
+                    response = self.response_factory.create_response(
+                        response_data)
+                    response_str = self.serialize(response)
+                    phases.mark('serialize')
+                    sock.sendall(response_str)
+                    phases.mark('send')
+            else:
+                metrics.incr('commands.' + handler.command_type)
+                try:
+                    self.executor.submit(handler)
+                except CommandBusyError as e:
+                    self.reject(sock, handler, e)
         except socket.error as e:
+            metrics.incr('requests.errors')
             logging.exception("Unable to send command response: %s" % str(e))
         except Exception as e:
+            metrics.incr('requests.errors')
             logging.exception("Unexpected exception while handling command")
-
+        finally:
+            if handler is not None:
+                self.profiler.report('command', handler.command_type,
+                                     phases.total,
+                                     params=handler.command_data.params,
+                                     timings=phases.timings)
+
+    def reject(self, sock, handler, exc):
+        self.metrics.incr('requests.busy')
+        logging.warning('Rejecting "%s" command: %s', handler.command_type,
+                        str(exc))
+        response = self.response_factory.create_busy_response(
+            handler.command_type)
+        self.send_xml(sock, response)
 
     def send_response(self, sock, response_data):
         response = self.response_factory.create_response(response_data)
+        self.send_xml(sock, response)
+
+    def send_xml(self, sock, response):
+        sock.sendall(self.serialize(response))
+
+    @staticmethod
+    def serialize(response):
         response_str = response.get_xml_str(encoding=FSALServer.OUT_ENCODING)
         if not response_str[-1] == '\0':
             response_str += '\0'
-        sock.sendall(response_str)
+        return response_str
 
-    def prepare_socket(self, path):
+    @staticmethod
+    def prepare_socket(path):
         try:
             os.unlink(path)
         except OSError:
@@ -137,8 +204,11 @@ class FSALServer(object):
 
 def cleanup(context):
     try:
-        context['fs_manager'].stop()
-        context['server'].stop()
+        # processes of the multi-process mode run only some of the services
+        for name in ('hub_monitor', 'receiver', 'snapshotter', 'fs_manager',
+                     'server'):
+            if name in context:
+                context[name].stop()
         close_databases(context['databases'])
     except Exception as e:
         logging.exception("Exception while shutting down: {}".format(str(e)))
@@ -184,42 +254,123 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 sys.excepthook = handle_exception
 
 
-def main():
-    import argparse
-
-    parser = argparse.ArgumentParser(description='Start FSAL server')
-    parser.add_argument('--conf', metavar='PATH',
-                        help='Path to configuration file',
-                        default=in_pkg('fsal-server.ini'))
-    args, unknown = parser.parse_known_args()
-
-    config = ConfDict.from_file(args.conf, defaults=FSAL_DEFAULTS)
-
-    configure_logging(config)
-
+def create_context(config, role=ROLE_SINGLE, channel=None):
+    """
+    Start all services of a process with ``role``. Changes of the index are
+    passed on to peer processes through ``channel`` if specified.
+    """
     context = dict()
     context['config'] = config
+    context['role'] = role
     context['databases'] = init_databases(config)
+    context['metrics'] = Metrics(config)
+    context['profiler'] = Profiler(config)
+
+    hub_monitor = HubMonitor(config, context['metrics'])
+    hub_monitor.start()
+    context['hub_monitor'] = hub_monitor
+    cache = ResponseCache(config)
+    tree = IndexTree(config)
+    usage = StorageUsage()
+    if role == ROLE_INDEXER:
+        # the indexer serves no commands, it only passes its changes of the
+        # index on to the query processes
+        cache.enabled = tree.enabled = False
+    if channel is not None:
+        cache = SharedCache(config, cache, channel)
+        tree = SharedTree(config, tree, channel)
+        usage = SharedUsage(usage, channel)
+    context['cache'] = cache
+    context['tree'] = tree
+    context['usage'] = usage
+    context['throttle'] = IndexThrottle(config)
 
     fs_manager = FSDBManager(config, context)
     fs_manager.start()
     context['fs_manager'] = fs_manager
+    return context
 
+
+def run_server(config, context, listener=None, snapshots=True):
     server = FSALServer(config, context)
     context['server'] = server
 
+    if snapshots:
+        snapshotter = StatsSnapshotter(config, context)
+        snapshotter.start()
+        context['snapshotter'] = snapshotter
+
     def cleanup_wrapper(*args):
         cleanup(context)
 
     gevent.signal(signal.SIGINT, cleanup_wrapper)
     gevent.signal(signal.SIGTERM, cleanup_wrapper)
 
+    time_to_ready = time.time() - context['metrics'].started
+    context['metrics'].gauge('startup.time_to_ready', round(time_to_ready, 3))
+
     try:
         logging.info('FSAL server started.')
-        server.run()
+        server.run(listener)
     except KeyboardInterrupt:
         logging.info('Keyboard interrupt received. Shutting down.')
         cleanup(context)
 
+
+def run_indexer(config, channel):
+    """
+    Run the indexer process of the multi-process mode.
+    """
+    context = create_context(config, ROLE_INDEXER, channel)
+    stopped = gevent.event.Event()
+
+    def cleanup_wrapper(*args):
+        cleanup(context)
+        stopped.set()
+
+    gevent.signal(signal.SIGINT, cleanup_wrapper)
+    gevent.signal(signal.SIGTERM, cleanup_wrapper)
+    logging.info('FSAL indexer started.')
+    stopped.wait()
+
+
+def run_query_worker(config, channel, inbox, listener, snapshots):
+    """
+    Run a query process of the multi-process mode, which serves commands
+    received on ``listener`` and applies changes of the index made by other
+    processes, which it reads from the ``inbox`` pipe.
+    """
+    context = create_context(config, ROLE_QUERY, channel)
+    # changes made by peers are applied only locally
+    receiver = Receiver(inbox, context['tree'].local, context['cache'].local,
+                        context['usage'].local,
+                        reload_tree=context['fs_manager'].reload_tree)
+    receiver.start()
+    context['receiver'] = receiver
+    run_server(config, context, listener=listener, snapshots=snapshots)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Start FSAL server')
+    parser.add_argument('--conf', metavar='PATH',
+                        help='Path to configuration file',
+                        default=in_pkg('fsal-server.ini'))
+    args, unknown = parser.parse_known_args()
+
+    config = ConfDict.from_file(args.conf, defaults=FSAL_DEFAULTS)
+
+    configure_logging(config)
+
+    if config.get('workers.enabled', False):
+        # imported here, as the daemon module imports this one
+        from .daemon import ProcessGroup
+        ProcessGroup(config).run()
+        return
+
+    context = create_context(config)
+    run_server(config, context)
+
 if __name__ == '__main__':
     main()
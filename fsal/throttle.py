@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+throttle.py: prioritization of client commands over background indexing
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import time
+import contextlib
+
+import gevent
+
+from .metrics import Histogram
+
+
+#: Seconds the indexer sleeps between directories when not throttled
+DEFAULT_SLEEP = 0.01
+
+
+class IndexThrottle(object):
+    """
+    Tracks client commands and slows background indexing down while clients
+    are active, that is while any command is in flight or one finished less
+    than ``idle_after`` milliseconds ago. Active clients make the indexer
+    write smaller batches and sleep longer whenever it pauses, while an idle
+    server indexes at full speed.
+
+    To make the tradeoff measurable, the share of time indexing tasks spent
+    working rather than paused (the duty cycle) is reported, together with
+    latencies of client commands received while indexing was and was not
+    running.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get('throttle.enabled', True)
+        self.idle_after = config.get('throttle.idle_after', 500) / 1000.0
+        self.busy_sleep = config.get('throttle.busy_sleep', 50) / 1000.0
+        self.busy_batch_size = config.get('throttle.busy_batch_size', 20)
+        self.in_flight = 0
+        self.last_seen = 0.0
+        self.tasks = 0
+        self.task_time = 0.0
+        self.paused_time = 0.0
+        self.backoffs = 0
+        self.latency_idle = Histogram()
+        self.latency_indexing = Histogram()
+
+    @property
+    def busy(self):
+        """
+        Whether clients are active at the moment.
+        """
+        return (self.in_flight > 0 or
+                time.time() - self.last_seen < self.idle_after)
+
+    @contextlib.contextmanager
+    def command(self):
+        """
+        Mark the execution of a client command within the block.
+        """
+        indexing = self.tasks > 0
+        started = time.time()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.last_seen = now = time.time()
+            if indexing or self.tasks > 0:
+                self.latency_indexing.record(now - started)
+            else:
+                self.latency_idle.record(now - started)
+
+    @contextlib.contextmanager
+    def task(self):
+        """
+        Mark the execution of a background indexing task within the block.
+        """
+        started = time.time()
+        self.tasks += 1
+        try:
+            yield
+        finally:
+            self.tasks -= 1
+            self.task_time += time.time() - started
+
+    def batch_size(self, default):
+        """
+        Return the number of entries the indexer writes in its next batch.
+        """
+        if self.enabled and self.busy:
+            return min(default, self.busy_batch_size)
+        return default
+
+    def pause(self):
+        """
+        Yield to other greenlets between two units of indexing work, for as
+        long as the current client activity calls for.
+        """
+        if not self.enabled:
+            gevent.sleep(DEFAULT_SLEEP)
+            return
+        if not self.busy:
+            gevent.sleep(0)
+            return
+        started = time.time()
+        self.backoffs += 1
+        gevent.sleep(self.busy_sleep)
+        self.paused_time += time.time() - started
+
+    def get_stats(self):
+        if self.task_time:
+            duty_cycle = 1.0 - self.paused_time / self.task_time
+        else:
+            duty_cycle = 1.0
+        return {
+            'enabled': self.enabled,
+            'busy': self.busy,
+            'in_flight': self.in_flight,
+            'indexing': self.tasks > 0,
+            'task_time': round(self.task_time, 3),
+            'paused_time': round(self.paused_time, 3),
+            'duty_cycle': round(max(duty_cycle, 0.0), 3),
+            'backoffs': self.backoffs,
+            'latency': {
+                'idle': self.latency_idle.to_dict(),
+                'indexing': self.latency_indexing.to_dict(),
+            },
+        }
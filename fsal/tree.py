@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""
+tree.py: in-memory mirror of the index
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import sys
+import time
+import struct
+import logging
+import datetime
+import operator
+
+from .metrics import Histogram
+
+
+ROOT_PATH = '.'
+SEP = '/'
+# same as ``FSDBManager.DIR_TYPE``
+DIR_TYPE = 1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#: id, size, create and modify time in microseconds since epoch, and type
+RECORD = struct.Struct('=qqqqB')
+
+#: Upper bound of the number of distinct names kept in the intern table
+MAX_INTERNED = 100000
+
+
+def to_micros(dt):
+    delta = dt - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds)
+
+
+def from_micros(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def find_child(children, name):
+    """
+    Return the position of ``name`` within ``children`` sorted by name, or the
+    position it should be inserted at.
+    """
+    lo, hi = 0, len(children)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if children[mid].name < name:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Node(object):
+    """
+    Entry of the tree. Directories have a list of children sorted by name,
+    files have ``None`` instead. All numeric fields are packed into a single
+    ``record``, which is ``None`` for directories that have not been loaded
+    from the index (yet).
+    """
+
+    __slots__ = ('name', 'parent', 'base_path', 'record', 'children')
+
+    def __init__(self, name, parent, children=None):
+        self.name = name
+        self.parent = parent
+        self.base_path = None
+        self.record = None
+        self.children = children
+
+    def is_dir(self):
+        return self.children is not None
+
+    def child(self, name):
+        children = self.children
+        if not children:
+            return None
+        pos = find_child(children, name)
+        if pos < len(children) and children[pos].name == name:
+            return children[pos]
+        return None
+
+
+class IndexTree(object):
+    """
+    Mirror of the index table kept in memory, which serves lookups of single
+    entries and directory listings without querying the database.
+
+    The tree is loaded from the index once at startup, before any command is
+    accepted, and afterwards every write to the index is applied to it as
+    well. The database remains the durable store. When the two get out of
+    sync, the tree is disabled until it is loaded again.
+    """
+
+    def __init__(self, config):
+        self.enabled = config.get('tree.enabled', False)
+        self.ready = False
+        # whether the tree got out of sync since it was last loaded
+        self.stale = False
+        self.loaded = False
+        self.reloads = 0
+        self.root = None
+        self.names = dict()
+        self.names_size = 0
+        self.entries = 0
+        self.dirs = 0
+        self.load_time = 0.0
+        self.lookup_time = Histogram()
+        self.clear()
+        self.node_size = (sys.getsizeof(Node(u'', None)) +
+                          sys.getsizeof(RECORD.pack(0, 0, 0, 0, 0)))
+        self.dir_size = sys.getsizeof([])
+
+    def clear(self):
+        self.root = Node(ROOT_PATH, None, [])
+        self.root.record = RECORD.pack(0, 0, 0, 0, DIR_TYPE)
+        self.names.clear()
+        self.names_size = 0
+        self.entries = 0
+        self.dirs = 0
+
+    def disable(self):
+        """
+        Stop serving lookups, as the tree no longer mirrors the index.
+        """
+        if self.ready:
+            logging.error('Index tree is out of sync, disabling it')
+        self.ready = False
+        self.stale = True
+
+    def _intern(self, name):
+        interned = self.names.get(name)
+        if interned is not None:
+            return interned
+        if len(self.names) < MAX_INTERNED:
+            self.names[name] = name
+            self.names_size += sys.getsizeof(name)
+        return name
+
+    def load(self, rows):
+        """
+        Replace the contents of the tree with index ``rows``, which may come
+        in any order.
+        """
+        if not self.enabled:
+            return
+        start = time.time()
+        self.ready = False
+        self.stale = False
+        self.clear()
+        # directories by path, as children are sorted only once all of them
+        # are loaded
+        dirs = {ROOT_PATH: self.root}
+        for row in rows:
+            path = row['path']
+            if row['type'] == DIR_TYPE:
+                node = self._load_dir(dirs, path)
+            else:
+                (parent_path, _, name) = path.rpartition(SEP)
+                parent = self._load_dir(dirs, parent_path or ROOT_PATH)
+                node = Node(self._intern(name), parent)
+                parent.children.append(node)
+            self._set(node, row)
+        self._sort(self.root)
+        # rows may have been fetched while the tree got out of sync again
+        self.ready = not self.stale
+        self.load_time = time.time() - start
+        if self.loaded:
+            self.reloads += 1
+        self.loaded = True
+        logging.info('Index tree loaded with %d entries in %0.3f s',
+                     self.entries, self.load_time)
+
+    def _load_dir(self, dirs, path):
+        node = dirs.get(path)
+        if node is None:
+            (parent_path, _, name) = path.rpartition(SEP)
+            parent = self._load_dir(dirs, parent_path or ROOT_PATH)
+            node = Node(self._intern(name), parent, [])
+            parent.children.append(node)
+            dirs[path] = node
+        return node
+
+    def _sort(self, root):
+        key = operator.attrgetter('name')
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            node.children.sort(key=key)
+            stack.extend(n for n in node.children if n.children)
+
+    def _find(self, path):
+        node = self.root
+        if path == ROOT_PATH:
+            return node
+        for name in path.split(SEP):
+            node = node.child(name)
+            if node is None:
+                return None
+        return node
+
+    def _child(self, parent, name, is_dir):
+        """
+        Return the child ``name`` of ``parent``, creating it if needed.
+        """
+        children = parent.children
+        pos = find_child(children, name)
+        if pos < len(children) and children[pos].name == name:
+            return children[pos]
+        node = Node(self._intern(name), parent, [] if is_dir else None)
+        children.insert(pos, node)
+        return node
+
+    def get(self, path):
+        """
+        Return a row of the entry at ``path``, or ``None`` if it's not indexed.
+        """
+        start = time.time()
+        node = self._find(path)
+        self.lookup_time.record(time.time() - start)
+        if node is None or node.record is None:
+            return None
+        return self._row(node, path)
+
+    def list_dir(self, path):
+        """
+        Return rows of the indexed children of the directory at ``path``.
+        """
+        node = self._find(path)
+        if node is None or not node.children:
+            return []
+        prefix = '' if path == ROOT_PATH else path + SEP
+        return [self._row(child, prefix + child.name)
+                for child in node.children if child.record is not None]
+
+    def _row(self, node, path):
+        (id, size, ctime, mtime, type) = RECORD.unpack(node.record)
+        parent = node.parent
+        if parent is None or parent.record is None:
+            parent_id = 0
+        else:
+            parent_id = RECORD.unpack(parent.record)[0]
+        return {
+            'id': id,
+            'parent_id': parent_id,
+            'type': type,
+            'name': node.name,
+            'size': size,
+            'create_time': from_micros(ctime),
+            'modify_time': from_micros(mtime),
+            'path': path,
+            'base_path': node.base_path,
+        }
+
+    def put(self, row):
+        """
+        Add or update the entry described by index ``row``.
+        """
+        if not self.enabled:
+            return
+        names = row['path'].split(SEP)
+        parent = self.root
+        for name in names[:-1]:
+            parent = self._child(parent, name, True)
+            if parent.children is None:
+                # a file was replaced by a directory
+                parent.children = []
+        node = self._child(parent, names[-1], row['type'] == DIR_TYPE)
+        self._set(node, row)
+
+    def _set(self, node, row):
+        is_dir = row['type'] == DIR_TYPE
+        if node.record is None:
+            self.entries += 1
+            self.dirs += is_dir
+        else:
+            self.dirs += is_dir - node.is_dir()
+        if is_dir and node.children is None:
+            node.children = []
+        elif not is_dir and node.children is not None:
+            self._drop(node.children)
+            node.children = None
+        node.base_path = row['base_path']
+        node.record = RECORD.pack(row['id'], row['size'],
+                                  to_micros(row['create_time']),
+                                  to_micros(row['modify_time']),
+                                  row['type'])
+
+    def remove(self, path):
+        """
+        Remove the entry at ``path`` together with all of its descendants.
+        """
+        if not self.enabled:
+            return
+        node = self._find(path)
+        if node is None or node.parent is None:
+            return
+        siblings = node.parent.children
+        pos = find_child(siblings, node.name)
+        if pos < len(siblings) and siblings[pos] is node:
+            del siblings[pos]
+        self._drop([node])
+
+    def _drop(self, nodes):
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node.record is not None:
+                self.entries -= 1
+                self.dirs -= node.is_dir()
+            if node.children:
+                stack.extend(node.children)
+
+    def set_base_path(self, base_path, sources, roots=None):
+        """
+        Change the base path of entries stored in one of the ``sources`` base
+        paths to ``base_path``, only within the subtrees of ``roots`` if
+        specified.
+        """
+        if not self.enabled:
+            return
+        if roots is None:
+            stack = [self.root]
+        else:
+            stack = [n for n in map(self._find, roots) if n is not None]
+        while stack:
+            node = stack.pop()
+            if node.base_path in sources:
+                node.base_path = base_path
+            if node.children:
+                stack.extend(node.children)
+
+    def get_stats(self):
+        memory = (self.entries * self.node_size +
+                  self.dirs * self.dir_size +
+                  # a reference to each entry in its parent's children
+                  self.entries * struct.calcsize('P') +
+                  self.names_size)
+        return {
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'reloads': self.reloads,
+            'entries': self.entries,
+            'directories': self.dirs,
+            'interned_names': len(self.names),
+            'memory': memory,
+            'memory_per_entry': (memory // self.entries
+                                 if self.entries else 0),
+            'load_time': round(self.load_time, 3),
+            'lookup_time': self.lookup_time.to_dict(),
+        }
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+usage.py: per base path totals of the indexed storage
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+
+def empty_totals():
+    return dict(bytes=0, files=0, dirs=0)
+
+
+class StorageUsage(object):
+    """
+    Number of indexed files and directories, and the total size of the files,
+    under each base path. Totals are loaded from the index once, and kept up
+    to date by the write paths of the index, so they can be read without
+    touching the database or the storage.
+    """
+
+    def __init__(self):
+        self.totals = dict()
+
+    def add(self, base_path, is_dir, size, count=1):
+        """
+        Account for ``count`` entries of ``size`` bytes in total. Removed
+        entries are accounted for with negative values.
+        """
+        totals = self.totals.setdefault(base_path, empty_totals())
+        if is_dir:
+            totals['dirs'] += count
+        else:
+            totals['files'] += count
+            totals['bytes'] += size
+
+    def replace(self, totals, base_paths=None):
+        """
+        Replace the totals of ``base_paths``, or of all base paths if not
+        specified, with ``totals``.
+        """
+        if base_paths is None:
+            self.totals.clear()
+        for base_path in base_paths or ():
+            self.totals.pop(base_path, None)
+        for (base_path, values) in totals.items():
+            self.totals[base_path] = dict(values)
+
+    def clear(self):
+        self.totals.clear()
+
+    def get(self, base_path):
+        return dict(self.totals.get(base_path) or empty_totals())
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import functools
 import collections
@@ -81,6 +82,33 @@ def validate_path(base_path, path):
     return full_path.startswith(base_path), full_path
 
 
+DIGITS_RE = re.compile(r'(\d+)')
+
+
+def natural_key(name):
+    """
+    Return a key which sorts names case insensitively, and numbers within
+    them by their value, so ``file2`` comes before ``file10``.
+    """
+    parts = DIGITS_RE.split(name.lower())
+    # numbers are at odd indices, so only values of the same type compare
+    parts[1::2] = [int(p) for p in parts[1::2]]
+    return parts
+
+
+def disk_space(path):
+    """
+    Return a tuple of (capacity, free) bytes of the file system ``path`` is
+    on, where free bytes are those available to unprivileged users, or
+    ``None`` if ``path`` is not accessible.
+    """
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+    return (st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize)
+
+
 def lru_cache(maxsize=100):
     '''Least-recently-used cache decorator.
 
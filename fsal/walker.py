@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+"""
+walker.py: parallel walking of large directory trees
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import array
+import errno
+import signal
+import struct
+import marshal
+import logging
+import multiprocessing
+
+import gevent
+import gevent.queue
+from gevent.os import make_nonblocking, nb_read
+import scandir
+
+
+#: Length prefix of the frames written by walker processes
+FRAME = struct.Struct('=I')
+
+#: Typecodes of the packed columns of a batch: type, size, ctime and mtime
+TYPE_CODE = 'B'
+# 64 bit integers have no typecode on python 2, while doubles represent sizes
+# up to 8 PB exactly
+SIZE_CODE = 'd'
+TIME_CODE = 'd'
+
+#: Partitions created per walker process, so busy processes can be evened
+#: out by idle ones picking up the remaining partitions
+PARTITIONS_PER_PROCESS = 4
+
+#: Batches read ahead of the indexer per walker process. Once as many are
+#: waiting, walker processes are left to block on their full pipes, so the
+#: walk never runs far ahead of indexing
+BATCHES_PER_PROCESS = 2
+
+FILE_TYPE = 0
+DIR_TYPE = 1
+
+
+class PackedStat(object):
+    """
+    The fields of a stat result needed by the indexer.
+    """
+
+    __slots__ = ('st_size', 'st_ctime', 'st_mtime')
+
+    def __init__(self, size, ctime, mtime):
+        self.st_size = size
+        self.st_ctime = ctime
+        self.st_mtime = mtime
+
+
+class WalkedEntry(object):
+    """
+    Entry found by a walker process, which quacks like a ``scandir`` entry
+    and knows its path relative to the walked base path.
+    """
+
+    __slots__ = ('path', 'rel_path', '_is_dir', '_stat')
+
+    def __init__(self, path, rel_path, is_dir, stat):
+        self.path = path
+        self.rel_path = rel_path
+        self._is_dir = is_dir
+        self._stat = stat
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_symlink(self):
+        return False
+
+    def stat(self):
+        return self._stat
+
+
+def pack_batch(rel_paths, types, sizes, ctimes, mtimes):
+    return marshal.dumps((u'\0'.join(rel_paths).encode('utf-8'),
+                          types.tostring(), sizes.tostring(),
+                          ctimes.tostring(), mtimes.tostring()))
+
+
+def unpack_batch(data):
+    (paths, types, sizes, ctimes, mtimes) = marshal.loads(data)
+    columns = []
+    for (code, packed) in ((TYPE_CODE, types), (SIZE_CODE, sizes),
+                           (TIME_CODE, ctimes), (TIME_CODE, mtimes)):
+        column = array.array(code)
+        column.fromstring(packed)
+        columns.append(column)
+    return [paths.decode('utf-8').split(u'\0')] + columns
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def read_line(fd):
+    """
+    Read a single line from the blocking ``fd``, or return ``None`` when it
+    was closed.
+    """
+    chars = []
+    while True:
+        char = os.read(fd, 1)
+        if not char:
+            return None
+        if char == b'\n':
+            return b''.join(chars).decode('utf-8')
+        chars.append(char)
+
+
+def walk_partition(root, base_path, fn, out, batch_size):
+    """
+    Walk the subtree of ``root`` without its root, and write entries
+    accepted by ``fn`` to ``out`` in packed batches. Each directory comes
+    before its children.
+    """
+    prefix_len = len(base_path.rstrip(os.sep)) + 1
+    stack = [root]
+    batch = ([], array.array(TYPE_CODE), array.array(SIZE_CODE),
+             array.array(TIME_CODE), array.array(TIME_CODE))
+    while stack:
+        path = stack.pop()
+        try:
+            entries = scandir.scandir(path)
+            for entry in entries:
+                if not fn(entry):
+                    continue
+                is_dir = entry.is_dir()
+                if is_dir:
+                    stack.append(entry.path)
+                st = entry.stat()
+                batch[0].append(entry.path[prefix_len:])
+                batch[1].append(DIR_TYPE if is_dir else FILE_TYPE)
+                batch[2].append(st.st_size)
+                batch[3].append(st.st_ctime)
+                batch[4].append(st.st_mtime)
+                if len(batch[0]) >= batch_size:
+                    data = pack_batch(*batch)
+                    write_all(out, FRAME.pack(len(data)) + data)
+                    batch = ([], array.array(TYPE_CODE),
+                             array.array(SIZE_CODE), array.array(TIME_CODE),
+                             array.array(TIME_CODE))
+        except OSError as e:
+            # only the unreadable directory is skipped, not the whole walk
+            logging.error('Cannot walk "%s": %s', path, e)
+    if batch[0]:
+        data = pack_batch(*batch)
+        write_all(out, FRAME.pack(len(data)) + data)
+
+
+class WalkerProcess(object):
+    """
+    Forked process which walks the partitions it is sent, one per line on
+    its task pipe, and answers each with packed batches of entries followed
+    by an empty frame.
+    """
+
+    def __init__(self, base_path, fn, batch_size, siblings=()):
+        (task_in, self.tasks) = os.pipe()
+        (self.results, results_out) = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(self.tasks)
+            os.close(self.results)
+            for sibling in siblings:
+                # a copy of the task pipe of a sibling would keep it from
+                # ever seeing the pipe closed
+                os.close(sibling.tasks)
+                os.close(sibling.results)
+            self._serve(task_in, results_out, base_path, fn, batch_size)
+        os.close(task_in)
+        os.close(results_out)
+        make_nonblocking(self.results)
+
+    def _serve(self, tasks, results, base_path, fn, batch_size):
+        status = 0
+        try:
+            while True:
+                root = read_line(tasks)
+                if root is None:
+                    break
+                walk_partition(root, base_path, fn, results, batch_size)
+                write_all(results, FRAME.pack(0))
+        except Exception:
+            logging.exception('Unhandled exception in walker process')
+            status = 1
+        finally:
+            # the process must not run any of the greenlets of its parent
+            os._exit(status)
+
+    def send(self, root):
+        write_all(self.tasks, root.encode('utf-8') + b'\n')
+
+    def close(self, kill=False):
+        if self.tasks is not None:
+            os.close(self.tasks)
+            self.tasks = None
+        if kill:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        os.waitpid(self.pid, 0)
+        os.close(self.results)
+
+
+class ParallelWalker(object):
+    """
+    Walks large trees in a pool of forked processes, which take the per
+    entry overhead of the walk (``stat`` calls, checking entries against
+    the blacklist and relative path computation) off the indexer process.
+
+    The tree is split into partitions by walking it breadth first in the
+    indexer process, until there are several times more directories left
+    than processes. Each of those directories is a partition, which is
+    walked by the first idle process. Batches of found entries are packed
+    into a few flat arrays, and yielded in an order in which each directory
+    comes before its descendants.
+    """
+
+    def __init__(self, config):
+        processes = config.get('walker.processes', 0)
+        if processes < 0:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.batch_size = config.get('walker.batch_size', 1000)
+        self.walks = 0
+        self.partitions = 0
+
+    @property
+    def enabled(self):
+        return self.processes > 0
+
+    def walk(self, path, base_path, fn, pause=None):
+        """
+        Yield entries of the tree at ``path`` within ``base_path`` which are
+        accepted by ``fn``, including ``path`` itself, the same way
+        ``yielding_checked_fnwalk`` does. ``pause`` is called between units
+        of work.
+        """
+        pause = pause or (lambda: gevent.sleep(0))
+        self.walks += 1
+        (parent, name) = os.path.split(path)
+        entry = scandir.GenericDirEntry(parent, name)
+        if fn(entry):
+            yield entry
+        if not entry.is_dir():
+            return
+        partitions = [path]
+        target = self.processes * PARTITIONS_PER_PROCESS
+        while partitions and len(partitions) < target:
+            level = partitions
+            partitions = []
+            for path in level:
+                for entry in self._scan(path, fn):
+                    if entry.is_dir():
+                        partitions.append(entry.path)
+                    yield entry
+                pause()
+        if not partitions:
+            return
+        self.partitions += len(partitions)
+        for batch in self._walk_partitions(partitions, base_path, fn):
+            for entry in batch:
+                yield entry
+            pause()
+
+    def _scan(self, path, fn):
+        try:
+            return [e for e in scandir.scandir(path) if fn(e)]
+        except OSError as e:
+            logging.error('Cannot walk "%s": %s', path, e)
+            return []
+
+    def _walk_partitions(self, partitions, base_path, fn):
+        partitions = list(reversed(partitions))
+        count = min(self.processes, len(partitions))
+        processes = []
+        for _ in range(count):
+            processes.append(WalkerProcess(base_path, fn, self.batch_size,
+                                           siblings=processes))
+        batches = gevent.queue.Queue(maxsize=count * BATCHES_PER_PROCESS)
+        readers = [gevent.spawn(self._read, process, partitions, batches)
+                   for process in processes]
+        running = len(readers)
+        completed = False
+        try:
+            while running:
+                batch = batches.get()
+                if batch is None:
+                    running -= 1
+                    continue
+                yield self._entries(base_path, batch)
+            completed = True
+        finally:
+            gevent.killall(readers)
+            for process in processes:
+                process.close(kill=not completed)
+
+    def _read(self, process, partitions, batches):
+        """
+        Pass batches read from ``process`` on to ``batches``, sending the
+        process the next partition whenever it completes one.
+        """
+        abandoned = False
+        try:
+            process.send(partitions.pop())
+            pending = b''
+            while True:
+                data = nb_read(process.results, 65536)
+                if not data:
+                    logging.error('Walker process %d exited unexpectedly',
+                                  process.pid)
+                    return
+                pending += data
+                while len(pending) >= FRAME.size:
+                    (size,) = FRAME.unpack(pending[:FRAME.size])
+                    end = FRAME.size + size
+                    if len(pending) < end:
+                        break
+                    frame = pending[FRAME.size:end]
+                    pending = pending[end:]
+                    if frame:
+                        batches.put(unpack_batch(frame))
+                    elif partitions:
+                        process.send(partitions.pop())
+                    else:
+                        return
+        except gevent.GreenletExit:
+            abandoned = True
+            raise
+        finally:
+            # nobody reads the queue of an abandoned walk anymore
+            if not abandoned:
+                batches.put(None)
+
+    def _entries(self, base_path, batch):
+        (rel_paths, types, sizes, ctimes, mtimes) = batch
+        join = os.path.join
+        return [WalkedEntry(join(base_path, rel_path), rel_path,
+                            types[i] == DIR_TYPE,
+                            PackedStat(int(sizes[i]), ctimes[i], mtimes[i]))
+                for (i, rel_path) in enumerate(rel_paths)]
+
+    def get_stats(self):
+        return {
+            'processes': self.processes,
+            'walks': self.walks,
+            'partitions': self.partitions,
+        }
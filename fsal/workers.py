@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+workers.py: sharing of index changes between server processes
+
+Copyright 2014-2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import json
+import logging
+import os
+
+import gevent
+from gevent.os import make_nonblocking, nb_read, nb_write
+
+from .tree import to_micros, from_micros
+
+
+#: Everything runs in a single process
+ROLE_SINGLE = 'single'
+#: Process which indexes the storage and extracts bundles
+ROLE_INDEXER = 'indexer'
+#: Process which serves commands of clients
+ROLE_QUERY = 'query'
+
+#: Fields of index rows needed by the tree
+TREE_FIELDS = ('id', 'type', 'size', 'path', 'base_path')
+
+
+def encode_row(row):
+    data = dict((key, row[key]) for key in TREE_FIELDS)
+    data['create_time'] = to_micros(row['create_time'])
+    data['modify_time'] = to_micros(row['modify_time'])
+    return data
+
+
+def decode_row(data):
+    data['create_time'] = from_micros(data['create_time'])
+    data['modify_time'] = from_micros(data['modify_time'])
+    return data
+
+
+class Channel(object):
+    """
+    Write ends of the pipes of peer processes. Messages are sent to all peers
+    as JSON encoded lines. Writes to a full pipe wait cooperatively until the
+    peer reads from it. A peer whose pipe cannot be written to any more, e.g.
+    because it exited, is dropped from the channel.
+    """
+
+    def __init__(self, fds):
+        self.fds = list(fds)
+        for fd in self.fds:
+            make_nonblocking(fd)
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, kind, *args):
+        if not self.fds:
+            return
+        data = (json.dumps([kind] + list(args)) + '\n').encode('utf-8')
+        for fd in list(self.fds):
+            try:
+                written = 0
+                while written < len(data):
+                    written += nb_write(fd, data[written:])
+            except (OSError, IOError) as exc:
+                logging.error('Dropping peer of pipe %s: %s', fd, exc)
+                self._drop(fd)
+        self.sent += 1
+
+    def _drop(self, fd):
+        self.fds.remove(fd)
+        self.dropped += 1
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+class Receiver(object):
+    """
+    Applies changes of the index made by peer processes, which are read from
+    the pipe of this process, to the local tree, response cache and storage
+    usage totals. ``reload_tree`` is called to load the tree from the index
+    again, once a peer found it out of sync with the index.
+    """
+
+    def __init__(self, fd, tree, cache, usage, reload_tree=None):
+        self.fd = fd
+        self.tree = tree
+        self.cache = cache
+        self.usage = usage
+        self.reload_tree = reload_tree
+        self.received = 0
+        self._background = None
+
+    def start(self):
+        if self._background is not None:
+            return
+        make_nonblocking(self.fd)
+        self._background = gevent.spawn(self._receive)
+
+    def stop(self):
+        if self._background:
+            self._background.kill()
+            self._background = None
+
+    def _receive(self):
+        pending = b''
+        while True:
+            data = nb_read(self.fd, 65536)
+            if not data:
+                logging.error('Pipe of index changes was closed')
+                return
+            lines = (pending + data).split(b'\n')
+            # the last line is incomplete, or empty
+            pending = lines.pop()
+            for line in lines:
+                try:
+                    self.apply(*json.loads(line.decode('utf-8')))
+                except Exception:
+                    logging.exception('Cannot apply index change %r', line)
+                self.received += 1
+
+    def apply(self, kind, *args):
+        if kind == 'invalidate':
+            self.cache.invalidate(*args)
+        elif kind == 'put':
+            self.tree.put(decode_row(args[0]))
+        elif kind == 'remove':
+            self.tree.remove(*args)
+        elif kind == 'set_base_path':
+            self.tree.set_base_path(*args)
+        elif kind == 'clear':
+            self.tree.clear()
+        elif kind == 'disable':
+            self.tree.disable()
+        elif kind == 'reload':
+            if self.reload_tree is not None:
+                self.reload_tree()
+        elif kind == 'usage_add':
+            self.usage.add(*args)
+        elif kind == 'usage_replace':
+            self.usage.replace(*args)
+        elif kind == 'usage_clear':
+            self.usage.clear()
+        else:
+            logging.error('Unknown index change "%s"', kind)
+
+
+class Shared(object):
+    """
+    Wraps a component local to the process, passing all attribute accesses
+    through to it.
+    """
+
+    def __init__(self, local, channel, broadcast):
+        self.local = local
+        self.channel = channel
+        # whether peers keep the component enabled
+        self.broadcast = broadcast
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    def send(self, kind, *args):
+        if self.broadcast:
+            self.channel.send(kind, *args)
+
+
+class SharedCache(Shared):
+    """
+    Response cache whose invalidations are applied by peers as well.
+    """
+
+    def __init__(self, config, cache, channel):
+        super(SharedCache, self).__init__(
+            cache, channel, config.get('cache.enabled', True))
+
+    def invalidate(self, path):
+        self.local.invalidate(path)
+        self.send('invalidate', path)
+
+
+class SharedTree(Shared):
+    """
+    Index tree whose changes are applied by peers as well.
+    """
+
+    def __init__(self, config, tree, channel):
+        super(SharedTree, self).__init__(
+            tree, channel, config.get('tree.enabled', False))
+
+    def put(self, row):
+        self.local.put(row)
+        self.send('put', encode_row(row))
+
+    def remove(self, path):
+        self.local.remove(path)
+        self.send('remove', path)
+
+    def set_base_path(self, base_path, sources, roots=None):
+        self.local.set_base_path(base_path, sources, roots=roots)
+        self.send('set_base_path', base_path, list(sources), roots)
+
+    def clear(self):
+        self.local.clear()
+        self.send('clear')
+
+    def disable(self):
+        self.local.disable()
+        self.send('disable')
+
+    def reload(self):
+        """
+        Have peers load their trees from the index again.
+        """
+        self.send('reload')
+
+
+class SharedUsage(Shared):
+    """
+    Storage usage totals whose changes are applied by peers as well.
+    """
+
+    def __init__(self, usage, channel):
+        super(SharedUsage, self).__init__(usage, channel, True)
+
+    def add(self, base_path, is_dir, size, count=1):
+        self.local.add(base_path, is_dir, size, count)
+        self.send('usage_add', base_path, is_dir, size, count)
+
+    def replace(self, totals, base_paths=None):
+        self.local.replace(totals, base_paths)
+        self.send('usage_replace', totals,
+                  None if base_paths is None else list(base_paths))
+
+    def clear(self):
+        self.local.clear()
+        self.send('usage_clear')
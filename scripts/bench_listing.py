@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark of turning index rows into a listing response.
+
+Generates N index rows the way the database returns them, and measures
+how long it takes to turn them into listed entries with
+``FSDBManager._row_iterator``, how many objects are allocated and how much
+memory they take per entry, and how long it takes to serialize them into a
+``list_descendants`` response, for each of the given ``fields`` projections.
+Rows of a projection only have its columns. No database is involved.
+"""
+
+from __future__ import print_function
+
+import gc
+import time
+import random
+import argparse
+import datetime
+
+from fsal import commandtypes
+from fsal.fs import FIELDS_ALL, FIELDS_PATHS, FIELDS_SIZES
+from fsal.cache import estimate_size
+from fsal.fsdbmanager import FSDBManager
+from fsal.responses import CommandResponseFactory
+
+
+def make_rows(count):
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(count):
+        is_dir = i % 10 == 0
+        time = now - datetime.timedelta(seconds=random.randint(0, 10 ** 7))
+        rows.append({
+            'id': i + 1,
+            'parent_id': i // 10,
+            'type': FSDBManager.DIR_TYPE if is_dir else FSDBManager.FILE_TYPE,
+            'name': u'entry{}'.format(i),
+            'size': 0 if is_dir else random.randint(0, 10 ** 9),
+            'create_time': time,
+            'modify_time': time,
+            'path': u'dir{}/sub{}/entry{}'.format(i // 1000, i // 10, i),
+            'base_path': u'/mnt/external',
+        })
+    return rows
+
+
+def project(rows, fields):
+    columns = FSDBManager.PROJECTIONS.get(fields)
+    if columns is None:
+        return rows
+    return [dict((c, row[c]) for c in columns) for row in rows]
+
+
+def run(fs_mgr, rows, fields):
+    gc.collect()
+    gc.disable()
+    objects = len(gc.get_objects())
+    start = time.time()
+    entries = list(fs_mgr._row_iterator(rows, fields))
+    duration = time.time() - start
+    objects = len(gc.get_objects()) - objects
+    gc.enable()
+    size = estimate_size(entries) - estimate_size([None] * len(entries))
+    print('{:<6} construct entries={} time={:0.3f}s ({:0.1f} entries/s) '
+          'tracked objects/entry={:0.2f} bytes/entry={}'.format(
+              fields, len(entries), duration, len(entries) / duration,
+              float(objects) / len(entries), size // len(entries)))
+
+    data = {
+        'type': commandtypes.COMMAND_TYPE_LIST_DESCENDANTS,
+        'success': True,
+        'params': {
+            'fields': fields,
+            'dirs': [e for e in entries if e.is_dir()],
+            'files': [e for e in entries if e.is_file()],
+        },
+    }
+    start = time.time()
+    response = CommandResponseFactory().create_response(data)
+    xml = response.get_xml_str()
+    duration = time.time() - start
+    print('{:<6} serialize entries={} time={:0.3f}s ({:0.1f} entries/s) '
+          'bytes={}'.format(fields, len(entries), duration,
+                            len(entries) / duration, len(xml)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--entries', metavar='N', type=int, default=100000,
+                        help='number of listed entries')
+    parser.add_argument('--fields', metavar='FIELDS', nargs='+',
+                        default=[FIELDS_ALL, FIELDS_PATHS, FIELDS_SIZES],
+                        help='listing projections to measure')
+    args = parser.parse_args()
+
+    random.seed(0)
+    rows = make_rows(args.entries)
+    # only the parts of the manager used by the row iterator
+    fs_mgr = FSDBManager.__new__(FSDBManager)
+    fs_mgr.whitelist = []
+
+    for fields in args.fields:
+        run(fs_mgr, project(rows, fields), fields)
+
+
+if __name__ == '__main__':
+    main()
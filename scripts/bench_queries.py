@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark of the hot index queries.
+
+Indexes TREE into a scratch database and then measures the per-call latency
+of looking up the indexed entries by path, both through the query builder and
+through the prepared statement used by ``FSDBManager.get_fso``, and of name
+searches. Run it once per storage backend to compare them.
+
+The postgres backend requires a running server configured in the [database]
+section of the configuration file. The configured database is emptied on
+every run, so point --conf at a configuration of a scratch database.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import random
+import argparse
+
+from fsal.server import FSAL_DEFAULTS, in_pkg
+from fsal.cache import ResponseCache
+from fsal.metrics import Histogram, Metrics
+from fsal.profiler import Profiler
+from fsal.fsdbmanager import FSDBManager
+from fsal.db.databases import init_databases, close_databases
+
+from confloader import ConfDict
+
+
+def report(name, histogram):
+    stats = histogram.to_dict()
+    print('{:<12} calls={count} avg={avg}ms p50={p50}ms p95={p95}ms '
+          'p99={p99}ms'.format(name, **stats))
+
+
+def bench_get_fso(fs_mgr, paths, calls):
+    db = fs_mgr.db
+    builder = Histogram()
+    prepared = Histogram()
+    for _ in range(calls):
+        path = random.choice(paths)
+        start = time.time()
+        q = db.Select('*', sets=fs_mgr.FS_TABLE, where='path = %s')
+        db.fetchone(q, (path,))
+        builder.record(time.time() - start)
+        start = time.time()
+        db.fetchone_prepared(fs_mgr.GET_FSO_STMT, {'path': path})
+        prepared.record(time.time() - start)
+    report('builder', builder)
+    report('prepared', prepared)
+
+
+def bench_search(fs_mgr, paths, calls):
+    search = Histogram()
+    for _ in range(calls):
+        name = os.path.basename(random.choice(paths))
+        # search for a part of the name, as users usually do
+        word = name[:max(3, len(name) // 2)]
+        start = time.time()
+        list(fs_mgr.search(word)[1])
+        search.record(time.time() - start)
+    report('search', search)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('tree', metavar='TREE',
+                        help='directory to index (see rnd_tree.sh)')
+    parser.add_argument('--conf', metavar='PATH',
+                        default=in_pkg('fsal-server.ini'),
+                        help='path to configuration file')
+    parser.add_argument('--backend', choices=('postgres', 'sqlite'),
+                        default='postgres', help='storage backend')
+    parser.add_argument('--path', metavar='PATH', default='/tmp',
+                        help='directory of the sqlite database file')
+    parser.add_argument('--calls', metavar='N', type=int, default=10000,
+                        help='number of get_fso calls')
+    parser.add_argument('--searches', metavar='N', type=int, default=200,
+                        help='number of search calls')
+    args = parser.parse_args()
+
+    config = ConfDict.from_file(args.conf, defaults=FSAL_DEFAULTS)
+    config['database.backend'] = args.backend
+    config['database.path'] = args.path
+    config['fsal.basepaths'] = [args.tree]
+    config['cache.enabled'] = False
+    context = dict(config=config)
+    context['databases'] = init_databases(config)
+    context['metrics'] = Metrics(config)
+    context['profiler'] = Profiler(config)
+    context['cache'] = ResponseCache(config)
+    fs_mgr = FSDBManager(config, context)
+    try:
+        fs_mgr._clear_db()
+        start = time.time()
+        fs_mgr._update_db()
+        duration = time.time() - start
+        q = fs_mgr.db.Select('path', sets=fs_mgr.FS_TABLE)
+        paths = [row['path'] for row in fs_mgr.db.fetchall(q)]
+        print('indexed {} entries in {:0.3f}s ({:0.1f} entries/s)'.format(
+            len(paths), duration, len(paths) / duration))
+        if paths:
+            bench_get_fso(fs_mgr, paths, args.calls)
+            bench_search(fs_mgr, paths, args.searches)
+    finally:
+        close_databases(context['databases'])
+
+
+if __name__ == '__main__':
+    main()
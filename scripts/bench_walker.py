@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Benchmark of the serial and parallel directory walkers.
+
+Walks TREE with ``yielding_checked_fnwalk``, which the indexer uses by
+default, and with ``ParallelWalker`` for each of the given numbers of
+processes. Every walked entry is turned into an ``FSObject`` the way the
+indexer does it, so the per-entry overhead which the walker processes take
+off the indexer is part of the measurement, while the database is not
+touched at all.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import argparse
+
+import gevent
+
+from fsal.fs import File, Directory
+from fsal.fsdbmanager import yielding_checked_fnwalk
+from fsal.walker import ParallelWalker, WalkedEntry
+
+
+def accept(entry):
+    return not entry.is_symlink()
+
+
+def consume(base_path, walker):
+    paths = set()
+    for entry in walker:
+        if isinstance(entry, WalkedEntry):
+            rel_path = entry.rel_path
+        else:
+            rel_path = os.path.relpath(entry.path, base_path)
+        cls = Directory if entry.is_dir() else File
+        cls.from_stat(base_path, rel_path, entry.stat())
+        paths.add(rel_path)
+    return paths
+
+
+def report(name, paths, duration):
+    print('{:<12} entries={} time={:0.3f}s ({:0.1f} entries/s)'.format(
+        name, len(paths), duration, len(paths) / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('tree', metavar='TREE',
+                        help='directory to walk (see rnd_tree.sh)')
+    parser.add_argument('--processes', metavar='N', type=int, nargs='+',
+                        default=[2, 4], help='numbers of walker processes')
+    parser.add_argument('--batch-size', metavar='N', type=int, default=1000,
+                        help='number of entries passed on at once')
+    args = parser.parse_args()
+
+    base_path = os.path.abspath(args.tree).decode('utf-8')
+    pause = lambda: gevent.sleep(0)
+
+    start = time.time()
+    expected = consume(base_path,
+                       yielding_checked_fnwalk(base_path, accept, pause=pause))
+    report('serial', expected, time.time() - start)
+
+    for processes in args.processes:
+        walker = ParallelWalker({'walker.processes': processes,
+                                 'walker.batch_size': args.batch_size})
+        start = time.time()
+        paths = consume(base_path,
+                        walker.walk(base_path, base_path, accept, pause=pause))
+        report('parallel:{}'.format(processes), paths, time.time() - start)
+        if paths != expected:
+            print('  walked {} entries less and {} more than the serial '
+                  'walker'.format(len(expected - paths),
+                                  len(paths - expected)))
+
+
+if __name__ == '__main__':
+    main()
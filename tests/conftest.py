@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from confloader import ConfDict
+
+from fsal.server import FSAL_DEFAULTS, in_pkg
+from fsal.cache import ResponseCache
+from fsal.metrics import Metrics
+from fsal.profiler import Profiler
+from fsal.fsdbmanager import FSDBManager
+from fsal.db.databases import init_databases, close_databases
+
+
+#: Files of the storage tree indexed by ``fs_manager``, with their contents
+FILES = {
+    'docs/readme.txt': 'read me',
+    'docs/notes/a.md': 'aaaa',
+    'docs/notes/b.md': 'bb',
+    'music/song.mp3': 'x' * 100,
+    'top.txt': 'top',
+}
+
+
+def write_file(base_path, path, content):
+    full_path = os.path.join(base_path, path)
+    parent = os.path.dirname(full_path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(full_path, 'w') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def base_path(tmpdir):
+    path = str(tmpdir.mkdir('storage'))
+    for (rel_path, content) in FILES.items():
+        write_file(path, rel_path, content)
+    return path
+
+
+@pytest.fixture
+def config(base_path):
+    config = ConfDict.from_file(in_pkg('fsal-server.ini'),
+                                defaults=FSAL_DEFAULTS)
+    config['database.backend'] = 'sqlite'
+    config['database.path'] = ':memory:'
+    config['fsal.basepaths'] = [base_path]
+    config['bundles.bundles_dir'] = 'bundles'
+    return config
+
+
+@pytest.fixture
+def context(config):
+    context = dict(config=config)
+    context['databases'] = init_databases(config)
+    context['metrics'] = Metrics(config)
+    context['profiler'] = Profiler(config)
+    context['cache'] = ResponseCache(config)
+    yield context
+    close_databases(context['databases'])
+
+
+class ScheduleRecorder(object):
+    """
+    Stands in for the task scheduler, and records the scheduled functions
+    instead of running them in the background.
+    """
+
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, fn):
+        self.scheduled.append(fn)
+
+    def run(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+
+@pytest.fixture
+def fs_manager(config, context):
+    """
+    Manager of an index of :py:data:`FILES` in an in-memory SQLite database,
+    whose background work is recorded in ``scheduler.scheduled``, and left
+    in ``planner.pending`` in case of planned tasks.
+    """
+    manager = FSDBManager(config, context)
+    manager._update_db()
+    manager.scheduler = manager.planner.scheduler = ScheduleRecorder()
+    # start from an empty event queue
+    manager.event_queue.delitems(len(manager.event_queue.getitems(1000)))
+    return manager
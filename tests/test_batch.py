@@ -0,0 +1,171 @@
+import contextlib
+import datetime
+
+import pytest
+
+from fsal import client, handlers, responses, xmlparser
+from fsal.executor import CHEAP_READ, MUTATING
+from fsal.exceptions import FSALError, CommandBusyError
+from fsal.fs import File
+
+
+class FakeManager(object):
+    """
+    Stands in for the index behind the handlers of batched commands.
+    """
+
+    def __init__(self):
+        self.snapshots = 0
+        self.removed = []
+
+    @contextlib.contextmanager
+    def read_snapshot(self):
+        self.snapshots += 1
+        yield
+
+    def get_fso(self, path):
+        if path == 'missing':
+            return None
+        modified = datetime.datetime(2020, 1, 1)
+        return File('/mnt/data', path, modified, modified, 10)
+
+    def is_dir(self, path):
+        if path == 'broken':
+            raise RuntimeError('index is gone')
+        return path == 'dir'
+
+    def remove(self, path):
+        self.removed.append(path)
+        return (True, None)
+
+
+class LocalFSAL(client.FSAL):
+    """
+    Client which hands requests straight to the server side handlers.
+    """
+
+    def __init__(self, manager):
+        super(LocalFSAL, self).__init__(None)
+        self.factory = handlers.CommandHandlerFactory(
+            {'fs_manager': manager})
+        self.handlers = []
+
+    def _send_request(self, message):
+        request = xmlparser.parsestring(message.decode('utf8')).request
+        handler = self.factory.create_handler(request.command)
+        self.handlers.append(handler)
+        response_factory = responses.CommandResponseFactory()
+        return response_factory.create_response(
+            handler.do_command()).get_xml_str()
+
+
+@pytest.fixture
+def manager():
+    return FakeManager()
+
+
+@pytest.fixture
+def fsal(manager):
+    return LocalFSAL(manager)
+
+
+def test_results_in_invocation_order(fsal):
+    with fsal.batch() as batch:
+        found = batch.get_fso('a/b.txt')
+        missing = batch.get_fso('missing')
+        isdir = batch.isdir('dir')
+    (success, fso) = found.value
+    assert success
+    assert fso.rel_path == 'a/b.txt'
+    assert missing.value == (False, 'does_not_exist')
+    assert isdir.value is True
+    assert batch.results == [found.value, missing.value, isdir.value]
+    # everything was sent in a single request
+    assert len(fsal.handlers) == 1
+
+
+def test_failed_command_maps_to_error(fsal):
+    with fsal.batch() as batch:
+        broken = batch.isdir('broken')
+        isdir = batch.isdir('dir')
+    assert broken.error == 'isdir: internal_error'
+    with pytest.raises(FSALError):
+        broken.value
+    # the other commands are not affected
+    assert isdir.value is True
+
+
+def test_value_before_execute():
+    result = client.BatchResult()
+    with pytest.raises(RuntimeError):
+        result.value
+
+
+def test_unbatchable_method(fsal):
+    batch = client.CommandBatch(fsal)
+    with pytest.raises(AttributeError):
+        batch.get_changes
+
+
+def test_empty_batch_sends_nothing(fsal):
+    with fsal.batch():
+        pass
+    assert fsal.handlers == []
+
+
+def test_read_only_batch_uses_snapshot(fsal, manager):
+    with fsal.batch() as batch:
+        batch.get_fso('a')
+        batch.isdir('dir')
+    (handler,) = fsal.handlers
+    assert handler.command_class == CHEAP_READ
+    assert manager.snapshots == 1
+
+
+class RecordingCache(object):
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, handler, fn):
+        self.fetched.append(handler.command_type)
+        return fn()
+
+
+def test_read_only_batch_bypasses_cache(fsal):
+    fsal.factory.context['cache'] = cache = RecordingCache()
+    with fsal.batch() as batch:
+        found = batch.get_fso('a')
+    assert found.value[0] is True
+    # results of the snapshot may be older than the cached ones
+    assert cache.fetched == []
+    with fsal.batch() as batch:
+        batch.get_fso('a')
+        batch.remove('a')
+    assert cache.fetched == ['get_fso', 'remove']
+
+
+def test_batch_takes_class_of_most_expensive_command(fsal, manager):
+    with fsal.batch() as batch:
+        batch.get_fso('a')
+        removed = batch.remove('a')
+    (handler,) = fsal.handlers
+    assert handler.command_class == MUTATING
+    assert manager.snapshots == 0
+    assert removed.value[0] is True
+    assert manager.removed == ['a']
+
+
+def test_busy_batch(fsal):
+    class BusyFSAL(LocalFSAL):
+        def _send_request(self, message):
+            response_factory = responses.CommandResponseFactory()
+            return response_factory.create_busy_response(
+                'batch').get_xml_str()
+
+    busy = BusyFSAL(FakeManager())
+    batch = client.CommandBatch(busy)
+    result = batch.get_fso('a')
+    with pytest.raises(CommandBusyError):
+        batch.execute()
+    assert not result.done
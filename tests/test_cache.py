@@ -0,0 +1,154 @@
+import pytest
+
+from fsal.cache import ResponseCache
+
+
+class Handler(object):
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key or ('listing', path)
+
+    def cache_key(self):
+        return self.key
+
+    def cache_path(self):
+        return self.path
+
+
+class Counter(object):
+    """
+    Command body which returns how many times it was executed.
+    """
+
+    def __init__(self, on_execute=None):
+        self.calls = 0
+        self.on_execute = on_execute
+
+    def __call__(self):
+        self.calls += 1
+        if self.on_execute:
+            self.on_execute()
+        return self.calls
+
+
+@pytest.fixture
+def cache():
+    return ResponseCache({})
+
+
+def test_hit_after_miss(cache):
+    execute = Counter()
+    handler = Handler('a/b')
+    assert cache.fetch(handler, execute) == 1
+    assert cache.fetch(handler, execute) == 1
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_uncacheable_command(cache):
+    class Uncached(Handler):
+        def cache_key(self):
+            return None
+
+    execute = Counter()
+    cache.fetch(Uncached('a'), execute)
+    cache.fetch(Uncached('a'), execute)
+    assert execute.calls == 2
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_disabled_cache():
+    cache = ResponseCache({'cache.enabled': False})
+    execute = Counter()
+    cache.fetch(Handler('a'), execute)
+    cache.fetch(Handler('a'), execute)
+    assert execute.calls == 2
+
+
+@pytest.mark.parametrize('changed,cached,fresh', [
+    # change within the subtree of the cached path
+    ('a/b/c', 'a/b', False),
+    ('a/b', 'a/b', False),
+    # the cached path itself is replaced along with an ancestor
+    ('a', 'a/b', False),
+    ('.', 'a/b', False),
+    # unrelated subtrees
+    ('a/x', 'a/b', True),
+    ('b', 'a/b', True),
+    ('a/bc', 'a/b', True),
+])
+def test_invalidation_by_path(cache, changed, cached, fresh):
+    execute = Counter()
+    handler = Handler(cached)
+    cache.fetch(handler, execute)
+    cache.invalidate(changed)
+    cache.fetch(handler, execute)
+    assert (execute.calls == 1) == fresh
+
+
+def test_change_while_executing(cache):
+    handler = Handler('a')
+    execute = Counter(on_execute=lambda: cache.invalidate('a/b'))
+    cache.fetch(handler, execute)
+    # the stored result may not include the change, so it is not served
+    cache.fetch(handler, execute)
+    assert execute.calls == 2
+    assert cache.get_stats()['invalidations'] == 1
+
+
+def test_generations_reset():
+    cache = ResponseCache({'cache.max_generations': 4})
+    execute = Counter()
+    handler = Handler('x')
+    cache.fetch(handler, execute)
+    # the root, a and three of its children
+    for i in range(3):
+        cache.invalidate('a/{}'.format(i))
+    stats = cache.get_stats()
+    assert stats['resets'] == 1
+    assert stats['entries'] == 0
+    assert cache.subtree_gens == {}
+    assert cache.floor == cache.clock
+    # unrelated results are recomputed after a reset, and cached again
+    assert cache.fetch(handler, execute) == 2
+    assert cache.fetch(handler, execute) == 2
+
+
+def test_reset_rejects_results_in_progress():
+    cache = ResponseCache({'cache.max_generations': 1})
+
+    def change():
+        # overflows the generations and resets the cache
+        cache.invalidate('a/b')
+
+    execute = Counter(on_execute=change)
+    handler = Handler('x')
+    cache.fetch(handler, execute)
+    assert cache.get_stats()['resets'] == 1
+    # stamped before the floor, so the stored result is stale
+    assert not cache.is_fresh('x', cache.floor - 1)
+    cache.fetch(handler, execute)
+    assert execute.calls == 2
+
+
+def test_lru_eviction():
+    cache = ResponseCache({'cache.max_size': 4096})
+    execute = Counter()
+    handlers = [Handler('dir{}'.format(i)) for i in range(64)]
+    for handler in handlers:
+        cache.fetch(handler, execute)
+    stats = cache.get_stats()
+    assert stats['evictions'] > 0
+    assert stats['size'] <= stats['max_size']
+    # the most recently used result is still there
+    cache.fetch(handlers[-1], execute)
+    assert execute.calls == len(handlers)
+
+
+def test_oversized_result_not_cached():
+    cache = ResponseCache({'cache.max_size': 1024})
+    handler = Handler('a')
+    big = ['x' * 64] * 64
+    cache.fetch(handler, lambda: big)
+    assert cache.get_stats()['entries'] == 0
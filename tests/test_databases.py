@@ -0,0 +1,147 @@
+import gevent
+import pytest
+
+from fsal.db.databases import (GreenConnectionPool, GreenDatabase,
+                               PreparedStatement, MIN_POOL_SIZE)
+from fsal.fsdbmanager import FSDBManager
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append(sql)
+
+    def executemany(self, sql, params):
+        self.conn.statements.append(sql)
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self):
+        return []
+
+
+class FakeConnection(object):
+    """
+    Records the statements executed on it and how they were ended.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+        self.isolation_level = None
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool():
+    return GreenConnectionPool(maxsize=2, connect=FakeConnection)
+
+
+def test_transaction_pins_connection(pool):
+    with pool.transaction() as cursor:
+        conn = cursor.conn
+        pool.execute('SELECT 1;')
+        pool.execute('SELECT 2;')
+        # committed once the transaction ends, not after each statement
+        assert conn.commits == 0
+    assert conn.statements == ['SELECT 1;', 'SELECT 2;']
+    assert conn.commits == 1
+
+
+def test_nested_transactions_are_merged(pool):
+    with pool.transaction() as outer:
+        with pool.transaction() as inner:
+            assert inner.conn is outer.conn
+        assert outer.conn.commits == 0
+    assert outer.conn.commits == 1
+
+
+def test_other_greenlets_use_other_connections(pool):
+    def statement():
+        with pool.connection() as conn:
+            conn.cursor().execute('SELECT 2;')
+            return conn
+
+    with pool.transaction() as cursor:
+        other = gevent.spawn(statement).get()
+        assert other is not cursor.conn
+    assert cursor.conn.statements == []
+
+
+def test_failed_transaction_is_rolled_back(pool):
+    with pytest.raises(ValueError):
+        with pool.transaction() as cursor:
+            pool.execute('DELETE FROM fsentries;')
+            raise ValueError()
+    assert (cursor.conn.commits, cursor.conn.rollbacks) == (0, 1)
+    # the connection is no longer pinned
+    with pool.connection() as conn:
+        assert conn is cursor.conn
+
+
+@pytest.mark.parametrize('maxsize', range(MIN_POOL_SIZE))
+def test_pools_need_two_connections(maxsize):
+    with pytest.raises(ValueError):
+        GreenDatabase.connect('localhost', 5432, 'fs', 'postgres', None,
+                              maxsize)
+
+
+def test_prepared_statement_sql():
+    statement = PreparedStatement(
+        'get_fso', 'SELECT * FROM fsentries WHERE path = $1', ['path'])
+    assert statement.prepare_sql == (
+        'PREPARE get_fso AS SELECT * FROM fsentries WHERE path = $1;')
+    assert statement.execute_sql == 'EXECUTE get_fso(%(path)s);'
+
+
+def test_statements_are_prepared_once_per_connection(pool):
+    db = GreenDatabase(pool, {})
+    statement = FSDBManager.GET_FSO_STMT
+    with pool.transaction() as cursor:
+        db.fetchone_prepared(statement, {'path': 'a'})
+        db.fetchone_prepared(statement, {'path': 'b'})
+    assert cursor.conn.statements == [statement.prepare_sql,
+                                      statement.execute_sql,
+                                      statement.execute_sql]
+
+    def other_connection():
+        with pool.transaction() as other:
+            db.fetchone_prepared(statement, {'path': 'c'})
+            return other.conn
+
+    # prepared again on the second connection of the pool
+    with pool.transaction():
+        other = gevent.spawn(other_connection).get()
+    assert other.statements == [statement.prepare_sql, statement.execute_sql]
+
+
+def test_prepared_statements_survive_rollback(pool):
+    db = GreenDatabase(pool, {})
+    statement = FSDBManager.GET_FSO_STMT
+    with pytest.raises(ValueError):
+        with pool.transaction() as cursor:
+            db.fetchone_prepared(statement, {'path': 'a'})
+            raise ValueError()
+    db.fetchone_prepared(statement, {'path': 'a'})
+    assert cursor.conn.statements.count(statement.prepare_sql) == 1
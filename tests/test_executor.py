@@ -0,0 +1,125 @@
+import gevent
+import pytest
+
+from fsal import handlers
+from fsal.executor import (CommandExecutor, CommandPool, CHEAP_READ,
+                           HEAVY_READ, CONTROL, MUTATING)
+from fsal.exceptions import CommandBusyError
+from fsal.metrics import Metrics
+
+
+class SleepingHandler(object):
+    command_type = 'sleep'
+
+    def __init__(self, command_class=MUTATING, seconds=0.01):
+        self.command_class = command_class
+        self.seconds = seconds
+        self.done = False
+
+    def do_command(self):
+        gevent.sleep(self.seconds)
+        self.done = True
+        return self.command_class
+
+
+def make_pool(concurrency=1, max_queue=1):
+    return CommandPool('test', concurrency, max_queue, Metrics({}))
+
+
+def test_pool_runs_handler():
+    pool = make_pool()
+    handler = SleepingHandler()
+    assert pool.run(handler) == MUTATING
+    assert handler.done
+    stats = pool.get_stats()
+    assert stats['active'] == 0
+    assert stats['waiting'] == 0
+    assert stats['run_time']['count'] == 1
+
+
+def test_pool_rejects_over_queue():
+    pool = make_pool(concurrency=1, max_queue=1)
+    running = gevent.spawn(pool.run, SleepingHandler(seconds=0.05))
+    queued = gevent.spawn(pool.run, SleepingHandler(seconds=0.05))
+    gevent.sleep(0)
+    with pytest.raises(CommandBusyError):
+        pool.run(SleepingHandler())
+    gevent.joinall([running, queued])
+    assert pool.get_stats()['rejected'] == 1
+
+
+def test_executor_routes_by_class():
+    executor = CommandExecutor({}, Metrics({}))
+    for command_class in (CHEAP_READ, HEAVY_READ, CONTROL, MUTATING):
+        executor.execute(SleepingHandler(command_class, seconds=0))
+    stats = executor.get_stats()
+    assert all(stats[c]['run_time']['count'] == 1
+               for c in (CHEAP_READ, HEAVY_READ, CONTROL, MUTATING))
+
+
+def test_control_commands_do_not_wait_for_file_operations():
+    config = {'executor.mutating_concurrency': 1,
+              'executor.mutating_queue': 0}
+    executor = CommandExecutor(config, Metrics({}))
+    copying = executor.submit(SleepingHandler(MUTATING, seconds=0.2))
+    gevent.sleep(0)
+    with pytest.raises(CommandBusyError):
+        executor.execute(SleepingHandler(MUTATING))
+    assert executor.execute(SleepingHandler(CONTROL)) == CONTROL
+    assert not copying.ready()
+    copying.join()
+
+
+def test_executor_config_overrides_defaults():
+    config = {'executor.mutating_concurrency': 3,
+              'executor.mutating_queue': 5}
+    executor = CommandExecutor(config, Metrics({}))
+    stats = executor.get_stats()[MUTATING]
+    assert (stats['concurrency'], stats['max_queue']) == (3, 5)
+
+
+def test_submit_admits_background_commands():
+    config = {'executor.mutating_concurrency': 1,
+              'executor.mutating_queue': 1}
+    executor = CommandExecutor(config, Metrics({}))
+    handlers = [SleepingHandler(), SleepingHandler()]
+    greenlets = [executor.submit(h) for h in handlers]
+    # neither command has started yet, but both are admitted
+    with pytest.raises(CommandBusyError):
+        executor.submit(SleepingHandler())
+    gevent.joinall(greenlets)
+    assert all(h.done for h in handlers)
+    assert executor.get_stats()[MUTATING]['rejected'] == 1
+
+
+def test_submit_survives_failing_handler():
+    class FailingHandler(SleepingHandler):
+        def do_command(self):
+            raise ValueError('failed')
+
+    executor = CommandExecutor({}, Metrics({}))
+    greenlet = executor.submit(FailingHandler())
+    greenlet.join()
+    assert greenlet.successful()
+    assert executor.get_stats()[MUTATING]['active'] == 0
+
+
+@pytest.mark.parametrize('handler_cls', [
+    handlers.RefreshCommandHandler,
+    handlers.RefreshPathCommandHandler,
+    handlers.RefreshFileCommandHandler,
+    handlers.SetWhitelistCommandHandler,
+    handlers.SetProfilingCommandHandler,
+])
+def test_state_changes_are_control_commands(handler_cls):
+    assert handler_cls.command_class == CONTROL
+
+
+@pytest.mark.parametrize('handler_cls', [
+    handlers.ConsolidateCommandHandler,
+    handlers.CopyCommandHandler,
+    handlers.RemoveCommandHandler,
+    handlers.TransferCommandHandler,
+])
+def test_file_operations_are_mutating(handler_cls):
+    assert handler_cls.command_class == MUTATING
@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from fsal.fs import FSObject, File, Directory, PathEntry, to_timestamp
+
+
+MODIFIED = datetime.datetime(2020, 1, 1, 12, 30, 15)
+
+
+@pytest.mark.parametrize('cls', [FSObject, File, Directory, PathEntry])
+def test_no_instance_dict(cls):
+    assert not hasattr(cls.__new__(cls), '__dict__')
+
+
+def test_paths_are_derived():
+    fso = File('/mnt/data', 'docs/notes/a.md', MODIFIED, MODIFIED, 4)
+    assert fso.path == '/mnt/data/docs/notes/a.md'
+    assert fso.name == 'a.md'
+    assert fso.parent == 'docs/notes'
+    assert fso.is_file() and not fso.is_dir()
+
+
+def test_timestamps_are_converted_on_access():
+    fso = File('/mnt/data', 'a.md', MODIFIED, MODIFIED, 4)
+    assert fso.modify_date is MODIFIED
+    assert fso.modify_timestamp == to_timestamp(MODIFIED)
+    parsed = File('/mnt/data', 'a.md', 1.5, 2.5, 4)
+    assert parsed.create_timestamp == 1.5
+    assert parsed.modify_date == datetime.datetime.fromtimestamp(2.5)
+
+
+def test_from_db_row():
+    row = {'id': 7, 'base_path': '/mnt/data', 'path': 'docs',
+           'size': 0, 'create_time': MODIFIED, 'modify_time': MODIFIED}
+    fso = Directory.from_db_row(row)
+    assert (fso.id, fso.rel_path, fso.base_path) == (7, 'docs', '/mnt/data')
+    assert fso == Directory('/mnt/data', 'docs', MODIFIED, MODIFIED, 0)
+    assert fso != File('/mnt/data', 'docs', MODIFIED, MODIFIED, 0)
+
+
+def test_changed():
+    fso = File('/mnt/data', 'a.md', MODIFIED, MODIFIED, 4)
+    later = MODIFIED + datetime.timedelta(seconds=1)
+    assert not fso.changed(File('/mnt/data', 'a.md', later, MODIFIED, 4))
+    assert fso.changed(File('/mnt/data', 'a.md', MODIFIED, later, 4))
+    assert fso.changed(File('/mnt/data', 'a.md', MODIFIED, MODIFIED, 5))
+    with pytest.raises(TypeError):
+        fso.changed('a.md')
+
+
+def test_path_entry():
+    entry = PathEntry('docs/notes', True)
+    assert (entry.name, entry.size) == ('notes', None)
+    assert entry.is_dir() and not entry.is_file()
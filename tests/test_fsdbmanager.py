@@ -0,0 +1,390 @@
+import os
+
+import pytest
+
+from fsal import fsdbmanager
+from fsal.events import EVENT_CREATED, EVENT_DELETED, EVENT_MODIFIED
+from fsal.fs import PathEntry, FIELDS_PATHS, FIELDS_SIZES, FIELDS_COUNTS
+from fsal.planner import REFRESH, PRUNE, UPDATE, EXTRACT
+from fsal.tree import IndexTree
+
+from conftest import write_file
+
+
+def indexed_paths(manager):
+    rows = manager.db.fetchall('SELECT path FROM fsentries;')
+    return sorted(row['path'] for row in rows)
+
+
+def events(manager):
+    return sorted((e.event_type, e.src, e.is_dir)
+                  for e in manager.event_queue.getitems(1000))
+
+
+def test_remove_dir_deletes_subtree(fs_manager, base_path):
+    assert fs_manager.remove('docs') == (True, None)
+    assert not os.path.exists(os.path.join(base_path, 'docs'))
+    assert indexed_paths(fs_manager) == ['music', 'music/song.mp3',
+                                         'top.txt']
+    assert events(fs_manager) == [
+        (EVENT_DELETED, 'docs', True),
+        (EVENT_DELETED, 'docs/notes', True),
+        (EVENT_DELETED, 'docs/notes/a.md', False),
+        (EVENT_DELETED, 'docs/notes/b.md', False),
+        (EVENT_DELETED, 'docs/readme.txt', False),
+    ]
+    assert fs_manager.usage.get(base_path) == dict(bytes=103, files=2,
+                                                   dirs=1)
+
+
+def test_remove_paths_in_one_statement(fs_manager, base_path):
+    fs_manager._remove_paths([(base_path, 'top.txt'),
+                              (base_path, 'docs/notes/a.md'),
+                              (base_path, 'missing.txt')])
+    assert 'top.txt' not in indexed_paths(fs_manager)
+    assert 'docs/notes/a.md' not in indexed_paths(fs_manager)
+    # only the removed entries are reported
+    assert events(fs_manager) == [
+        (EVENT_DELETED, 'docs/notes/a.md', False),
+        (EVENT_DELETED, 'top.txt', False),
+    ]
+    assert fs_manager.usage.get(base_path)['files'] == 3
+
+
+def test_remove_no_paths(fs_manager):
+    count = len(indexed_paths(fs_manager))
+    fs_manager._remove_paths([])
+    assert len(indexed_paths(fs_manager)) == count
+    assert events(fs_manager) == []
+
+
+def test_rolled_back_batch_leaves_no_events(fs_manager, base_path):
+    write_file(base_path, 'docs/new.txt', 'new')
+    with pytest.raises(ValueError):
+        with fs_manager._index_batch():
+            fs_manager._remove_paths([(base_path, 'top.txt')])
+            entry = fsdbmanager.scandir.GenericDirEntry(
+                os.path.join(base_path, 'docs'), 'new.txt')
+            fs_manager._index_entry(base_path, entry, {})
+            raise ValueError('failed batch')
+    assert 'top.txt' in indexed_paths(fs_manager)
+    assert 'docs/new.txt' not in indexed_paths(fs_manager)
+    assert events(fs_manager) == []
+
+
+def test_prune_removes_missing_files(fs_manager, base_path):
+    os.remove(os.path.join(base_path, 'docs', 'notes', 'b.md'))
+    fs_manager._prune_db()
+    assert 'docs/notes/b.md' not in indexed_paths(fs_manager)
+    assert events(fs_manager) == [(EVENT_DELETED, 'docs/notes/b.md', False)]
+
+
+def base_paths(manager):
+    rows = manager.db.fetchall('SELECT path, base_path FROM fsentries;')
+    return dict((row['path'], row['base_path']) for row in rows)
+
+
+def test_update_base_paths_of_subtrees(fs_manager, base_path):
+    # one statement per subtree
+    fs_manager.PREFIX_BATCH_SIZE = 1
+    moved = fs_manager._update_base_paths([base_path], '/mnt/other',
+                                          roots=['docs/notes', 'top.txt'])
+    assert moved == set(['docs/notes', 'docs/notes/a.md', 'docs/notes/b.md',
+                         'top.txt'])
+    stored = base_paths(fs_manager)
+    assert all(stored[path] == '/mnt/other' for path in moved)
+    assert stored['docs/readme.txt'] == base_path
+    assert fs_manager.usage.get('/mnt/other') == dict(bytes=9, files=3,
+                                                      dirs=1)
+    assert fs_manager.usage.get(base_path) == dict(bytes=107, files=2,
+                                                   dirs=2)
+
+
+def test_update_all_base_paths(fs_manager, base_path):
+    moved = fs_manager._update_base_paths([base_path], '/mnt/other')
+    assert moved == set(indexed_paths(fs_manager))
+    assert set(base_paths(fs_manager).values()) == set(['/mnt/other'])
+    assert fs_manager.usage.get(base_path)['files'] == 0
+
+
+def test_update_base_paths_without_roots(fs_manager, base_path):
+    assert fs_manager._update_base_paths([base_path], '/mnt/other',
+                                         roots=[]) == set()
+    assert set(base_paths(fs_manager).values()) == set([base_path])
+
+
+def test_subtree_roots(fs_manager):
+    roots = fs_manager._subtree_roots(['a/b', 'a', 'ab', 'a/b/c', 'c/d',
+                                       'ab'])
+    assert roots == ['a', 'ab', 'c/d']
+
+
+def pending(manager):
+    return [(t.kind, t.path, t.base_paths) for t in manager.planner.pending]
+
+
+def test_fingerprints_are_saved(fs_manager, base_path):
+    fs_manager._save_fingerprints()
+    fingerprints = fs_manager._load_fingerprints()
+    assert list(fingerprints) == [base_path]
+    assert sorted(fingerprints[base_path]['entries']) == ['docs', 'music',
+                                                          'top.txt']
+    assert fs_manager._fingerprint(base_path + '-missing') is None
+
+
+def test_refresh_changed_entries_only(fs_manager, base_path):
+    fs_manager._save_fingerprints()
+    fingerprints = fs_manager._load_fingerprints()
+    top = os.path.join(base_path, 'top.txt')
+    os.utime(top, (0, os.path.getmtime(top) + 10))
+    os.mkdir(os.path.join(base_path, 'new'))
+    fs_manager._refresh_changed(fingerprints)
+    base_paths = set([base_path])
+    assert sorted(pending(fs_manager)[1:]) == [
+        (PRUNE, 'top.txt', base_paths),
+        (UPDATE, 'new', base_paths),
+        (UPDATE, 'top.txt', base_paths),
+    ]
+    assert pending(fs_manager)[0][0] == EXTRACT
+
+
+def test_refresh_remounted_base_path(fs_manager, base_path):
+    fs_manager._save_fingerprints()
+    fingerprints = fs_manager._load_fingerprints()
+    fingerprints[base_path]['inode'] += 1
+    fs_manager._refresh_changed(fingerprints)
+    base_paths = set([base_path])
+    assert pending(fs_manager) == [(EXTRACT, None, None),
+                                   (PRUNE, None, base_paths),
+                                   (UPDATE, None, base_paths)]
+
+
+def test_start_without_fingerprints_refreshes(fs_manager):
+    fs_manager.start()
+    try:
+        assert pending(fs_manager) == [(REFRESH, None, None)]
+        assert not fs_manager.indexed
+        fs_manager.scheduler.run()
+        assert fs_manager.indexed
+        # saved once the index is up to date
+        assert fs_manager._load_fingerprints()
+    finally:
+        fs_manager.stop()
+
+
+def entries(listing):
+    return sorted((e.rel_path, e.is_dir(), e.size) for e in listing)
+
+
+def test_list_descendants_of_paths(fs_manager):
+    (success, count, listing) = fs_manager.list_descendants(
+        'docs', fields=FIELDS_PATHS)
+    listing = list(listing)
+    assert success
+    assert all(isinstance(e, PathEntry) for e in listing)
+    assert entries(listing) == [
+        ('docs/notes', True, None),
+        ('docs/notes/a.md', False, None),
+        ('docs/notes/b.md', False, None),
+        ('docs/readme.txt', False, None),
+    ]
+
+
+def test_list_descendants_of_sizes(fs_manager):
+    listing = fs_manager.list_descendants('docs/notes',
+                                          fields=FIELDS_SIZES)[2]
+    assert entries(listing) == [('docs/notes/a.md', False, 4),
+                                ('docs/notes/b.md', False, 2)]
+
+
+def test_list_descendants_counts(fs_manager):
+    (success, counts, listing) = fs_manager.list_descendants(
+        '.', fields=FIELDS_COUNTS)
+    assert (success, counts, listing) == (True, dict(dirs=3, files=5), [])
+
+
+def test_filter_paths(fs_manager):
+    (success, listing) = fs_manager.filter(['top.txt', 'music', 'missing'],
+                                           fields=FIELDS_SIZES)
+    assert [e[:2] for e in entries(listing)] == [('music', True),
+                                                 ('top.txt', False)]
+    listing = fs_manager.filter(['top.txt'], fields=FIELDS_SIZES)[1]
+    assert entries(listing) == [('top.txt', False, 3)]
+
+
+def test_aggregate_by_extension(fs_manager):
+    (success, groups) = fs_manager.aggregate('.', ['extension'])
+    assert success
+    assert groups == [dict(extension='mp3', count=1, size=100),
+                      dict(extension='txt', count=2, size=10),
+                      dict(extension='md', count=2, size=6),
+                      dict(extension=None, count=3, size=0)]
+
+
+def test_aggregate_by_several_keys(fs_manager, base_path):
+    (success, groups) = fs_manager.aggregate(
+        'docs', ['type', 'base_path'], ignored_paths=['docs/notes/b'])
+    assert success
+    assert groups == [
+        dict(type='file', base_path=base_path, count=2, size=11),
+        dict(type='dir', base_path=base_path, count=1, size=0),
+    ]
+
+
+def test_aggregate_by_day(fs_manager):
+    groups = fs_manager.aggregate('music', ['day'])[1]
+    assert len(groups) == 1
+    assert groups[0]['size'] == 100
+    assert len(groups[0]['day']) == len('2020-01-01')
+
+
+@pytest.mark.parametrize('path,group_by', [
+    ('.', []),
+    ('.', ['extension', 'owner']),
+    ('missing', ['type']),
+])
+def test_invalid_aggregation(fs_manager, path, group_by):
+    assert fs_manager.aggregate(path, group_by) == (False, [])
+
+
+@pytest.fixture
+def incoming(tmpdir):
+    path = str(tmpdir.mkdir('incoming'))
+    write_file(path, 'new/file.bin', 'x' * 50)
+    return path
+
+
+def test_consolidate_checks_space_for_unindexed_sources(fs_manager, incoming,
+                                                        base_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(fsdbmanager, 'disk_space', lambda path: (1000, 40))
+    (success, is_partial, msg) = fs_manager.consolidate([incoming],
+                                                        base_path)
+    assert (success, is_partial) == (False, False)
+    assert '50 bytes needed' in msg
+    assert not os.path.exists(os.path.join(base_path, 'new'))
+
+
+def test_consolidate_checks_space_for_base_paths(fs_manager, incoming,
+                                                 base_path, monkeypatch):
+    monkeypatch.setattr(fsdbmanager, 'disk_space', lambda path: (1000, 100))
+    fs_manager.base_paths.append(incoming)
+    fs_manager.usage.add(incoming, False, 200)
+    (success, _, msg) = fs_manager.consolidate([incoming], base_path)
+    assert not success
+    assert '200 bytes needed' in msg
+    fs_manager.usage.add(incoming, False, -200)
+    (success, _, _) = fs_manager.consolidate([incoming], base_path)
+    assert success
+    assert os.path.exists(os.path.join(base_path, 'new', 'file.bin'))
+
+
+def test_indexed_sources_are_not_walked(fs_manager, base_path, incoming,
+                                        monkeypatch):
+    def walk(*args, **kwargs):
+        raise AssertionError('walked')
+
+    monkeypatch.setattr(fsdbmanager, 'yielding_checked_fnwalk', walk)
+    assert fs_manager._validate_transfer(base_path, incoming,
+                                         indexed=True) == (True, None, 116)
+    # the destination the index is checked against
+    dest = os.path.join(base_path, incoming.lstrip(os.sep))
+    fs_manager.PATH_LEN_LIMIT = len(dest) + len('/music/song.mp3')
+    (valid, msg, _) = fs_manager._validate_transfer(base_path, incoming,
+                                                    indexed=True)
+    assert not valid
+    assert msg.startswith(os.path.join(dest, 'docs'))
+
+
+def test_storage_info(fs_manager, base_path, monkeypatch):
+    monkeypatch.setattr(fsdbmanager, 'disk_space', lambda path: (1000, 400))
+    assert fs_manager.storage_info() == [
+        dict(path=base_path, bytes=116, files=5, dirs=3, capacity=1000,
+             free=400)]
+    fs_manager.remove('music/song.mp3')
+    assert fs_manager.storage_info()[0]['bytes'] == 16
+
+
+@pytest.fixture
+def sorted_dir(fs_manager, base_path):
+    for (name, size) in (('item2', 5), ('item10', 1), ('item1', 3)):
+        write_file(base_path, 'sorted/' + name, 'x' * size)
+    os.mkdir(os.path.join(base_path, 'sorted', 'sub'))
+    fs_manager._update_db()
+    return 'sorted'
+
+
+@pytest.mark.parametrize('order,expected', [
+    ('name', ['item1', 'item10', 'item2', 'sub']),
+    ('-name', ['sub', 'item2', 'item10', 'item1']),
+    ('size', ['item10', 'item1', 'item2', 'sub']),
+    ('natural', ['item1', 'item2', 'item10', 'sub']),
+    ('-natural', ['sub', 'item10', 'item2', 'item1']),
+])
+def test_list_dir_order(fs_manager, sorted_dir, order, expected):
+    (success, listing) = fs_manager.list_dir(sorted_dir, order=order)
+    assert success
+    assert [f.name for f in listing] == expected
+
+
+@pytest.mark.parametrize('order', ['name', '-size', 'natural'])
+def test_list_dir_order_of_tree(fs_manager, sorted_dir, order):
+    listing = [f.name for f in fs_manager.list_dir(sorted_dir, order)[1]]
+    fs_manager.tree = IndexTree({'tree.enabled': True})
+    fs_manager._load_tree()
+    assert fs_manager._tree_ready
+    # rows of the tree are sorted the way the index sorts them
+    assert [f.name for f in fs_manager.list_dir(sorted_dir, order)[1]] == (
+        listing)
+
+
+def test_list_dir_invalid_order(fs_manager, sorted_dir):
+    assert fs_manager.list_dir(sorted_dir, order='owner') == (False, [])
+
+
+def size_of(manager, path):
+    return manager.get_fso(path).size
+
+
+def test_refresh_new_file(fs_manager, base_path):
+    write_file(base_path, 'docs/new.txt', 'new')
+    assert fs_manager.refresh_file('docs/new.txt') == (True, None)
+    assert size_of(fs_manager, 'docs/new.txt') == 3
+    assert events(fs_manager) == [(EVENT_CREATED, 'docs/new.txt', False)]
+    # nothing is walked
+    assert fs_manager.planner.pending == []
+    assert fs_manager.usage.get(base_path)['files'] == 6
+
+
+def test_refresh_modified_file(fs_manager, base_path):
+    write_file(base_path, 'top.txt', 'longer top')
+    assert fs_manager.refresh_file('top.txt') == (True, None)
+    assert size_of(fs_manager, 'top.txt') == 10
+    assert events(fs_manager) == [(EVENT_MODIFIED, 'top.txt', False)]
+    assert fs_manager.usage.get(base_path)['bytes'] == 123
+
+
+def test_refresh_removed_file(fs_manager, base_path):
+    os.remove(os.path.join(base_path, 'docs', 'readme.txt'))
+    assert fs_manager.refresh_file('docs/readme.txt') == (True, None)
+    assert fs_manager.get_fso('docs/readme.txt') is None
+    assert events(fs_manager) == [(EVENT_DELETED, 'docs/readme.txt', False)]
+
+
+@pytest.mark.parametrize('path,tasks', [
+    # directories are refreshed as subtrees
+    ('docs/notes', [(PRUNE, 'docs/notes'), (UPDATE, 'docs/notes')]),
+    # and so are files in directories which are not indexed yet
+    ('new/dir/file.txt', [(UPDATE, 'new')]),
+])
+def test_refresh_file_falls_back_to_subtrees(fs_manager, base_path, path,
+                                             tasks):
+    write_file(base_path, 'new/dir/file.txt', 'x')
+    assert fs_manager.refresh_file(path) == (True, None)
+    assert [(t.kind, t.path) for t in fs_manager.planner.pending] == tasks
+    assert events(fs_manager) == []
+
+
+def test_refresh_invalid_file(fs_manager):
+    (success, _) = fs_manager.refresh_file('.')
+    assert not success
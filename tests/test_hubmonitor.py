@@ -0,0 +1,71 @@
+import gevent
+import pytest
+
+from fsal.hubmonitor import HubMonitor, activity, real_sleep, _activities
+from fsal.metrics import Metrics
+
+
+def test_activity_labels_are_nested():
+    current = gevent.getcurrent()
+    with activity('task._update_db'):
+        with activity('command.list_dir'):
+            assert _activities[current] == 'command.list_dir'
+        assert _activities[current] == 'task._update_db'
+    assert current not in _activities
+
+
+def test_activity_of_other_greenlets():
+    def labelled():
+        with activity('command.get_fso'):
+            return _activities.get(gevent.getcurrent())
+
+    with activity('task._prune_db'):
+        assert gevent.spawn(labelled).get() == 'command.get_fso'
+        assert _activities[gevent.getcurrent()] == 'task._prune_db'
+
+
+@pytest.fixture
+def monitor():
+    monitor = HubMonitor({'hub_monitor.threshold': 50}, Metrics({}))
+    monitor.start()
+    yield monitor
+    monitor.stop()
+
+
+def block(seconds):
+    with activity('command.blocking'):
+        real_sleep(seconds)
+
+
+def test_blocking_is_attributed(monitor):
+    # let the heartbeat run once before the hub is blocked
+    gevent.sleep(0.01)
+    gevent.spawn(block, 0.3).join()
+    stats = monitor.get_stats()
+    assert stats['events'] >= 1
+    assert stats['max_blocked'] >= 50
+    assert stats['last_event']['activity'] == 'command.blocking'
+    # counted by the heartbeat once the hub is running again
+    gevent.sleep(monitor.interval * 2)
+    counters = monitor.metrics.get_stats()['counters']
+    assert counters['hub']['blocked']['command']['blocking'] >= 1
+
+
+def test_reports_are_counted_by_heartbeat(monitor):
+    monitor._report(0.1)
+    assert 'hub' not in monitor.metrics.get_stats()['counters']
+    gevent.sleep(monitor.interval * 2)
+    counters = monitor.metrics.get_stats()['counters']
+    assert counters['hub']['blocked']['unknown'] == 1
+
+
+def test_cooperative_code_is_not_reported(monitor):
+    for _ in range(10):
+        gevent.sleep(0.02)
+    assert monitor.get_stats()['events'] == 0
+
+
+def test_disabled_monitor():
+    monitor = HubMonitor({'hub_monitor.enabled': False}, Metrics({}))
+    monitor.start()
+    assert monitor._thread is None
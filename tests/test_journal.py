@@ -0,0 +1,72 @@
+import pytest
+
+from fsal.journal import TaskJournal
+from fsal.planner import PlannedTask, RefreshPlanner, PRUNE, UPDATE
+
+from conftest import ScheduleRecorder
+
+
+def task(kind, path=None):
+    return PlannedTask(kind, None, (path, None), path)
+
+
+@pytest.fixture
+def journal(context):
+    return TaskJournal(context['databases'].fs)
+
+
+def test_records_in_order(journal):
+    first = journal.add(task(UPDATE, 'a'))
+    second = journal.add(task(PRUNE))
+    assert journal.records() == [(first, UPDATE, ['a', None]),
+                                 (second, PRUNE, [None, None])]
+    journal.remove([first])
+    assert [r[0] for r in journal.records()] == [second]
+
+
+def test_pop(journal):
+    journal.add(task(UPDATE, 'a'))
+    assert journal.pop() == [(UPDATE, ['a', None])]
+    assert journal.records() == []
+    assert journal.pop() == []
+
+
+@pytest.fixture
+def planner(journal):
+    return RefreshPlanner(ScheduleRecorder(), lambda fn, args: None,
+                          journal=journal)
+
+
+def test_planner_records_accepted_tasks(planner, journal):
+    planner.add(task(UPDATE, 'a/b'))
+    planner.add(task(UPDATE, 'a/b/c'))
+    assert [r[2] for r in journal.records()] == [['a/b', None]]
+    planner.add(task(UPDATE, 'a'))
+    # the replaced task is no longer needed
+    assert [r[2] for r in journal.records()] == [['a', None]]
+    planner.scheduler.run()
+    assert journal.records() == []
+
+
+def test_planner_adopts_tasks_of_other_processes(planner, journal):
+    planner.add(task(UPDATE, 'a'))
+    journal.add(task(UPDATE, 'a/b'))
+    journal.add(task(PRUNE, 'b'))
+    planner.adopt(lambda kind, path, base_paths: task(kind, path))
+    assert [(t.kind, t.path) for t in planner.pending] == [(UPDATE, 'a'),
+                                                           (PRUNE, 'b')]
+    # adopting again does not duplicate tasks
+    planner.adopt(lambda kind, path, base_paths: task(kind, path))
+    assert len(planner.pending) == 2
+    assert len(journal.records()) == 2
+
+
+def test_unfinished_tasks_are_replayed(fs_manager):
+    fs_manager._prune_db_async(src_path='docs')
+    fs_manager._update_db_async(src_path='music')
+    # the process died before running them
+    fs_manager.planner.pending = []
+    fs_manager._replay_journal()
+    assert [(t.kind, t.path) for t in fs_manager.planner.pending] == [
+        (PRUNE, 'docs'), (UPDATE, 'music')]
+    assert len(fs_manager.planner.journal.records()) == 2
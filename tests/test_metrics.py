@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from fsal.metrics import (Histogram, Metrics, PhaseTimer, Stopwatch,
+                          collect_stats, nest, NULL_TIMER)
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    # 90 fast samples and 10 slow ones
+    for _ in range(90):
+        histogram.record(0.0005)
+    for _ in range(10):
+        histogram.record(0.3)
+    stats = histogram.to_dict()
+    assert stats['count'] == 100
+    assert stats['p50'] == 1.0
+    assert stats['p95'] == 300.0
+    assert stats['max'] == 300.0
+    assert stats['avg'] == pytest.approx(30.45)
+
+
+def test_histogram_overflow_bucket():
+    histogram = Histogram()
+    histogram.record(60)
+    assert histogram.percentile(99) == 60000.0
+
+
+def test_empty_histogram():
+    assert Histogram().to_dict() == {
+        'count': 0, 'avg': 0.0, 'max': 0.0, 'p50': 0.0, 'p95': 0.0,
+        'p99': 0.0,
+    }
+
+
+def test_nest():
+    assert nest({'a.b': 1, 'a.c': 2, 'd': 3}) == {
+        'a': {'b': 1, 'c': 2}, 'd': 3}
+
+
+def test_metrics_report():
+    metrics = Metrics({})
+    metrics.incr('requests.errors')
+    metrics.incr('requests.errors', 2)
+    metrics.gauge('indexer.entries_per_sec', 10.0)
+    with metrics.timer('handlers.list_dir'):
+        pass
+    stats = metrics.get_stats()
+    assert stats['counters'] == {'requests': {'errors': 3}}
+    assert stats['gauges'] == {'indexer': {'entries_per_sec': 10.0}}
+    assert stats['latency']['handlers']['list_dir']['count'] == 1
+
+
+def test_disabled_metrics():
+    metrics = Metrics({'stats.enabled': False})
+    metrics.incr('a')
+    metrics.record('b', 1)
+    assert metrics.timer('c') is NULL_TIMER
+    stats = metrics.get_stats()
+    assert (stats['counters'], stats['latency']) == ({}, {})
+
+
+def test_phase_timer():
+    metrics = Metrics({})
+    phases = PhaseTimer(metrics, 'requests.')
+    phases.mark('parse')
+    phases.mark('execute')
+    assert list(phases.timings) == ['parse', 'execute']
+    assert phases.total == pytest.approx(sum(phases.timings.values()))
+    assert set(metrics.get_stats()['latency']['requests']) == set(
+        ['parse', 'execute'])
+
+
+def test_stopwatch_accumulates():
+    stopwatch = Stopwatch()
+    sleep = stopwatch.timed(time.sleep)
+    sleep(0.01)
+    with stopwatch:
+        time.sleep(0.01)
+    assert stopwatch.elapsed >= 0.02
+
+
+def test_collect_stats():
+    metrics = Metrics({})
+    stats = collect_stats({'metrics': metrics, 'unrelated': object()})
+    assert list(stats) == ['metrics']
+
+
+def test_walk_time_excludes_pauses(fs_manager):
+    fs_manager.throttle.pause = lambda: time.sleep(0.01)
+    fs_manager._update_db()
+    latency = fs_manager.metrics.get_stats()['latency']['indexer']
+    # every directory is followed by a pause
+    assert latency['paused']['max'] >= 40
+    assert latency['walk']['max'] < latency['paused']['max']
@@ -0,0 +1,105 @@
+import pytest
+
+from fsal.planner import (PlannedTask, RefreshPlanner, within, REFRESH, PRUNE,
+                          UPDATE, EXTRACT)
+
+from conftest import ScheduleRecorder
+
+
+def task(kind, path=None, base_paths=None):
+    return PlannedTask(kind, kind, (path, base_paths), path, base_paths)
+
+
+@pytest.mark.parametrize('path,root,expected', [
+    ('a/b', None, True),
+    ('a/b', 'a', True),
+    ('a', 'a', True),
+    ('ab', 'a', False),
+    ('a', 'a/b', False),
+    (None, 'a', False),
+])
+def test_within(path, root, expected):
+    assert within(path, root) is expected
+
+
+@pytest.mark.parametrize('first,second,expected', [
+    (task(REFRESH), task(UPDATE, 'a', ['/mnt/data']), True),
+    (task(UPDATE), task(UPDATE, 'a/b'), True),
+    (task(UPDATE, '.'), task(UPDATE, 'a'), True),
+    (task(UPDATE, 'a/'), task(UPDATE, 'a/b'), True),
+    (task(UPDATE, 'a'), task(UPDATE), False),
+    (task(UPDATE, 'a'), task(UPDATE, 'ab'), False),
+    (task(UPDATE), task(PRUNE), False),
+    (task(UPDATE, None, ['/a', '/b']), task(UPDATE, 'x', ['/a']), True),
+    (task(UPDATE, None, ['/a']), task(UPDATE, 'x', ['/a', '/b']), False),
+    (task(UPDATE, None, ['/a']), task(UPDATE, 'x'), False),
+    (task(UPDATE, 'x'), task(UPDATE, 'x', ['/a']), True),
+    (task(EXTRACT), task(EXTRACT), True),
+])
+def test_covers(first, second, expected):
+    assert first.covers(second) is expected
+
+
+@pytest.fixture
+def planner():
+    ran = []
+    planner = RefreshPlanner(ScheduleRecorder(),
+                             lambda fn, args: ran.append((fn, args)))
+    planner.ran = ran
+    return planner
+
+
+def test_covered_tasks_are_merged(planner):
+    assert planner.add(task(UPDATE, 'a'))
+    assert not planner.add(task(UPDATE, 'a/b'))
+    assert not planner.add(task(UPDATE, 'a'))
+    assert len(planner.scheduler.scheduled) == 1
+    stats = planner.get_stats()
+    assert (stats['planned'], stats['merged']) == (1, 2)
+
+
+def test_covering_task_replaces_pending_ones(planner):
+    planner.add(task(UPDATE, 'a/b'))
+    planner.add(task(PRUNE))
+    planner.add(task(UPDATE, 'a/c'))
+    assert planner.add(task(UPDATE, 'a'))
+    # the first covered task is replaced in place
+    assert [(t.kind, t.path) for t in planner.pending] == [
+        (UPDATE, 'a'), (PRUNE, None)]
+    assert planner.get_stats()['replaced'] == 2
+    planner.scheduler.run()
+    assert planner.ran == [(UPDATE, ('a', None)), (PRUNE, (None, None))]
+    stats = planner.get_stats()
+    assert (stats['executed'], stats['pending']) == (2, 0)
+    assert planner.idle
+
+
+def test_refresh_replaces_everything(planner):
+    planner.add(task(UPDATE, 'a'))
+    planner.add(task(EXTRACT))
+    planner.add(task(REFRESH))
+    assert not planner.add(task(PRUNE, 'b'))
+    assert [t.kind for t in planner.pending] == [REFRESH]
+    assert planner.get_stats()['pending_by_kind'][REFRESH] == 1
+
+
+def test_running_task_does_not_cover_new_ones(planner):
+    def run(fn, args):
+        planner.ran.append(fn)
+        if len(planner.ran) == 1:
+            # the change may come after the running task passed it
+            assert planner.add(task(UPDATE, 'a/b'))
+
+    planner.run = run
+    planner.add(task(UPDATE, 'a'))
+    planner.scheduler.run()
+    assert planner.ran == [UPDATE, UPDATE]
+
+
+def test_on_idle(planner):
+    idle = []
+    planner.on_idle = lambda: idle.append(planner.idle)
+    planner.add(task(UPDATE, 'a'))
+    planner.add(task(PRUNE))
+    planner.scheduler.run()
+    assert idle == [True]
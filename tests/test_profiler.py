@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+
+from fsal.profiler import Profiler
+from fsal.xmlparser import parsestring
+
+
+class LogRecorder(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def profiler(tmpdir):
+    profiler = Profiler({'profiling.enabled': True,
+                         'profiling.slow_threshold': 100,
+                         'profiling.profile_dir': str(tmpdir),
+                         'profiling.slow_log': None})
+    profiler.slow_log = LogRecorder()
+    return profiler
+
+
+def test_fast_commands_are_not_logged(profiler):
+    profiler.report('command', 'list_dir', 0.05)
+    assert profiler.slow_log.messages == []
+    assert profiler.get_stats()['slow_count'] == 0
+
+
+def test_slow_command_entry(profiler):
+    request = parsestring('<request><command><type>list_dir</type><params>'
+                          '<path>a/b</path></params></command></request>')
+    params = request.request.command.params
+    profiler.report('command', 'list_dir', 0.25, params=params,
+                    timings={'parse': 0.001, 'execute': 0.249})
+    (message,) = profiler.slow_log.messages
+    entry = json.loads(message)
+    assert entry['kind'] == 'command'
+    assert entry['name'] == 'list_dir'
+    assert entry['duration'] == 250.0
+    assert entry['params'] == {'path': 'a/b'}
+    assert entry['timings'] == {'parse': 1.0, 'execute': 249.0}
+    assert profiler.get_stats()['slow_count'] == 1
+
+
+def test_disabled_slow_log(profiler):
+    profiler.configure(enabled=False)
+    profiler.report('task', '_update_db', 10)
+    assert profiler.slow_log.messages == []
+
+
+def test_threshold_is_configurable(profiler):
+    profiler.configure(threshold=10)
+    profiler.report('command', 'get_fso', 0.02)
+    assert len(profiler.slow_log.messages) == 1
+
+
+def test_profiles_requested_commands(profiler, tmpdir):
+    profiler.configure(profile_requests=2)
+    for _ in range(3):
+        with profiler.profile('command', 'list_dir'):
+            sum(range(100))
+    stats = profiler.get_stats()
+    assert stats['profile_requests'] == 0
+    assert len(stats['profiles']) == 2
+    assert all(os.path.dirname(p) == str(tmpdir) for p in stats['profiles'])
+    assert all(os.path.exists(p) for p in stats['profiles'])
+
+
+def test_profiles_next_indexing_task(profiler):
+    profiler.configure(profile_indexing=True)
+    with profiler.profile('command', 'list_dir'):
+        pass
+    with profiler.profile('task', '_update_db'):
+        pass
+    (path,) = profiler.get_stats()['profiles']
+    assert 'fsal-task-_update_db-' in path
+    assert not profiler.profile_indexing
+
+
+def test_other_tasks_are_not_profiled(profiler):
+    profiler.configure(profile_indexing=True)
+    with profiler.profile('task', '_prune_db'):
+        pass
+    with profiler.profile('task', '_save_fingerprints'):
+        pass
+    assert profiler.get_stats()['profiles'] == []
+    assert profiler.profile_indexing
+    with profiler.profile('task', '_refresh_db'):
+        pass
+    (path,) = profiler.get_stats()['profiles']
+    assert 'fsal-task-_refresh_db-' in path
+    assert not profiler.profile_indexing
+
+
+def test_single_profile_at_a_time(profiler):
+    profiler.configure(profile_requests=2)
+    with profiler.profile('command', 'outer'):
+        with profiler.profile('command', 'inner'):
+            pass
+    (path,) = profiler.get_stats()['profiles']
+    assert 'outer' in path
+    # the nested command did not use up a request
+    assert profiler.profile_requests == 1
+
+
+def test_unwritable_profile_dir(profiler, tmpdir):
+    profiler.profile_dir = str(tmpdir.join('missing'))
+    profiler.configure(profile_requests=1)
+    with profiler.profile('command', 'list_dir'):
+        pass
+    assert profiler.get_stats()['profiles'] == []
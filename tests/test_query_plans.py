@@ -0,0 +1,139 @@
+"""
+Regression check that the hot index queries are served by indexes.
+
+The statements are taken from :py:class:`~fsal.fsdbmanager.FSDBManager`
+itself and explained with the default planner settings against a scratch
+database filled with enough entries for index scans to pay off. The tests
+need a Postgres server, whose connection parameters are read from the
+``FSAL_TEST_DSN`` environment variable, e.g.::
+
+    FSAL_TEST_DSN="host=localhost port=5432 user=postgres password=postgres"
+
+and are skipped when it is not set. The scratch database is dropped once the
+tests are done.
+"""
+
+import os
+import datetime
+
+import pytest
+from squery_pg.migrations import migrate
+from squery_pg.testing import random_name
+
+from fsal.db.databases import GreenDatabase
+from fsal.fsdbmanager import FSDBManager
+
+
+DSN = os.environ.get('FSAL_TEST_DSN')
+
+pytestmark = pytest.mark.skipif(not DSN, reason='FSAL_TEST_DSN is not set')
+
+# number of directories and of files in each of them
+DIRS = 100
+FILES = 200
+
+BASE_PATHS = ['/mnt/data', '/mnt/external']
+
+
+def dir_path(i):
+    return 'd{:03}'.format(i)
+
+
+def file_path(i, j):
+    return '{}/f{:04}'.format(dir_path(i), j)
+
+
+def populate(db):
+    now = datetime.datetime.now()
+    columns = ', '.join(FSDBManager.FSO_COLUMNS)
+    sql = ('INSERT INTO {} ({}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) '
+           'RETURNING id'.format(FSDBManager.FS_TABLE, columns))
+    for i in range(DIRS):
+        base_path = BASE_PATHS[i % len(BASE_PATHS)]
+        path = dir_path(i)
+        parent_id = db.fetchone(sql, (0, FSDBManager.DIR_TYPE, path, 0, now,
+                                      now, path, base_path))['id']
+        db.executemany(sql.replace(' RETURNING id', ''), [
+            (parent_id, FSDBManager.FILE_TYPE, os.path.basename(p), j, now,
+             now - datetime.timedelta(days=j), p, base_path)
+            for (j, p) in ((j, file_path(i, j)) for j in range(FILES))])
+    db.execute('ANALYZE {};'.format(FSDBManager.FS_TABLE))
+
+
+@pytest.fixture(scope='module')
+def db():
+    params = dict(item.split('=', 1) for item in DSN.split())
+    name = random_name('fsal_plans')
+    conn = dict(host=params.get('host', 'localhost'),
+                port=int(params.get('port', 5432)),
+                user=params.get('user', 'postgres'),
+                password=params.get('password'))
+    db = GreenDatabase.connect(database=name, maxsize=2, **conn)
+    try:
+        migrate(db, 'fs', 'fsal.migrations.fs')
+        populate(db)
+        yield db
+    finally:
+        db.close()
+        GreenDatabase.drop(dbname=name, maxsize=2, **conn)
+
+
+@pytest.fixture
+def manager():
+    # only the attributes the query building helpers read are needed
+    mgr = FSDBManager.__new__(FSDBManager)
+    mgr.whitelist = []
+    return mgr
+
+
+def dir_id(db, i):
+    return db.fetchone_prepared(FSDBManager.GET_FSO_STMT,
+                                {'path': dir_path(i)})['id']
+
+
+def explain(db, sql, params):
+    return '\n'.join(row[0] for row in
+                     db.fetchall('EXPLAIN ' + sql, params))
+
+
+def explain_prepared(db, statement, params):
+    with db.pool.prepared(statement) as cursor:
+        cursor.execute('EXPLAIN ' + statement.execute_sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def assert_indexed(plan):
+    assert 'Seq Scan on {}'.format(FSDBManager.FS_TABLE) not in plan, plan
+
+
+def test_get_fso(db):
+    plan = explain_prepared(db, FSDBManager.GET_FSO_STMT,
+                            {'path': file_path(42, 42)})
+    assert_indexed(plan)
+
+
+def test_list_dir(db):
+    plan = explain_prepared(db, FSDBManager.LIST_DIR_STMT,
+                            {'parent_id': dir_id(db, 42)})
+    assert_indexed(plan)
+
+
+@pytest.mark.parametrize('key', sorted(FSDBManager.LIST_DIR_SORTED_STMTS))
+def test_list_dir_sorted(db, key):
+    statement = FSDBManager.LIST_DIR_SORTED_STMTS[key]
+    plan = explain_prepared(db, statement, {'parent_id': dir_id(db, 42)})
+    assert_indexed(plan)
+
+
+@pytest.mark.parametrize('whitelist', [[], [dir_path(7)]])
+def test_filter_descendants(db, manager, whitelist):
+    manager.whitelist = whitelist
+    q = db.Select('*', sets=FSDBManager.FS_TABLE)
+    params = manager._filter_descendants(q, dir_path(42))
+    assert_indexed(explain(db, q.serialize(), params))
+
+
+def test_remove_paths(db):
+    paths = [file_path(42, j) for j in range(10)]
+    plan = explain(db, FSDBManager.REMOVE_PATHS_SQL, (paths,))
+    assert_indexed(plan)
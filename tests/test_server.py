@@ -0,0 +1,54 @@
+import os
+import socket
+
+import gevent
+from xml.etree.ElementTree import tostring
+
+from fsal.client import build_request_xml
+from fsal.executor import MUTATING
+from fsal.server import FSALServer
+from fsal.throttle import IndexThrottle
+
+
+def send_command(server, command, params):
+    (client_sock, server_sock) = socket.socketpair()
+    request = tostring(build_request_xml(command, params), 'utf-8')
+    client_sock.sendall(request + b'\0')
+    server.request_handler(server_sock, None)
+    client_sock.close()
+    server_sock.close()
+
+
+def wait_for_pool(server, command_class):
+    stats = server.executor.pools[command_class]
+    with gevent.Timeout(5):
+        while stats.run_time.count == 0:
+            gevent.sleep(0.01)
+
+
+def make_server(config, context, fs_manager):
+    context['fs_manager'] = fs_manager
+    context['throttle'] = IndexThrottle(config)
+    return FSALServer(config, context)
+
+
+def test_copy(config, context, fs_manager, base_path):
+    server = make_server(config, context, fs_manager)
+    send_command(server, 'copy', {'source': 'docs/notes',
+                                  'dest': 'docs/copied'})
+    wait_for_pool(server, MUTATING)
+    copied = os.path.join(base_path, 'docs', 'copied', 'a.md')
+    with open(copied) as f:
+        assert f.read() == 'aaaa'
+    # the copy is indexed in the background
+    fs_manager.scheduler.run()
+    assert fs_manager.get_fso('docs/copied/a.md').size == 4
+
+
+def test_copy_outside_base_path(config, context, fs_manager, base_path):
+    server = make_server(config, context, fs_manager)
+    send_command(server, 'copy', {'source': 'top.txt',
+                                  'dest': '../escaped.txt'})
+    wait_for_pool(server, MUTATING)
+    assert not os.path.exists(os.path.join(base_path, '..', 'escaped.txt'))
+    assert fs_manager.planner.pending == []
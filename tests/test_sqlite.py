@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from fsal.db import sqlite
+from fsal.db.databases import PreparedStatement
+from fsal.db.sqlite import (SQLiteConnection, SQLiteDatabase, translate,
+                            bind, init_sqlite_databases)
+
+
+@pytest.mark.parametrize('sql,expected', [
+    ('SELECT * FROM t WHERE a = %s AND b = %s',
+     ('SELECT * FROM t WHERE a = ? AND b = ?', None)),
+    ('SELECT * FROM t WHERE a = %(a)s OR b = %(b)s OR c = %(a)s',
+     ('SELECT * FROM t WHERE a = ? OR b = ? OR c = ?', ['a', 'b', 'a'])),
+    ("SELECT * FROM t WHERE path LIKE 'a%%'",
+     ("SELECT * FROM t WHERE path LIKE 'a%'", None)),
+    ('DELETE FROM t WHERE path = ANY(%s)',
+     ('DELETE FROM t WHERE path IN (SELECT value FROM json_each(?))', None)),
+    ('DELETE FROM t WHERE id = any ( %s ) RETURNING id',
+     ('DELETE FROM t WHERE id IN (SELECT value FROM json_each(?)) '
+      'RETURNING id', None)),
+])
+def test_translate(sql, expected):
+    assert translate(sql) == expected
+
+
+@pytest.mark.parametrize('names,params,expected', [
+    (None, None, ()),
+    (None, (1, 'a'), (1, 'a')),
+    # named parameters the query does not use
+    (None, {'a': 1}, ()),
+    (['b', 'a'], {'a': 1, 'b': 2}, (2, 1)),
+    (None, (['x', 'y'],), ('["x", "y"]',)),
+])
+def test_bind(names, params, expected):
+    assert bind(names, params) == expected
+
+
+@pytest.fixture
+def db():
+    db = SQLiteDatabase(sqlite.MEMORY)
+    db.executescript('CREATE TABLE t (id INTEGER PRIMARY KEY, path TEXT);')
+    db.executemany('INSERT INTO t (path) VALUES (%s)',
+                   [('a',), ('b',), ('c',)])
+    return db
+
+
+def paths(db):
+    return [row['path'] for row in db.fetchall('SELECT path FROM t '
+                                               'ORDER BY id;')]
+
+
+def test_array_parameters(db):
+    rows = db.fetchall('DELETE FROM t WHERE path = ANY(%s) RETURNING path;',
+                       (['a', 'c'],))
+    assert sorted(row['path'] for row in rows) == ['a', 'c']
+    assert paths(db) == ['b']
+
+
+def test_prepared_statement(db):
+    statement = PreparedStatement(
+        'get_path', 'SELECT * FROM t WHERE path = $1 OR id = $2',
+        ['path', 'id'])
+    row = db.fetchone_prepared(statement, {'path': 'b', 'id': 0})
+    assert row['path'] == 'b'
+
+
+def test_transaction_rollback(db):
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.execute('DELETE FROM t;')
+            with db.transaction():
+                db.execute("INSERT INTO t (path) VALUES ('d');")
+            raise ValueError()
+    assert paths(db) == ['a', 'b', 'c']
+
+
+def test_migrations_set_version():
+    databases = init_sqlite_databases({'database.name': 'fs'}, '_indexer')
+    db = databases.fs
+    # the indexer shares the connection
+    assert databases.fs_indexer is db
+    assert db.fetchone('PRAGMA user_version;')[0] > 0
+    assert db.fetchone('SELECT count(*) FROM fsentries;')[0] == 0
+
+
+def test_recreate(tmpdir):
+    config = {'database.name': 'fs', 'database.path': str(tmpdir)}
+    db = init_sqlite_databases(config, '_indexer').fs
+    version = db.fetchone('PRAGMA user_version;')[0]
+    db.execute('INSERT INTO fingerprints (base_path, fingerprint) '
+               "VALUES ('/mnt/data', 'x');")
+    db.recreate()
+    assert os.path.exists(os.path.join(str(tmpdir), 'fs.sqlite'))
+    assert db.fetchone('PRAGMA user_version;')[0] == version
+    assert db.fetchone('SELECT count(*) FROM fingerprints;')[0] == 0
+
+
+def test_version_check(monkeypatch):
+    monkeypatch.setattr(sqlite, 'MIN_SQLITE_VERSION', (99, 0, 0))
+    with pytest.raises(RuntimeError) as exc:
+        SQLiteConnection(sqlite.MEMORY)
+    assert '99.0.0' in str(exc.value)
@@ -0,0 +1,50 @@
+import pytest
+
+from fsal.throttle import IndexThrottle
+
+
+@pytest.fixture
+def throttle():
+    return IndexThrottle({'throttle.idle_after': 50,
+                          'throttle.busy_sleep': 1,
+                          'throttle.busy_batch_size': 5})
+
+
+def test_idle_server_indexes_at_full_speed(throttle):
+    assert not throttle.busy
+    assert throttle.batch_size(100) == 100
+    with throttle.task():
+        throttle.pause()
+    stats = throttle.get_stats()
+    assert (stats['backoffs'], stats['duty_cycle']) == (0, 1.0)
+
+
+def test_commands_in_flight_slow_indexing_down(throttle):
+    with throttle.task():
+        with throttle.command():
+            assert throttle.busy
+            assert throttle.batch_size(100) == 5
+            assert throttle.batch_size(3) == 3
+            throttle.pause()
+    stats = throttle.get_stats()
+    assert stats['backoffs'] == 1
+    assert stats['paused_time'] <= stats['task_time']
+    assert stats['latency']['indexing']['count'] == 1
+    assert stats['latency']['idle']['count'] == 0
+
+
+def test_busy_until_idle_after(throttle, monkeypatch):
+    with throttle.command():
+        pass
+    assert throttle.busy
+    monkeypatch.setattr(throttle, 'last_seen', throttle.last_seen - 0.05)
+    assert not throttle.busy
+    assert throttle.get_stats()['latency']['idle']['count'] == 1
+
+
+def test_disabled_throttle(throttle):
+    throttle.enabled = False
+    with throttle.command():
+        assert throttle.batch_size(100) == 100
+        throttle.pause()
+    assert throttle.get_stats()['backoffs'] == 0
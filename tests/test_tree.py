@@ -0,0 +1,171 @@
+import datetime
+
+import pytest
+
+from fsal.fsdbmanager import FSDBManager
+from fsal.tree import IndexTree, DIR_TYPE
+
+from conftest import ScheduleRecorder
+
+
+FILE_TYPE = 0
+
+MODIFIED = datetime.datetime(2020, 1, 1, 12, 30, 15, 250)
+
+
+def make_row(id, path, type=FILE_TYPE, size=0, base_path='/mnt/data'):
+    return {'id': id, 'path': path, 'type': type, 'size': size,
+            'create_time': MODIFIED, 'modify_time': MODIFIED,
+            'base_path': base_path}
+
+
+@pytest.fixture
+def tree():
+    tree = IndexTree({'tree.enabled': True})
+    tree.load([
+        make_row(1, 'a', DIR_TYPE),
+        make_row(2, 'a/b', DIR_TYPE),
+        make_row(3, 'a/b/c.txt', size=3),
+        make_row(4, 'a/d.txt', size=4),
+        make_row(5, 'e.txt', size=5, base_path='/mnt/external'),
+    ])
+    return tree
+
+
+def counts(tree):
+    stats = tree.get_stats()
+    return (stats['entries'], stats['directories'])
+
+
+def test_load(tree):
+    assert tree.ready
+    assert counts(tree) == (5, 2)
+    row = tree.get('a/b/c.txt')
+    assert row['id'] == 3
+    assert row['parent_id'] == 2
+    assert row['modify_time'] == MODIFIED
+    assert tree.get('a/missing') is None
+
+
+def test_list_dir_is_sorted(tree):
+    tree.put(make_row(6, 'a/0.txt'))
+    assert [r['path'] for r in tree.list_dir('a')] == [
+        'a/0.txt', 'a/b', 'a/d.txt']
+    assert [r['path'] for r in tree.list_dir('.')] == ['a', 'e.txt']
+
+
+def test_put_counts_new_entries_only(tree):
+    tree.put(make_row(6, 'f/g.txt'))
+    # the parent directory is created, but is not an indexed entry yet
+    assert counts(tree) == (6, 2)
+    tree.put(make_row(7, 'f', DIR_TYPE))
+    assert counts(tree) == (7, 3)
+    tree.put(make_row(6, 'f/g.txt', size=100))
+    assert counts(tree) == (7, 3)
+    assert tree.get('f/g.txt')['size'] == 100
+
+
+def test_put_replaces_directory_with_file(tree):
+    tree.put(make_row(2, 'a/b', size=1))
+    assert counts(tree) == (4, 1)
+    assert tree.get('a/b/c.txt') is None
+
+
+def test_remove_subtree(tree):
+    tree.remove('a')
+    assert counts(tree) == (1, 0)
+    assert tree.get('a/b') is None
+    tree.remove('a')
+    assert counts(tree) == (1, 0)
+
+
+def test_set_base_path(tree):
+    tree.set_base_path('/mnt/new', ['/mnt/data'], roots=['a/b'])
+    assert tree.get('a/b/c.txt')['base_path'] == '/mnt/new'
+    assert tree.get('a/d.txt')['base_path'] == '/mnt/data'
+    tree.set_base_path('/mnt/new', ['/mnt/data', '/mnt/external'])
+    assert tree.get('e.txt')['base_path'] == '/mnt/new'
+    assert counts(tree) == (5, 2)
+
+
+def test_disabled_tree_ignores_writes():
+    tree = IndexTree({'tree.enabled': False})
+    tree.load([make_row(1, 'a', DIR_TYPE)])
+    tree.put(make_row(2, 'b'))
+    assert not tree.ready
+    assert counts(tree) == (0, 0)
+
+
+def test_reload_after_disable(tree):
+    tree.disable()
+    assert not tree.ready
+    tree.load([make_row(1, 'a', DIR_TYPE)])
+    assert tree.ready
+    assert tree.get_stats()['reloads'] == 1
+
+
+def test_disabled_while_loading(tree):
+    def rows():
+        yield make_row(1, 'a', DIR_TYPE)
+        tree.disable()
+
+    tree.load(rows())
+    assert not tree.ready
+    assert tree.stale
+
+
+@pytest.fixture
+def tree_manager(config, context):
+    config['tree.enabled'] = True
+    context['tree'] = IndexTree(config)
+    manager = FSDBManager(config, context)
+    manager._update_db()
+    manager._load_tree()
+    manager.scheduler = manager.planner.scheduler = ScheduleRecorder()
+    return manager
+
+
+def fail_batch(manager):
+    with pytest.raises(ValueError):
+        with manager._index_batch():
+            manager.tree.put(make_row(1000, 'phantom.txt'))
+            raise ValueError()
+
+
+def test_manager_serves_from_tree(tree_manager):
+    assert tree_manager._tree_ready
+    (success, listing) = tree_manager.list_dir('docs')
+    assert success
+    assert [f.rel_path for f in listing] == ['docs/notes', 'docs/readme.txt']
+
+
+def test_snapshot_reads_bypass_tree(tree_manager):
+    tree_manager.tree.put(make_row(1000, 'phantom.txt'))
+    assert tree_manager.get_fso('phantom.txt') is not None
+    with tree_manager.read_snapshot():
+        assert not tree_manager._tree_ready
+        assert tree_manager.get_fso('phantom.txt') is None
+    assert tree_manager._tree_ready
+
+
+def test_rolled_back_batch_reloads_tree_when_idle(tree_manager):
+    tree = tree_manager.tree
+    fail_batch(tree_manager)
+    assert not tree_manager._tree_ready
+    # lookups fall back to the database meanwhile
+    assert tree_manager.get_fso('phantom.txt') is None
+    tree_manager.scheduler.run()
+    assert tree_manager._tree_ready
+    assert tree.get('phantom.txt') is None
+    assert tree.get_stats()['reloads'] == 1
+
+
+def test_reload_waits_for_pending_tasks(tree_manager):
+    tree_manager._refresh_db_async()
+    fail_batch(tree_manager)
+    assert tree_manager.scheduler.scheduled == [
+        tree_manager.planner._run_next]
+    tree_manager.scheduler.run()
+    # reloaded by the planner once the refresh is done
+    assert tree_manager._tree_ready
+    assert tree_manager.tree.get_stats()['reloads'] == 1
@@ -0,0 +1,9 @@
+from fsal.utils import natural_key
+
+
+def test_natural_key():
+    names = ['file10.txt', 'File2.txt', 'file1.txt', '10', '9', 'file',
+             'file2a.txt']
+    assert sorted(names, key=natural_key) == [
+        '9', '10', 'file', 'file1.txt', 'File2.txt', 'file2a.txt',
+        'file10.txt']
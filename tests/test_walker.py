@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import array
+import os
+
+import gevent
+import gevent.queue
+import pytest
+
+from fsal import walker
+from fsal.walker import (ParallelWalker, FRAME, TYPE_CODE, SIZE_CODE,
+                         TIME_CODE, DIR_TYPE, FILE_TYPE, pack_batch,
+                         unpack_batch, walk_partition)
+
+from conftest import write_file
+
+
+def test_batches_round_trip():
+    batch = ([u'a', u'a/č.txt'], array.array(TYPE_CODE, [1, 0]),
+             array.array(SIZE_CODE, [0, 2 ** 40]),
+             array.array(TIME_CODE, [1.5, 2.5]),
+             array.array(TIME_CODE, [3.5, 4.5]))
+    assert unpack_batch(pack_batch(*batch)) == list(batch)
+
+
+def read_batches(fd):
+    data = b''
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    batches = []
+    while data:
+        (size,) = FRAME.unpack(data[:FRAME.size])
+        batches.append(unpack_batch(data[FRAME.size:FRAME.size + size]))
+        data = data[FRAME.size + size:]
+    return batches
+
+
+@pytest.fixture
+def tree(tmpdir):
+    path = str(tmpdir.mkdir('tree'))
+    for i in range(4):
+        for j in range(3):
+            write_file(path, 'd{}/e{}/f.txt'.format(i, j), 'x' * i)
+    write_file(path, 'top.txt', 'top')
+    return path
+
+
+def test_walk_partition(tree):
+    (read_fd, write_fd) = os.pipe()
+    walk_partition(os.path.join(tree, 'd1'), tree,
+                   lambda e: not e.name.startswith('e2'), write_fd,
+                   batch_size=2)
+    os.close(write_fd)
+    batches = read_batches(read_fd)
+    os.close(read_fd)
+    assert [len(b[0]) for b in batches] == [2, 2]
+    rows = []
+    for (paths, types, sizes, _, _) in batches:
+        rows.extend(zip(paths, types, sizes))
+    assert sorted(row[:2] for row in rows) == [('d1/e0', DIR_TYPE),
+                                               ('d1/e0/f.txt', FILE_TYPE),
+                                               ('d1/e1', DIR_TYPE),
+                                               ('d1/e1/f.txt', FILE_TYPE)]
+    assert [size for (_, type, size) in rows if type == FILE_TYPE] == [1, 1]
+
+
+def walk(tree, processes):
+    walker = ParallelWalker({'walker.processes': processes,
+                             'walker.batch_size': 2})
+    entries = list(walker.walk(tree, os.path.dirname(tree),
+                               lambda e: e.name != 'e1'))
+    return (walker, [os.path.relpath(e.path, tree) for e in entries])
+
+
+def test_parallel_walk(tree):
+    (walker, paths) = walk(tree, 2)
+    assert walker.get_stats()['partitions'] > 1
+    assert sorted(paths) == sorted(
+        ['.', 'top.txt'] +
+        ['d{}'.format(i) for i in range(4)] +
+        ['d{}/e{}'.format(i, j) for i in range(4) for j in (0, 2)] +
+        ['d{}/e{}/f.txt'.format(i, j) for i in range(4) for j in (0, 2)])
+    # each directory comes before its descendants
+    seen = set()
+    for path in paths:
+        parent = os.path.dirname(path)
+        assert parent in seen or path == '.' or not parent
+        seen.add(path)
+
+
+def test_parallel_walk_of_file(tree):
+    (_, paths) = walk(os.path.join(tree, 'top.txt'), 2)
+    assert paths == ['.']
+
+
+class RecordingQueue(gevent.queue.Queue):
+    """
+    Queue which records the largest number of items it held.
+    """
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingQueue, self).__init__(*args, **kwargs)
+        self.max_size = 0
+        self.instances.append(self)
+
+    def put(self, item, *args, **kwargs):
+        super(RecordingQueue, self).put(item, *args, **kwargs)
+        self.max_size = max(self.max_size, self.qsize())
+
+
+def test_walk_waits_for_indexer(tree, monkeypatch):
+    del RecordingQueue.instances[:]
+    monkeypatch.setattr(walker.gevent.queue, 'Queue', RecordingQueue)
+    parallel = ParallelWalker({'walker.processes': 1,
+                               'walker.batch_size': 1})
+    # the indexer falls behind the walker process
+    entries = list(parallel.walk(tree, os.path.dirname(tree),
+                                 lambda e: True,
+                                 pause=lambda: gevent.sleep(0.01)))
+    (batches,) = RecordingQueue.instances
+    assert batches.maxsize == walker.BATCHES_PER_PROCESS
+    assert batches.max_size == batches.maxsize
+    assert len(entries) == 30
+
+
+def test_abandoned_walk(tree):
+    entries = ParallelWalker({'walker.processes': 2,
+                              'walker.batch_size': 1}).walk(
+        tree, os.path.dirname(tree), lambda e: True)
+    for _ in range(8):
+        next(entries)
+    # the readers blocked on the full queue are stopped
+    with gevent.Timeout(5):
+        entries.close()
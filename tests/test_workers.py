@@ -0,0 +1,112 @@
+import datetime
+import os
+
+import gevent
+import pytest
+
+from fsal.tree import IndexTree
+from fsal.usage import StorageUsage
+from fsal.workers import (Channel, Receiver, SharedCache, SharedTree,
+                          SharedUsage, encode_row, decode_row)
+
+
+MODIFIED = datetime.datetime(2020, 1, 1, 12, 30, 15, 250)
+
+ROW = {'id': 1, 'path': 'a.txt', 'type': 0, 'size': 3,
+       'create_time': MODIFIED, 'modify_time': MODIFIED,
+       'base_path': '/mnt/data', 'name': 'a.txt'}
+
+
+class FakeCache(object):
+
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate(self, path):
+        self.invalidated.append(path)
+
+
+def test_encoded_rows_round_trip():
+    data = encode_row(ROW)
+    # extra fields of the row are not needed by peers
+    assert 'name' not in data
+    assert isinstance(data['modify_time'], int)
+    assert decode_row(data) == dict((k, v) for (k, v) in ROW.items()
+                                    if k != 'name')
+
+
+def new_tree():
+    tree = IndexTree({'tree.enabled': True})
+    tree.load([])
+    return tree
+
+
+@pytest.fixture
+def peer():
+    (read_fd, write_fd) = os.pipe()
+    reloads = []
+    receiver = Receiver(read_fd, new_tree(), FakeCache(), StorageUsage(),
+                        reload_tree=lambda: reloads.append(True))
+    receiver.reloads = reloads
+    receiver.start()
+    receiver.channel = Channel([write_fd])
+    yield receiver
+    receiver.stop()
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def wait_for(receiver, count):
+    with gevent.Timeout(5):
+        while receiver.received < count:
+            gevent.sleep(0.01)
+
+
+def test_changes_are_applied_by_peers(peer):
+    config = {'tree.enabled': True}
+    tree = SharedTree(config, new_tree(), peer.channel)
+    cache = SharedCache(config, FakeCache(), peer.channel)
+    usage = SharedUsage(StorageUsage(), peer.channel)
+    tree.put(ROW)
+    usage.add('/mnt/data', False, 3)
+    cache.invalidate('a.txt')
+    tree.set_base_path('/mnt/other', ['/mnt/data'])
+    wait_for(peer, 4)
+    assert peer.tree.get('a.txt')['base_path'] == '/mnt/other'
+    assert peer.tree.get('a.txt')['modify_time'] == MODIFIED
+    assert peer.usage.get('/mnt/data') == usage.get('/mnt/data')
+    assert peer.cache.invalidated == ['a.txt']
+    tree.remove('a.txt')
+    tree.reload()
+    wait_for(peer, 6)
+    assert peer.tree.get('a.txt') is None
+    assert peer.reloads == [True]
+    # passed through to the local components
+    assert tree.get_stats()['entries'] == 0
+    assert peer.channel.sent == 6
+
+
+def test_disabled_components_are_not_shared(peer):
+    tree = SharedTree({'tree.enabled': False}, new_tree(), peer.channel)
+    tree.put(ROW)
+    assert peer.channel.sent == 0
+
+
+def test_unknown_changes_are_skipped(peer):
+    peer.channel.send('explode')
+    peer.channel.send('usage_add', '/mnt/data', True, 0, 1)
+    wait_for(peer, 2)
+    assert peer.usage.get('/mnt/data')['dirs'] == 1
+
+
+def test_dead_peers_are_dropped(peer):
+    (read_fd, write_fd) = os.pipe()
+    # the peer of the pipe exited
+    os.close(read_fd)
+    channel = Channel([write_fd, peer.channel.fds[0]])
+    channel.send('usage_add', '/mnt/data', True, 0, 1)
+    channel.send('usage_add', '/mnt/data', True, 0, 1)
+    wait_for(peer, 2)
+    assert peer.usage.get('/mnt/data')['dirs'] == 2
+    assert channel.fds == peer.channel.fds
+    assert (channel.sent, channel.dropped) == (2, 1)